@@ -0,0 +1,478 @@
+# -*- coding: utf-8 -*-
+"""
+Historical pull analytics.
+
+Folds the run manifest (see sft_manifest) into daily aggregates per submitter: files,
+bytes, rows and, for every stage of the pull (download, stage, sync_wait, delete and
+their total), a log-bucketed histogram of seconds per file, so p50/p95 can be read back
+without the raw records.  The aggregates live in one small JSON file next to the manifest
+(sft_analytics.json) together with the manifest cursor they cover, and are brought up to
+date incrementally: only records newer than the cursor are read.
+
+    python sft_analytics.py                       # update, then print the last 30 days
+    python sft_analytics.py --submitter LAB_A     # one submitter, per stage and per day
+    python sft_analytics.py --no-update --json    # read-only, machine readable
+"""
+###############################################################################################################
+###############################################################################################################
+
+import os
+import json
+import math
+import pickle
+import datetime
+import argparse
+
+from sft_manifest import read_since
+from sft_report import format_bytes, format_seconds
+
+ANALYTICS_FILENAME = 'sft_analytics.json'
+
+# Histogram buckets: BUCKETS_PER_DOUBLING per doubling of seconds, starting at MIN_SECONDS.
+# Four per doubling keeps percentiles within ~10% of the true value.
+MIN_SECONDS = 0.001
+BUCKETS_PER_DOUBLING = 4
+
+# Name of the per-file sum of all stages
+TOTAL_STAGE = 'total'
+
+# Name of the per-file time to availability (first seen on the SFT -> verified on the share)
+AVAILABLE_STAGE = 'available'
+
+###############################################################################################################
+###############################################################################################################
+
+####################################################################################
+# Histograms
+####################################################################################
+
+def bucket_for(seconds):
+    '''Histogram bucket (as a string key) holding a duration in seconds.'''
+
+    if seconds <= MIN_SECONDS:
+        return '0'
+
+    return str(int(math.log2(seconds / MIN_SECONDS) * BUCKETS_PER_DOUBLING) + 1)
+
+
+def bucket_upper_seconds(bucket):
+    '''Largest duration that falls in a bucket.'''
+
+    return MIN_SECONDS * 2 ** (int(bucket) / BUCKETS_PER_DOUBLING)
+
+
+def merge_histograms(target, source):
+    '''Adds the counts of source into target (both {bucket: count}).  Returns target.'''
+
+    for bucket, count in source.items():
+        target[bucket] = target.get(bucket, 0) + count
+
+    return target
+
+
+def percentile(histogram, q):
+
+    '''
+    (Python)
+
+    Approximate q-th percentile (0-100) of a histogram, as the upper edge of the bucket
+    it falls in.  None for an empty histogram.
+    '''
+
+    total = sum(histogram.values())
+    if not total:
+        return None
+
+    rank = q / 100 * total
+    seen = 0
+    for bucket in sorted(histogram, key=int):
+        seen += histogram[bucket]
+        if seen >= rank:
+            return bucket_upper_seconds(bucket)
+
+    return bucket_upper_seconds(max(histogram, key=int))
+
+###############################################################################################################
+###############################################################################################################
+
+####################################################################################
+# Building the aggregates incrementally
+####################################################################################
+
+def empty_aggregates():
+    return {'cursor': 0, 'updated_at': None, 'days': {}}
+
+
+def load_aggregates(manifest_directory):
+    '''The stored aggregates, or empty ones.'''
+
+    path = os.path.join(manifest_directory, ANALYTICS_FILENAME)
+    if not os.path.exists(path):
+        return empty_aggregates()
+
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def save_aggregates(manifest_directory, aggregates):
+    '''Writes the aggregates (and the cursor they cover) in one atomic replace.'''
+
+    path = os.path.join(manifest_directory, ANALYTICS_FILENAME)
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w') as f:
+        json.dump(aggregates, f, separators=(',', ':'), sort_keys=True)
+    os.replace(temp_path, path)
+
+
+def add_record(aggregates, record):
+
+    '''
+    (Python)
+
+    Folds one manifest record into the aggregates: the day it was downloaded, its
+    submitter, its size and rows, and each stage's seconds (plus their total).
+    '''
+
+    day = str(record.get('downloaded_at') or record.get('recorded_at') or '')[:10] or 'unknown'
+    submitter = record.get('submitter') or 'unknown'
+
+    entry = aggregates['days'].setdefault(day, {}).setdefault(submitter, {
+        'files': 0, 'bytes': 0, 'rows': 0, 'unsized_files': 0, 'stages': {}})
+
+    entry['files'] += 1
+    if record.get('size') is None:
+        entry['unsized_files'] += 1
+    else:
+        entry['bytes'] += record['size']
+    entry['rows'] += record.get('row_count') or 0
+
+    stage_seconds = dict(record.get('stage_seconds') or {})
+    if stage_seconds:
+        stage_seconds[TOTAL_STAGE] = sum(stage_seconds.values())
+
+    # Time to availability (see sft_schedule) sits beside the stages, outside the total
+    if record.get('available_seconds') is not None:
+        stage_seconds[AVAILABLE_STAGE] = record['available_seconds']
+
+    for stage, seconds in stage_seconds.items():
+        stats = entry['stages'].setdefault(stage, {'sum': 0.0, 'histogram': {}})
+        stats['sum'] += seconds
+        bucket = bucket_for(seconds)
+        stats['histogram'][bucket] = stats['histogram'].get(bucket, 0) + 1
+
+
+def update_aggregates(manifest_directory, aggregates=None):
+
+    '''
+    (Python)
+
+    Brings the aggregates up to date with the manifest and saves them.  Only records
+    after the stored cursor are read, so a daily update costs one day of records.
+
+    --------------------------------------------------------------------------------------
+
+    Keyword arguments:
+    manifest_directory -- folder holding the manifest (and the aggregates file)
+    aggregates -- already loaded aggregates, if any
+
+    --------------------------------------------------------------------------------------
+
+    Returns:
+    (aggregates, number of records added)
+    '''
+
+    if aggregates is None:
+        aggregates = load_aggregates(manifest_directory)
+
+    records, cursor = read_since(manifest_directory, aggregates['cursor'])
+
+    for record in records:
+        add_record(aggregates, record)
+
+    if records:
+        aggregates['cursor'] = cursor
+        aggregates['updated_at'] = datetime.datetime.now().isoformat(timespec='seconds')
+        save_aggregates(manifest_directory, aggregates)
+
+    return aggregates, len(records)
+
+###############################################################################################################
+###############################################################################################################
+
+####################################################################################
+# Queries
+####################################################################################
+
+def _merge_entry(target, entry):
+
+    for key in ('files', 'bytes', 'rows', 'unsized_files'):
+        target[key] += entry.get(key, 0)
+
+    for stage, stats in entry['stages'].items():
+        merged = target['stages'].setdefault(stage, {'sum': 0.0, 'histogram': {}})
+        merged['sum'] += stats['sum']
+        merge_histograms(merged['histogram'], stats['histogram'])
+
+    return target
+
+
+def _new_entry():
+    return {'files': 0, 'bytes': 0, 'rows': 0, 'unsized_files': 0, 'stages': {}}
+
+
+def window_days(aggregates, days, end=None):
+    '''The days-long window ending on end (default: the last day with data) as sorted ISO dates.'''
+
+    known = sorted(d for d in aggregates['days'] if d != 'unknown')
+    if not known:
+        return []
+
+    end = end or datetime.date.fromisoformat(known[-1])
+    start = end - datetime.timedelta(days=days - 1)
+
+    return [(start + datetime.timedelta(days=i)).isoformat() for i in range(days)]
+
+
+def daily_series(aggregates, days, submitter=None):
+
+    '''
+    (Python)
+
+    One merged entry per day of the window (days with no pulls are zero), for one
+    submitter or all of them.  Returns a list of (ISO date, entry).
+    '''
+
+    series = []
+    for day in days:
+        entry = _new_entry()
+        for name, day_entry in aggregates['days'].get(day, {}).items():
+            if submitter is None or name == submitter:
+                _merge_entry(entry, day_entry)
+        series.append((day, entry))
+
+    return series
+
+
+def by_submitter(aggregates, days):
+    '''Window totals per submitter: {submitter: entry}.'''
+
+    totals = {}
+    for day in days:
+        for name, entry in aggregates['days'].get(day, {}).items():
+            _merge_entry(totals.setdefault(name, _new_entry()), entry)
+
+    return totals
+
+
+def stage_summary(entry):
+    '''{stage: (mean, p50, p95)} seconds per file for an entry.'''
+
+    summary = {}
+    for stage, stats in entry['stages'].items():
+        count = sum(stats['histogram'].values())
+        summary[stage] = (stats['sum'] / count if count else None,
+                          percentile(stats['histogram'], 50), percentile(stats['histogram'], 95))
+
+    return summary
+
+
+def linear_fit(ys):
+
+    '''
+    (Python)
+
+    Least-squares line through (0, ys[0]), (1, ys[1]), ...  Returns (slope per step,
+    value at the last step).  A flat line for fewer than two points.
+    '''
+
+    n = len(ys)
+    if n < 2:
+        return 0.0, (ys[0] if ys else 0.0)
+
+    mean_x = (n - 1) / 2
+    mean_y = sum(ys) / n
+    slope = (sum((x - mean_x) * (y - mean_y) for x, y in enumerate(ys))
+             / sum((x - mean_x) ** 2 for x in range(n)))
+
+    return slope, mean_y + slope * (n - 1 - mean_x)
+
+
+def project(series, horizon_days):
+
+    '''
+    (Python)
+
+    Linear trend of daily files, bytes and pull time over the series, and the daily
+    values it projects horizon_days after the last day.  Pull time per day is the
+    projected file count times the window's mean seconds per file.
+
+    --------------------------------------------------------------------------------------
+
+    Returns:
+    dict with files_per_day / bytes_per_day slopes ('*_slope'), current fitted values
+    ('*_now') and projections ('*_projected'), plus seconds_per_file and
+    pull_seconds_projected
+    '''
+
+    files = [e['files'] for _, e in series]
+    sizes = [e['bytes'] for _, e in series]
+
+    files_slope, files_now = linear_fit(files)
+    bytes_slope, bytes_now = linear_fit(sizes)
+
+    total_seconds = sum(e['stages'].get(TOTAL_STAGE, {}).get('sum', 0.0) for _, e in series)
+    timed_files = sum(sum(e['stages'].get(TOTAL_STAGE, {}).get('histogram', {}).values()) for _, e in series)
+    seconds_per_file = total_seconds / timed_files if timed_files else None
+
+    files_projected = max(files_now + files_slope * horizon_days, 0.0)
+
+    return {
+        'files_slope': files_slope, 'files_now': files_now, 'files_projected': files_projected,
+        'bytes_slope': bytes_slope, 'bytes_now': bytes_now,
+        'bytes_projected': max(bytes_now + bytes_slope * horizon_days, 0.0),
+        'seconds_per_file': seconds_per_file,
+        'pull_seconds_projected': files_projected * seconds_per_file if seconds_per_file is not None else None,
+    }
+
+###############################################################################################################
+###############################################################################################################
+
+####################################################################################
+# Formatting
+####################################################################################
+
+def _seconds(value):
+    return '-' if value is None else ('{:.2f}s'.format(value) if value < 10 else format_seconds(value))
+
+
+def format_trends(aggregates, days=30, horizon_days=90, submitter=None):
+
+    '''
+    (Python)
+
+    Text report for the window: per-submitter volume and p50/p95 time per file (slowest
+    first), or for one submitter its per-stage times and day-by-day series; then the
+    daily trend and the projection horizon_days out.
+    '''
+
+    window = window_days(aggregates, days)
+    if not window:
+        return 'No pull history in the aggregates yet (cursor {}).'.format(aggregates['cursor'])
+
+    lines = ['SFT pull analytics  {} .. {}  ({} days, manifest cursor {})'.format(
+        window[0], window[-1], days, aggregates['cursor']), '']
+
+    if submitter is None:
+        totals = by_submitter(aggregates, window)
+        rows = []
+        for name, entry in totals.items():
+            stages = stage_summary(entry)
+            _, p50, p95 = stages.get(TOTAL_STAGE, (None, None, None))
+            slowest = max((s for s in stages if s not in (TOTAL_STAGE, AVAILABLE_STAGE)), key=lambda s: stages[s][2] or 0, default=None)
+            rows.append((p95 or 0, name, entry, p50, p95, stages.get(AVAILABLE_STAGE, (None, None, None))[2], slowest))
+
+        lines.append('{:<28} {:>7} {:>10} {:>9} {:>9} {:>9}  {}'.format('Submitter', 'Files', 'Size', 'p50/file', 'p95/file', 'p95 avail', 'slowest stage (p95)'))
+        for _, name, entry, p50, p95, available_p95, slowest in sorted(rows, key=lambda r: (-r[0], r[1])):
+            lines.append('{:<28} {:>7} {:>10} {:>9} {:>9} {:>9}  {}'.format(
+                name[:28], entry['files'], format_bytes(entry['bytes']), _seconds(p50), _seconds(p95), _seconds(available_p95),
+                '{} ({})'.format(slowest, _seconds(stage_summary(entry)[slowest][2])) if slowest else '-'))
+
+    else:
+        entry = _new_entry()
+        for _, day_entry in daily_series(aggregates, window, submitter):
+            _merge_entry(entry, day_entry)
+
+        lines.append('{}:  {} file(s), {}'.format(submitter, entry['files'], format_bytes(entry['bytes'])))
+        lines.append('{:<12} {:>9} {:>9} {:>9}'.format('Stage', 'mean', 'p50', 'p95'))
+        for stage, (mean, p50, p95) in sorted(stage_summary(entry).items()):
+            lines.append('{:<12} {:>9} {:>9} {:>9}'.format(stage, _seconds(mean), _seconds(p50), _seconds(p95)))
+
+        lines += ['', '{:<12} {:>7} {:>10} {:>9}'.format('Day', 'Files', 'Size', 'p95/file')]
+        for day, day_entry in daily_series(aggregates, window, submitter):
+            if day_entry['files']:
+                _, _, p95 = stage_summary(day_entry).get(TOTAL_STAGE, (None, None, None))
+                lines.append('{:<12} {:>7} {:>10} {:>9}'.format(day, day_entry['files'], format_bytes(day_entry['bytes']), _seconds(p95)))
+
+    projection = project(daily_series(aggregates, window, submitter), horizon_days)
+
+    lines += ['',
+              'Daily trend:     {:+.2f} files/day, {}{}/day per day'.format(
+                  projection['files_slope'], '-' if projection['bytes_slope'] < 0 else '+',
+                  format_bytes(abs(projection['bytes_slope']))),
+              'Now (fitted):    {:.1f} files/day, {}/day'.format(projection['files_now'], format_bytes(projection['bytes_now'])),
+              '{:<17}{:.1f} files/day, {}/day, pull time {}/day'.format(
+                  'In {} days:'.format(horizon_days), projection['files_projected'], format_bytes(projection['bytes_projected']),
+                  _seconds(projection['pull_seconds_projected']))]
+
+    return '\n'.join(lines)
+
+
+def trends_to_json(aggregates, days=30, horizon_days=90, submitter=None):
+    '''The same figures as format_trends(), as JSON.'''
+
+    window = window_days(aggregates, days)
+
+    submitters = {}
+    for name, entry in by_submitter(aggregates, window).items():
+        if submitter is None or name == submitter:
+            submitters[name] = {'files': entry['files'], 'bytes': entry['bytes'], 'rows': entry['rows'],
+                                'stages': {s: dict(zip(('mean', 'p50', 'p95'), v)) for s, v in stage_summary(entry).items()}}
+
+    series = daily_series(aggregates, window, submitter)
+
+    return json.dumps({
+        'cursor': aggregates['cursor'],
+        'window': window[:1] + window[-1:],
+        'submitters': submitters,
+        'daily': [{'date': d, 'files': e['files'], 'bytes': e['bytes']} for d, e in series],
+        'projection': dict(project(series, horizon_days), horizon_days=horizon_days),
+    }, indent=1)
+
+###############################################################################################################
+###############################################################################################################
+
+####################################################################################
+# Command line
+####################################################################################
+
+def main(argv=None):
+
+    '''
+    (Python)
+
+    Command line for the analytics (also `sft stats`).  Returns the process exit code.
+    '''
+
+    parser = argparse.ArgumentParser(description='Pull throughput, latency and volume trends from the run manifest.')
+    parser.add_argument('--days', type=int, default=30, help='window length in days (default 30)')
+    parser.add_argument('--horizon', type=int, default=90, help='days ahead to project (default 90)')
+    parser.add_argument('--submitter', help='one submitter: per-stage times and day-by-day series')
+    parser.add_argument('--no-update', action='store_true', help='read the stored aggregates without folding in new records')
+    parser.add_argument('--json', action='store_true', help='print JSON instead of text')
+    parser.add_argument('--manifest-dir', help='manifest folder (default: manifest_directory from the objects file)')
+    args = parser.parse_args(argv)
+
+    manifest_directory = args.manifest_dir
+    if manifest_directory is None:
+        from sft_settings import get_settings
+        objects = pickle.load(open(get_settings().objects_path, 'rb'))
+        manifest_directory = objects.get('manifest_directory', '//Sequence Data and Reporting/Submissions/manifest/')
+
+    if args.no_update:
+        aggregates = load_aggregates(manifest_directory)
+    else:
+        aggregates, added = update_aggregates(manifest_directory)
+        if added and not args.json:
+            print('Folded {} new manifest record(s) into the aggregates.\n'.format(added))
+
+    if args.json:
+        print(trends_to_json(aggregates, args.days, args.horizon, args.submitter))
+    else:
+        print(format_trends(aggregates, args.days, args.horizon, args.submitter))
+
+    return 0
+
+
+if __name__ == '__main__':
+    import sys
+    sys.exit(main())
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+"""
+`sft` command line.
+
+    sft pull     [--no-report] [--dry-run] [--since YYYY-MM-DD] ...   (sft_run: locked pull, then report)
+    sft report   [--date YYYY-MM-DD] [--since YYYY-MM-DD] [--dry-run]  (sft_email)
+    sft plan     [--csv plan.csv] [--json plan.json] [--no-cache]      (sft_plan)
+    sft config   show | recipients | set | settings                    (sft_config)
+    sft stats    [--days N] [--submitter NAME] [--horizon N] [--json]  (sft_analytics)
+    sft scrub    [--mb-per-second N] [--max-minutes N] [--problems]    (sft_scrub)
+    sft reconcile [--since YYYY-MM-DD] [--live] [--repair] [--json f]  (sft_reconcile)
+    sft pack     [--days N] [--max-minutes N] [--extract NAME]         (sft_pack)
+    sft retention [--dry-run] [--batch N] [--max-minutes N]            (sft_retention)
+
+Each subcommand's module is imported only when it runs, so `sft report` and
+`sft config` never load selenium or pandas.  `sft <command> --help` lists the options.
+"""
+###############################################################################################################
+###############################################################################################################
+
+import sys
+import importlib
+
+# Subcommand -> (module with a main(argv) function, one-line description)
+COMMANDS = {
+    'pull': ('sft_run', 'pull files from the SFT under the run lock, then send the daily report'),
+    'report': ('sft_email', 'build and email (or print) the daily report'),
+    'plan': ('sft_plan', 'show what the pull would do, without moving anything'),
+    'config': ('sft_config', 'view or edit the objects file, recipients and settings'),
+    'stats': ('sft_analytics', 'throughput, latency and volume trends per submitter, with projections'),
+    'scrub': ('sft_scrub', 're-verify archived files against their pull-time checksums'),
+    'reconcile': ('sft_reconcile', 'cross-check the SFT listing, the pull log and the files on disk'),
+    'pack': ('sft_pack', 'move cold archive copies into monthly pack files, or extract one'),
+    'retention': ('sft_retention', 'delete archive copies past their retention policy (or --dry-run)'),
+}
+
+###############################################################################################################
+###############################################################################################################
+
+def usage():
+    '''Top-level help text.'''
+
+    lines = ['usage: sft <command> [options]', '', 'commands:']
+    lines += ['  {:<8} {}'.format(name, description) for name, (_, description) in COMMANDS.items()]
+
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+
+    '''
+    (Python)
+
+    Dispatches to the subcommand's main(argv).  Returns the process exit code.
+    '''
+
+    argv = sys.argv[1:] if argv is None else list(argv)
+
+    if not argv or argv[0] in ('-h', '--help'):
+        print(usage())
+        return 0 if argv else 2
+
+    command, rest = argv[0], argv[1:]
+    if command not in COMMANDS:
+        print('sft: unknown command {!r}\n\n{}'.format(command, usage()), file=sys.stderr)
+        return 2
+
+    module = importlib.import_module(COMMANDS[command][0])
+
+    try:
+        return module.main(rest)
+    except SystemExit as e:
+        # argparse --help / usage errors inside the subcommand
+        return e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+"""
+Viewing and editing the SFT objects file (sft_objects.p) and settings.
+
+Backs `sft config` and sft_TweakEmailList.py.  Imports nothing beyond the standard
+library and sft_settings, so it starts quickly.
+
+Examples:
+    sft config show
+    sft config recipients --set first.person@doh.wa.gov second.person@doh.wa.gov
+    sft config recipients --add new.person@doh.wa.gov
+    sft config set chrome_headless false
+    sft config settings
+"""
+###############################################################################################################
+###############################################################################################################
+
+import os
+import re
+import json
+import pickle
+import argparse
+
+from sft_settings import get_settings
+
+# Keys whose values are never printed (smtp_password, api tokens, ...)
+SECRET_KEY_PATTERN = re.compile(r'password|passwd|secret|token', re.IGNORECASE)
+
+###############################################################################################################
+###############################################################################################################
+
+####################################################################################
+# Reading and writing the objects file
+####################################################################################
+
+def load_objects(settings=None):
+    '''The contents of sft_objects.p.'''
+
+    with open((settings or get_settings()).objects_path, 'rb') as f:
+        return pickle.load(f)
+
+
+def save_objects(objects, settings=None):
+    '''Writes sft_objects.p (to a temporary file first, so a failed write can't truncate it).'''
+
+    path = (settings or get_settings()).objects_path
+    temp_path = path + '.tmp'
+
+    with open(temp_path, 'wb') as f:
+        pickle.dump(objects, f)
+    os.replace(temp_path, path)
+
+
+def update_email_recipients(set_to=None, add=(), remove=(), settings=None):
+
+    '''
+    (Python)
+
+    Edits objects['email_recipient_list'] and saves the objects file.
+    Returns the new list.
+
+    --------------------------------------------------------------------------------------
+
+    Keyword arguments:
+    set_to -- replace the whole list with this one
+    add -- addresses to add (if not already there)
+    remove -- addresses to remove
+    settings -- sft_settings.Settings.  Defaults to the process-wide settings.
+    '''
+
+    objects = load_objects(settings)
+
+    email_list = list(set_to) if set_to is not None else list(objects.get('email_recipient_list', []))
+    email_list += [e for e in add if e not in email_list]
+    email_list = [e for e in email_list if e not in remove]
+
+    objects['email_recipient_list'] = email_list
+    save_objects(objects, settings)
+
+    return email_list
+
+
+def shown_value(key, value):
+    '''value as printed by `sft config`: secrets (see SECRET_KEY_PATTERN) are masked.'''
+
+    if SECRET_KEY_PATTERN.search(str(key)) and value not in (None, ''):
+        return '***'
+
+    return repr(value)
+
+
+def parse_value(text):
+    '''Command line value -> Python value: JSON if it parses (numbers, true/false, null, lists), else the string.'''
+
+    try:
+        return json.loads(text)
+    except ValueError:
+        return text
+
+###############################################################################################################
+###############################################################################################################
+
+####################################################################################
+# Command line
+####################################################################################
+
+def main(argv=None):
+
+    '''
+    (Python)
+
+    Command line for `sft config`.  Returns the process exit code.
+    '''
+
+    parser = argparse.ArgumentParser(description='View or edit the SFT objects file and settings.')
+    commands = parser.add_subparsers(dest='command')
+
+    commands.add_parser('show', help='print the objects file (xpaths, options, recipients; secrets hidden)')
+
+    recipients = commands.add_parser('recipients', help='show or edit the daily report recipients')
+    recipients.add_argument('--set', nargs='+', metavar='EMAIL', help='replace the list')
+    recipients.add_argument('--add', nargs='+', metavar='EMAIL', default=[], help='add addresses')
+    recipients.add_argument('--remove', nargs='+', metavar='EMAIL', default=[], help='remove addresses')
+
+    set_value = commands.add_parser('set', help='set one key in the objects file')
+    set_value.add_argument('key')
+    set_value.add_argument('value', help='JSON (true, 30, ["a"]) or a plain string')
+
+    commands.add_parser('settings', help='print the resolved paths and where each came from (secrets hidden)')
+
+    args = parser.parse_args(argv)
+
+    if args.command == 'show':
+        for key, value in sorted(load_objects().items()):
+            print('{}:  {}'.format(key, shown_value(key, value)))
+
+    elif args.command == 'recipients':
+        if args.set is None and not args.add and not args.remove:
+            email_list = load_objects().get('email_recipient_list', [])
+        else:
+            email_list = update_email_recipients(args.set, args.add, args.remove)
+        print('\n'.join(email_list))
+
+    elif args.command == 'set':
+        objects = load_objects()
+        objects[args.key] = parse_value(args.value)
+        save_objects(objects)
+        print('{}:  {}'.format(args.key, shown_value(args.key, objects[args.key])))
+
+    elif args.command == 'settings':
+        print(get_settings())
+
+    else:
+        parser.print_help()
+        return 2
+
+    return 0
+
+
+if __name__ == '__main__':
+    import sys
+    sys.exit(main())
@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+"""
+Consolidated submissions dataset.
+
+Every workbook/CSV the pull converts (see sft_sidecar) is also appended to one
+append-only Parquet dataset, partitioned by submitter and pull month:
+
+    <consolidated_directory>/submitter=LAB_A/month=2021-08/part-<sha256 prefix>.parquet
+
+Each part file holds one submitted file's rows plus provenance columns (source file,
+its sha256, row number, pull run id and pull date).  Part files are never rewritten:
+a new submission adds a new file, and the same content pulled twice maps to the same
+part name.  Rebuilding the combined history is then a scan of the partitions instead
+of re-parsing every submission, e.g. in R:
+
+    arrow::open_dataset('<consolidated_directory>', unify_schemas = TRUE) |> dplyr::filter(month >= '2021-06')
+"""
+###############################################################################################################
+###############################################################################################################
+
+import os
+import glob
+
+# Provenance columns added to every row
+SOURCE_FILE_COLUMN = 'sft_source_file'
+SOURCE_SHA256_COLUMN = 'sft_source_sha256'
+ROW_NUMBER_COLUMN = 'sft_row_number'
+RUN_ID_COLUMN = 'sft_run_id'
+PULLED_ON_COLUMN = 'sft_pulled_on'
+
+PART_PREFIX = 'part-'
+
+###############################################################################################################
+###############################################################################################################
+
+####################################################################################
+# Layout
+####################################################################################
+
+def partition_value(value):
+    '''A submitter name or month made safe for a hive-style folder name.'''
+
+    return ''.join(c if c.isalnum() or c in '-_.' else '_' for c in str(value)) or 'unknown'
+
+
+def part_path(dataset_directory, submitter, month, sha256):
+
+    '''
+    (Python)
+
+    Relative path of a submitted file's part inside the dataset.  Named after the
+    file's hash, so one content -> one part.
+
+    --------------------------------------------------------------------------------------
+
+    Example:
+    part_path('//share/consolidated/', 'LAB_A', '2021-08', '9f86d0...')
+    # -> '//share/consolidated/submitter=LAB_A/month=2021-08/part-9f86d081884c7d65.parquet'
+    '''
+
+    return os.path.join(dataset_directory, 'submitter=' + partition_value(submitter), 'month=' + partition_value(month),
+                        '{}{}.parquet'.format(PART_PREFIX, sha256[:16]))
+
+###############################################################################################################
+###############################################################################################################
+
+####################################################################################
+# Writing a part (runs in the sidecar worker processes)
+####################################################################################
+
+def write_part(sidecar_path, output_path, provenance):
+
+    '''
+    (Python)
+
+    Copies a freshly written sidecar into a dataset part, one row group at a time,
+    adding the provenance columns.
+
+    --------------------------------------------------------------------------------------
+
+    Keyword arguments:
+    sidecar_path -- local Parquet sidecar (see sft_sidecar.convert_to_parquet)
+    output_path -- local file to write the part to (written as .part, then renamed)
+    provenance -- dict with source_file, source_sha256, run_id and pulled_on
+
+    --------------------------------------------------------------------------------------
+
+    Returns:
+    bytes written
+    '''
+
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    sidecar = pq.ParquetFile(sidecar_path)
+
+    constants = [(SOURCE_FILE_COLUMN, provenance['source_file']),
+                 (SOURCE_SHA256_COLUMN, provenance['source_sha256']),
+                 (RUN_ID_COLUMN, provenance['run_id']),
+                 (PULLED_ON_COLUMN, provenance['pulled_on'])]
+
+    schema = sidecar.schema_arrow
+    for name, _ in constants:
+        schema = schema.append(pa.field(name, pa.string()))
+    schema = schema.append(pa.field(ROW_NUMBER_COLUMN, pa.int64()))
+
+    temp_path = output_path + '.part'
+    writer = pq.ParquetWriter(temp_path, schema)
+    row_number = 1
+
+    try:
+        for group in range(sidecar.num_row_groups):
+            table = sidecar.read_row_group(group)
+            for name, value in constants:
+                table = table.append_column(name, pa.array([value] * table.num_rows, pa.string()))
+            table = table.append_column(ROW_NUMBER_COLUMN, pa.array(range(row_number, row_number + table.num_rows), pa.int64()))
+            writer.write_table(table.replace_schema_metadata(schema.metadata))
+            row_number += table.num_rows
+    finally:
+        writer.close()
+
+    os.replace(temp_path, output_path)
+
+    return os.path.getsize(output_path)
+
+###############################################################################################################
+###############################################################################################################
+
+####################################################################################
+# Reading the dataset
+####################################################################################
+
+def part_files(dataset_directory, submitters=None, months=None):
+
+    '''
+    (Python)
+
+    Part files of the dataset, optionally limited to some submitters and months, found
+    from the folder names alone (no file is opened).
+    '''
+
+    submitter_globs = ['submitter=' + partition_value(s) for s in submitters] if submitters else ['submitter=*']
+    month_globs = ['month=' + partition_value(m) for m in months] if months else ['month=*']
+
+    paths = []
+    for submitter_glob in submitter_globs:
+        for month_glob in month_globs:
+            paths += glob.glob(os.path.join(dataset_directory, submitter_glob, month_glob, PART_PREFIX + '*.parquet'))
+
+    return sorted(paths)
+
+
+def open_dataset(dataset_directory, submitters=None, months=None):
+
+    '''
+    (Python)
+
+    pyarrow Dataset over the parts (all, or the given submitters/months), with
+    submitter and month as columns and the submitters' layouts unified: a column
+    missing from a file reads as null.
+
+    --------------------------------------------------------------------------------------
+
+    Example:
+    table = open_dataset(consolidated_directory, months=['2021-08']).to_table(columns=['submitter', 'SEQUENCE_ACCESSION'])
+    '''
+
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+
+    files = part_files(dataset_directory, submitters, months)
+    partitioning = ds.partitioning(pa.schema([('submitter', pa.string()), ('month', pa.string())]), flavor='hive')
+
+    # Only the footers are read to unify the schemas
+    schema = pa.unify_schemas([pq.read_schema(path).remove_metadata() for path in files]) if files else pa.schema([])
+    for name in ('submitter', 'month'):
+        if schema.get_field_index(name) < 0:
+            schema = schema.append(pa.field(name, pa.string()))
+
+    return ds.dataset(files, schema=schema, format='parquet', partitioning=partitioning,
+                      partition_base_dir=dataset_directory)
@@ -0,0 +1,281 @@
+# -*- coding: utf-8 -*-
+"""
+Chrome driver factory for the SFT pull.
+
+Builds a low-footprint (optionally headless) Chrome session whose downloads land
+in a dedicated per-run directory instead of the operator's shared Downloads folder.
+"""
+###############################################################################################################
+###############################################################################################################
+
+import os
+import shutil
+import datetime
+import tempfile
+
+###############################################################################################################
+###############################################################################################################
+
+####################################################################################
+# Per-run download directory
+####################################################################################
+
+def make_run_download_directory(base_directory=None, run_label=None):
+
+    '''
+    (Python)
+
+    Creates an empty download directory dedicated to a single SFT pull run.
+    Nothing else writes here, so watching it for finished downloads is cheap.
+
+    --------------------------------------------------------------------------------------
+
+    Keyword arguments:
+    base_directory -- folder the run directories live under.  Defaults to <tmp>/sft_downloads/
+    run_label -- name of the run directory.  Defaults to a YYYYmmdd_HHMMSS timestamp
+
+    --------------------------------------------------------------------------------------
+
+    Example:
+    dir_downloads = make_run_download_directory('C:/Users/me/sft_downloads/')
+    # -> 'C:/Users/me/sft_downloads/20210831_140102/'
+
+    --------------------------------------------------------------------------------------
+
+    Dependencies:
+    import os
+    import datetime
+    import tempfile
+    '''
+
+    # Default to a folder under the system temp dir (works on both Windows and Linux runners)
+    if base_directory is None:
+        base_directory = os.path.join(tempfile.gettempdir(), 'sft_downloads')
+
+    # Default label is the run's start time
+    if run_label is None:
+        run_label = datetime.datetime.now().strftime('%Y%m%d_%H%M%S')
+
+    # Create the directory.  Forward slashes + trailing slash to match the rest of the SFT scripts
+    run_directory = os.path.join(base_directory, run_label).replace('\\', '/')
+    os.makedirs(run_directory, exist_ok=True)
+
+    return run_directory.rstrip('/') + '/'
+
+###############################################################################################################
+###############################################################################################################
+
+####################################################################################
+# Cleaning up the per-run download directory
+####################################################################################
+
+def remove_run_download_directory(run_directory):
+
+    '''
+    (Python)
+
+    Removes a per-run download directory, but only if everything in it has been moved out.
+    Leftover files are kept so that a failed run can be inspected by hand.
+
+    --------------------------------------------------------------------------------------
+
+    Keyword arguments:
+    run_directory -- directory returned by make_run_download_directory()
+
+    --------------------------------------------------------------------------------------
+
+    Example:
+    remove_run_download_directory(dir_downloads)
+
+    --------------------------------------------------------------------------------------
+
+    Dependencies:
+    import os
+    '''
+
+    # Only remove it if it exists and is empty
+    if os.path.isdir(run_directory) and not os.listdir(run_directory):
+        os.rmdir(run_directory)
+        return True
+
+    return False
+
+###############################################################################################################
+###############################################################################################################
+
+####################################################################################
+# Building the Chrome options
+####################################################################################
+
+def build_chrome_options(download_directory,
+                         headless=True,
+                         disable_images=True,
+                         disable_fonts=True,
+                         disable_extensions=True,
+                         memory_cap_mb=None,
+                         profile_directory=None):
+
+    '''
+    (Python)
+
+    Builds the selenium ChromeOptions used by create_chrome_driver().
+
+    --------------------------------------------------------------------------------------
+
+    Keyword arguments:
+    download_directory -- full path that Chrome should save downloads to
+    headless -- run without a visible browser window
+    disable_images -- don't load images (the SFT file browser doesn't need them)
+    disable_fonts -- don't fetch remote web fonts
+    disable_extensions -- don't load any Chrome extensions
+    memory_cap_mb -- optional cap (MB) on the JavaScript heap of each renderer.  Also limits renderers to one.
+    profile_directory -- optional Chrome user-data-dir.  Reusing it between runs keeps cookies warm.
+
+    --------------------------------------------------------------------------------------
+
+    Example:
+    options = build_chrome_options('C:/tmp/sft_downloads/20210831_140102/', memory_cap_mb=512)
+
+    --------------------------------------------------------------------------------------
+
+    Dependencies:
+    import os
+    from selenium import webdriver
+    '''
+
+    from selenium import webdriver
+
+    options = webdriver.ChromeOptions()
+
+    # Chrome wants a native absolute path for its download directory
+    native_download_directory = os.path.abspath(download_directory)
+
+    # Download behaviour: straight to our run directory, never prompt
+    prefs = {
+        'download.default_directory': native_download_directory,
+        'download.prompt_for_download': False,
+        'download.directory_upgrade': True,
+        'profile.default_content_setting_values.automatic_downloads': 1,
+    }
+
+    # Content settings.  2 == block
+    if disable_images:
+        prefs['profile.managed_default_content_settings.images'] = 2
+
+    options.add_experimental_option('prefs', prefs)
+
+    # Headless mode.  Window size still matters for right-click context menus.
+    if headless:
+        options.add_argument('--headless=new')
+        options.add_argument('--window-size=1920,1080')
+
+    if disable_fonts:
+        options.add_argument('--disable-remote-fonts')
+
+    if disable_extensions:
+        options.add_argument('--disable-extensions')
+
+    # Memory cap.  Limit the JS heap and keep everything in one renderer process.
+    if memory_cap_mb is not None:
+        options.add_argument('--js-flags=--max-old-space-size={}'.format(int(memory_cap_mb)))
+        options.add_argument('--renderer-process-limit=1')
+
+    # General low-footprint flags for shared VMs
+    options.add_argument('--disable-dev-shm-usage')
+    options.add_argument('--disable-gpu')
+    options.add_argument('--no-first-run')
+    options.add_argument('--disable-background-networking')
+    options.add_argument('--disable-sync')
+
+    # The pull needs no HTTP cache (each page is read once): keep the disk cache minimal
+    options.add_argument('--disk-cache-size=1')
+
+    # Reuse a profile between runs
+    if profile_directory is not None:
+        os.makedirs(profile_directory, exist_ok=True)
+        options.add_argument('--user-data-dir={}'.format(os.path.abspath(profile_directory)))
+
+    return options
+
+###############################################################################################################
+###############################################################################################################
+
+####################################################################################
+# Creating the driver
+####################################################################################
+
+def create_chrome_driver(download_directory,
+                         headless=True,
+                         disable_images=True,
+                         disable_fonts=True,
+                         disable_extensions=True,
+                         memory_cap_mb=None,
+                         profile_directory=None):
+
+    '''
+    (Python)
+
+    Starts a Chrome webdriver configured for the SFT pull.  See build_chrome_options() for the arguments.
+
+    --------------------------------------------------------------------------------------
+
+    Example:
+    dir_downloads = make_run_download_directory()
+    driver = create_chrome_driver(dir_downloads, headless=True, memory_cap_mb=512)
+    driver.get('https://sft.wa.gov/')
+
+    --------------------------------------------------------------------------------------
+
+    Dependencies:
+    from selenium import webdriver
+    '''
+
+    from selenium import webdriver
+
+    options = build_chrome_options(download_directory,
+                                   headless=headless,
+                                   disable_images=disable_images,
+                                   disable_fonts=disable_fonts,
+                                   disable_extensions=disable_extensions,
+                                   memory_cap_mb=memory_cap_mb,
+                                   profile_directory=profile_directory)
+
+    driver = webdriver.Chrome(options=options)
+
+    # Older headless builds ignore the download prefs.  Set the behaviour explicitly through CDP as well.
+    try:
+        driver.execute_cdp_cmd('Page.setDownloadBehavior',
+                               {'behavior': 'allow', 'downloadPath': os.path.abspath(download_directory)})
+    except Exception as e:
+        print('Could not set download behaviour through CDP:  {}'.format(str(e)))
+
+    return driver
+
+###############################################################################################################
+###############################################################################################################
+
+####################################################################################
+# Resetting a reused profile
+####################################################################################
+
+def reset_profile_directory(profile_directory):
+
+    '''
+    (Python)
+
+    Deletes a reused Chrome profile so the next run starts from a clean slate.
+    Useful if the profile gets corrupted or the SFT login state goes stale.
+
+    --------------------------------------------------------------------------------------
+
+    Keyword arguments:
+    profile_directory -- the Chrome user-data-dir passed to create_chrome_driver()
+
+    --------------------------------------------------------------------------------------
+
+    Dependencies:
+    import shutil
+    '''
+
+    if os.path.isdir(profile_directory):
+        shutil.rmtree(profile_directory)
@@ -0,0 +1,384 @@
+# -*- coding: utf-8 -*-
+"""
+Row fingerprint index for duplicate detection at ingest.
+
+While a pulled workbook/CSV is streamed (see sft_sidecar), every row gets a fingerprint
+of its normalised identifiers: sequence id (GISAID_ID and its aliases), lab accession and
+specimen collection date, found with the same column-name rules as read_all_data.Rmd.
+Files with none of those columns fall back to a fingerprint of the whole row, which
+still catches labs re-sending identical records.
+
+Fingerprints are checked against a persistent SQLite index (one row per fingerprint with
+the file it was first seen in and how often it has been seen since).  A Bloom filter
+saved next to the database answers most lookups for new rows without touching SQLite,
+so checking a file costs O(its rows), not O(history).  Each manifest record is tagged
+with the file's duplicate counts.
+
+A file's rows are only added once the pull has confirmed it (share copies verified, SFT
+delete done): a file whose sync fails is pulled again by the next run and must not be
+reported as a duplicate of itself.  Until then its fingerprints are held in memory, so
+other files of the same run are still checked against them.
+"""
+###############################################################################################################
+###############################################################################################################
+
+import os
+import re
+import sqlite3
+import hashlib
+import datetime
+import threading
+
+# Sequence id columns, as listed in read_all_data.Rmd (gisaid_id_names)
+SEQUENCE_ID_NAMES = ('GISAID_ID', 'Seq ID', 'SEQUENCE_ACCESSION', 'shortname', 'gisaid_virus_name', 'Alt_CoVID',
+                     'altius_sample_identifier', 'virus_name', 'Virus name', 'strain_name', 'GISAID', 'IDs', 'GISAID ID')
+
+# Lab accession columns: read_all_data.Rmd's accession_names pattern minus its exclusions
+ACCESSION_PATTERN = re.compile('ACCESSION|ACC|SPECIMENID|SPECIMEN_ID|SEQUENCE_CLINICAL|ACESSION')
+ACCESSION_EXCLUDED = ('Link_test_to_parent_accession', 'SEQUENCE_ACCESSION')
+
+# Collection date columns, most specific first
+COLLECTION_DATE_NAMES = ('SEQUENCE_SPECIMEN_COLLECTION_DATE', 'SPECIMEN_COLLECTION_DATE', 'COLLECTION_DATE')
+
+# Values that mean 'missing'
+MISSING_VALUES = ('', 'NA', 'N/A', 'NULL', 'NONE', 'UNKNOWN')
+
+DATE_FORMATS = ('%Y-%m-%d', '%m/%d/%Y', '%m/%d/%y', '%Y%m%d', '%d-%b-%Y', '%Y/%m/%d')
+
+# Bloom filter sizing: bits per expected key and hash functions (about 1% false positives)
+BLOOM_BITS_PER_KEY = 10
+BLOOM_HASHES = 7
+BLOOM_MIN_KEYS = 1000000
+
+###############################################################################################################
+###############################################################################################################
+
+####################################################################################
+# Fingerprints
+####################################################################################
+
+def normalise_value(value):
+    '''Trimmed, upper-cased, single-spaced text, or '' for missing values.'''
+
+    if value is None:
+        return ''
+
+    text = ' '.join(str(value).split()).upper()
+
+    return '' if text in MISSING_VALUES else text
+
+
+def normalise_date(value):
+
+    '''
+    (Python)
+
+    A collection date as YYYY-MM-DD, accepting the formats labs send (ISO with or
+    without a time, m/d/Y, Excel serial numbers).  Unparseable values are returned
+    normalised but otherwise unchanged.
+    '''
+
+    text = normalise_value(value)
+    if not text:
+        return ''
+
+    # Excel serial day numbers ('44409')
+    if text.isdigit() and len(text) == 5:
+        return (datetime.date(1899, 12, 30) + datetime.timedelta(days=int(text))).isoformat()
+
+    candidate = text.split('T')[0].split(' ')[0]
+    for date_format in DATE_FORMATS:
+        try:
+            return datetime.datetime.strptime(candidate, date_format).date().isoformat()
+        except ValueError:
+            continue
+
+    return text
+
+
+def key_columns(columns):
+
+    '''
+    (Python)
+
+    Positions of the identifying columns of a file: (sequence id, lab accession,
+    collection date), each None if the file has no such column.
+    '''
+
+    upper = [c.upper() for c in columns]
+
+    sequence_id = next((columns.index(name) for name in SEQUENCE_ID_NAMES if name in columns), None)
+
+    accession = next((i for i, name in enumerate(columns)
+                      if ACCESSION_PATTERN.search(upper[i]) and name not in ACCESSION_EXCLUDED and i != sequence_id), None)
+
+    collection_date = next((upper.index(name) for name in COLLECTION_DATE_NAMES if name in upper), None)
+    if collection_date is None:
+        collection_date = next((i for i, name in enumerate(upper) if 'COLLECT' in name and 'DATE' in name), None)
+
+    return sequence_id, accession, collection_date
+
+
+class RowFingerprinter:
+
+    '''
+    (Python)
+
+    Fingerprints the rows of one file.  Keyed on (sequence id, lab accession, collection
+    date) when the file has a sequence id or accession column, else on the whole row.
+
+    --------------------------------------------------------------------------------------
+
+    Example:
+    fingerprinter = RowFingerprinter(columns)
+    for cells in rows:
+        fingerprinter.add(cells)
+    fingerprinter.fingerprints   # list of 16-byte digests
+    '''
+
+    def __init__(self, columns):
+        self.positions = key_columns(columns)
+        self.keyed = self.positions[0] is not None or self.positions[1] is not None
+        self.key = '+'.join(name for name, p in zip(('sequence_id', 'accession', 'collection_date'), self.positions)
+                            if p is not None) if self.keyed else 'row'
+        self.fingerprints = []
+        self.unkeyed_rows = 0
+
+    def add(self, cells):
+        '''Fingerprints one row (a list of cell texts).  Rows with all identifiers blank are counted, not indexed.'''
+
+        if self.keyed:
+            sequence_id, accession, collection_date = (cells[p] if p is not None and p < len(cells) else None
+                                                       for p in self.positions)
+            parts = (normalise_value(sequence_id), normalise_value(accession), normalise_date(collection_date))
+            if not parts[0] and not parts[1]:
+                self.unkeyed_rows += 1
+                return
+            text = 'K|' + '|'.join(parts)
+        else:
+            text = 'R|' + '|'.join(normalise_value(c) for c in cells)
+
+        self.fingerprints.append(hashlib.blake2b(text.encode('utf-8'), digest_size=16).digest())
+
+###############################################################################################################
+###############################################################################################################
+
+####################################################################################
+# Bloom filter
+####################################################################################
+
+class BloomFilter:
+
+    '''
+    (Python)
+
+    Fixed-size Bloom filter over 16-byte fingerprints.  The bit positions are slices of
+    the fingerprint itself (double hashing), so no extra hashing is done.
+    '''
+
+    def __init__(self, num_bits, num_hashes=BLOOM_HASHES, bits=None):
+        self.num_bits = num_bits
+        self.num_hashes = num_hashes
+        self.bits = bits if bits is not None else bytearray((num_bits + 7) // 8)
+
+    def _positions(self, fingerprint):
+        h1 = int.from_bytes(fingerprint[:8], 'little')
+        h2 = int.from_bytes(fingerprint[8:16], 'little') | 1
+        return ((h1 + i * h2) % self.num_bits for i in range(self.num_hashes))
+
+    def add(self, fingerprint):
+        for position in self._positions(fingerprint):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, fingerprint):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(fingerprint))
+
+###############################################################################################################
+###############################################################################################################
+
+####################################################################################
+# The index
+####################################################################################
+
+class DuplicateIndex:
+
+    '''
+    (Python)
+
+    Persistent fingerprint index: SQLite for the facts, a saved Bloom filter in front.
+
+    --------------------------------------------------------------------------------------
+
+    Keyword arguments:
+    path -- SQLite database.  The Bloom filter is saved as path + '.bloom'.
+
+    --------------------------------------------------------------------------------------
+
+    Example:
+    index = DuplicateIndex('//Sequence Data and Reporting/Data_Objects/SFT/sft_row_index.sqlite')
+    counts, pending = index.check(fingerprinter.fingerprints, 'LAB_A/metadata.csv', unkeyed_rows=0, key='sequence_id')
+    index.add(pending, 'LAB_A/metadata.csv')    # once the file is confirmed
+    index.close()
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.bloom_path = path + '.bloom'
+        self._lock = threading.Lock()
+
+        # Fingerprints of files checked this run but not confirmed yet: {fingerprint: source}
+        self._unconfirmed = {}
+
+        # Rollback journal rather than WAL: the database may live on a network share
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute('''CREATE TABLE IF NOT EXISTS fingerprints (
+                                       fingerprint BLOB PRIMARY KEY,
+                                       first_source TEXT NOT NULL,
+                                       first_seen TEXT NOT NULL,
+                                       times_seen INTEGER NOT NULL) WITHOUT ROWID''')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+        self.connection.commit()
+
+        self.keys = self.connection.execute('SELECT COUNT(*) FROM fingerprints').fetchone()[0]
+        self.bloom = self._load_bloom()
+
+    # ---- Bloom filter persistence ----
+
+    def _load_bloom(self):
+
+        saved_keys = self.connection.execute("SELECT value FROM meta WHERE key = 'bloom_keys'").fetchone()
+        num_bits = max(self.keys, BLOOM_MIN_KEYS) * BLOOM_BITS_PER_KEY
+
+        # The saved filter is used if it covers exactly the keys in the database and is big enough
+        if saved_keys is not None and int(saved_keys[0]) == self.keys and os.path.exists(self.bloom_path):
+            with open(self.bloom_path, 'rb') as f:
+                bits = bytearray(f.read())
+            if len(bits) * 8 >= num_bits // 2:
+                return BloomFilter(len(bits) * 8, bits=bits)
+
+        # Rebuild (first use, crash, or the index outgrew the filter): one pass over the keys
+        bloom = BloomFilter(num_bits * 2)
+        for (fingerprint,) in self.connection.execute('SELECT fingerprint FROM fingerprints'):
+            bloom.add(fingerprint)
+
+        return bloom
+
+    def _save_bloom(self):
+
+        temp_path = self.bloom_path + '.tmp'
+        with open(temp_path, 'wb') as f:
+            f.write(self.bloom.bits)
+        os.replace(temp_path, self.bloom_path)
+
+        self.connection.execute("INSERT OR REPLACE INTO meta VALUES ('bloom_keys', ?)", (str(self.keys),))
+        self.connection.commit()
+
+    # ---- checking files ----
+
+    def check(self, fingerprints, source, unkeyed_rows=0, key=None, top_sources=5):
+
+        '''
+        (Python)
+
+        Counts a file's rows already in the index, in a file checked earlier this run, or
+        repeated within the file.  Nothing is written: pass the returned pending rows to
+        add() once the file is confirmed.
+
+        --------------------------------------------------------------------------------------
+
+        Keyword arguments:
+        fingerprints -- the file's row fingerprints (RowFingerprinter.fingerprints)
+        source -- name of the file (e.g. the placed path), listed for later duplicates
+        unkeyed_rows -- rows that had no identifiers (reported, not indexed)
+        key -- what the fingerprints were built from (RowFingerprinter.key)
+        top_sources -- how many earlier files to list
+
+        --------------------------------------------------------------------------------------
+
+        Returns:
+        (counts, pending) -- counts is a dict with key, rows, duplicate_rows (seen in earlier
+        files), within_file (repeats inside this file), unkeyed_rows and earlier_sources
+        {file: rows}; pending is what add() needs
+        '''
+
+        seen_here = set()
+        within_file = 0
+        candidates = []
+        new = []
+
+        for fingerprint in fingerprints:
+            if fingerprint in seen_here:
+                within_file += 1
+                continue
+            seen_here.add(fingerprint)
+            (candidates if fingerprint in self.bloom else new).append(fingerprint)
+
+        with self._lock:
+            earlier = {}
+            repeated = []
+            for start in range(0, len(candidates), 500):
+                chunk = candidates[start:start + 500]
+                rows = self.connection.execute(
+                    'SELECT fingerprint, first_source FROM fingerprints WHERE fingerprint IN ({})'.format(','.join('?' * len(chunk))),
+                    chunk).fetchall()
+                found = {fingerprint: first_source for fingerprint, first_source in rows}
+                for fingerprint in chunk:
+                    if fingerprint in found:
+                        repeated.append(fingerprint)
+                        earlier[found[fingerprint]] = earlier.get(found[fingerprint], 0) + 1
+                    else:
+                        new.append(fingerprint)   # Bloom false positive
+
+            # Rows of files checked earlier in this run (not in the index until confirmed)
+            if self._unconfirmed:
+                unseen = []
+                for fingerprint in new:
+                    if fingerprint in self._unconfirmed:
+                        repeated.append(fingerprint)
+                        earlier[self._unconfirmed[fingerprint]] = earlier.get(self._unconfirmed[fingerprint], 0) + 1
+                    else:
+                        unseen.append(fingerprint)
+                new = unseen
+
+            for fingerprint in new:
+                self._unconfirmed[fingerprint] = source
+
+        counts = {'key': key, 'rows': len(fingerprints) + unkeyed_rows, 'duplicate_rows': len(repeated),
+                  'within_file': within_file, 'unkeyed_rows': unkeyed_rows,
+                  'earlier_sources': dict(sorted(earlier.items(), key=lambda kv: -kv[1])[:top_sources])}
+
+        return counts, (new, repeated)
+
+    def add(self, pending, source):
+        '''Adds a confirmed file's rows (check() output) to the index: new rows inserted, repeats counted.'''
+
+        new, repeated = pending
+        now = datetime.datetime.now().isoformat(timespec='seconds')
+
+        with self._lock:
+            # A repeat of a row from a file of this run that was never confirmed isn't in the
+            # database yet: it is inserted with this file as its source
+            self.connection.executemany('UPDATE fingerprints SET times_seen = times_seen + 1 WHERE fingerprint = ?',
+                                        ((f,) for f in repeated))
+            inserted = self.connection.executemany('INSERT OR IGNORE INTO fingerprints VALUES (?, ?, ?, 1)',
+                                                   ((f, source, now) for f in new + repeated)).rowcount
+            self.connection.commit()
+
+            for fingerprint in new + repeated:
+                self.bloom.add(fingerprint)
+            self.keys += max(inserted, 0)
+
+    def check_and_add(self, fingerprints, source, unkeyed_rows=0, key=None, top_sources=5):
+        '''check() then add() at once, for files that need no confirmation.  Returns the counts.'''
+
+        counts, pending = self.check(fingerprints, source, unkeyed_rows, key, top_sources)
+        self.add(pending, source)
+
+        return counts
+
+    def close(self):
+        '''Saves the Bloom filter and closes the database.'''
+
+        with self._lock:
+            self._save_bloom()
+            self.connection.close()
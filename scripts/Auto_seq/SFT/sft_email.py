@@ -9,157 +9,141 @@ Created on Mon Sep 13 15:49:08 2021
 # Load all libraries
 ###############################################################################################################
 
-from selenium import webdriver
-from selenium.webdriver.common.by import By
-from selenium.webdriver.common.keys import Keys
-from selenium.webdriver import ActionChains
-
-import time
-import os
-import shutil
-import numpy as np
-import pandas as pd
-import regex as re
+# Only what the report needs: no selenium or pandas, so this starts quickly
 import datetime
 import pickle
-import keyring
-import smtplib
-from email.message import EmailMessage
-from email.mime.text import MIMEText
 
-# Import customized functions .py file from the working directory we navigated to
-from sft_functions import *
+from sft_notify import notifier_from_config
+from sft_settings import get_settings
+from sft_report import build_daily_report, update_known_submitters
 
 ###############################################################################################################
-# Navigate to the proper working directory
-#### For easy user-interacting, this part allows a user to run the script from any location...
-#### .... AS LONG AS the sft_objects.p file exists in the same directory/folder as this file.
+# Build and send the daily report
 ###############################################################################################################
 
-# Define sequencing filepath location
-sequencing_path = keyring.get_password('sequencing', 'fpath')
+def run_report(report_date=None, since=None, send=True, settings=None):
 
-# Reload pre-defined objects for this script.  Mostly xpaths.
-objects = pickle.load( open( f'{sequencing_path}/Data_Objects/SFT/sft_objects.p', "rb" ) )
+    '''
+    (Python)
 
-###############################################################################################################
-# Define all variables of interest to be used later on
-###############################################################################################################
+    Builds the daily SFT pull report and emails it.
 
-# Define todays date
-todays_date_formatted = str(datetime.datetime.now().date())
-todays_date_unformatted = todays_date_formatted.replace('-','')
+    --------------------------------------------------------------------------------------
 
-# Define path to log file
-path_to_log = f'{sequencing_path}/Submissions/sft_automated_pull_log.csv'
+    Keyword arguments:
+    report_date -- datetime.date to report on.  Defaults to today.
+    since -- optional datetime.date.  Report every day from since up to report_date.
+    send -- False renders the report and returns it without emailing (and without
+            requiring today's pull to have completed)
+    settings -- sft_settings.Settings.  Defaults to the process-wide settings.
 
-###############################################################################################################
-#  Basic error handling to make sure that the main script ran successfully
-###############################################################################################################
+    --------------------------------------------------------------------------------------
 
-# If the script didn't run correctly, this will error out
-if (objects['last_completed_date'] == todays_date_formatted):
-    print('Main script ran succesfully.  Proceeding as normal.')
-    
-else:
-    raise ValueError('Morning did not run successfully')
+    Returns:
+    the rendered report dict ('html', 'text', 'json')
+    '''
 
-###############################################################################################################
-# Read in / analyze today's log file for new downloads
-###############################################################################################################
+    ####################################################################################
+    # Navigate to the proper working directory
+    #### For easy user-interacting, this part allows a user to run the script from any location...
+    #### .... AS LONG AS the sft_objects.p file exists in the same directory/folder as this file.
+    ####################################################################################
 
-# Read in the logfile
-logfile = pd.read_csv(path_to_log)
-
-# Query our dataframe to see what we downloaded today.  
-### NOTE: Used copy() to avoid warning.  Not essential, but cleans up output.
-todays_downloads = logfile.copy().query('Date == {0}'.format(todays_date_unformatted))
-
-# Count anything we downloaded
-files_downloaded = len(todays_downloads)
-
-
-if files_downloaded > 0:
-    
-    # Redefine the Logfile's column to be more digestible
-    todays_downloads['Folder'] = todays_downloads['DestinationName']
-    
-    # Similarly redefine Logfile column "FileName" to be simpler
-    todays_downloads['File'] = todays_downloads['FileName']
-    
-    # Parse out the time that it was downloaded
-    todays_downloads['TimeOfDownload'] = todays_downloads['ArchiveFileName'].str[9:13]
-    todays_downloads['TimeOfDownload'] = todays_downloads['TimeOfDownload'].str[:2] + ':' +  todays_downloads['TimeOfDownload'].str[-2:]
-    
-    # order our output
-    todays_downloads.sort_values('Folder',inplace=True)
-    
-    # Select columns we want to use and set the date as the index
-    todays_downloads = todays_downloads[['Date','Folder','File','TimeOfDownload']]
-    todays_downloads.reset_index(drop=True, inplace=True)
-    
-    # Convert to html for email.
-    html_table_foremail = todays_downloads.to_html(classes='table table-striped')
-    
-    
-###############################################################################################################
-# Look for new lab submitters
-###############################################################################################################
+    # Paths (and SMTP credentials), resolved once per process
+    if settings is None:
+        settings = get_settings()
+
+    # Reload pre-defined objects for this script.  Mostly xpaths.
+    objects = pickle.load( open( settings.objects_path, "rb" ) )
+
+    ####################################################################################
+    # Define all variables of interest to be used later on
+    ####################################################################################
+
+    # Define todays date
+    if report_date is None:
+        report_date = datetime.datetime.now().date()
+
+    # Define path to log file
+    path_to_log = settings.pull_log_path
+
+    ####################################################################################
+    #  Basic error handling to make sure that the main script ran successfully
+    ####################################################################################
+
+    # If the script didn't run correctly, this will error out.  Only checked when actually sending.
+    if send:
+        if (objects['last_completed_date'] == str(report_date)):
+            print('Main script ran succesfully.  Proceeding as normal.')
+
+        else:
+            raise ValueError('Morning did not run successfully')
 
-# Find out what was downloaded today vs. what was downloaded before    
-todays_downloads = logfile.copy().query('Date == {0}'.format(todays_date_unformatted))
-previous_downloads = logfile.copy().query('Date < {0}'.format(todays_date_unformatted))
+    ####################################################################################
+    # Build the report from the run manifest (falls back to the log file for older days)
+    ####################################################################################
 
-# Using set differences, find out any first-submission-drops based on our log file.
-new_submitters = list( set(todays_downloads['DestinationName'].tolist()) - set(previous_downloads['DestinationName'].tolist()))
+    # Where the run manifest lives
+    manifest_directory = objects.get('manifest_directory', '//Sequence Data and Reporting/Submissions/manifest/')
 
-# Initialize empty list, will go into email as empty if no new submission folders located.
-html_new_submitters = ''
+    # Summarise the pulls per submitter and render the HTML / text / JSON versions in one pass
+    report, records = build_daily_report(manifest_directory, report_date, path_to_log, since=since)
 
-# Looping through each new submitter, format the correct header2 to potentially use in the email.
-for i in np.arange(0,len(new_submitters)):
-    html_new_submitters += '<h2 style="text-align: left;"><span style="color: #DE3163;">Please review first submission:  {}</span></h2>'.format(new_submitters[i])
+    if not send:
+        return report
+
+    ####################################################################################
+    # Send email
+    ####################################################################################
+
+    # Define subject and recipients
+    email_subject = 'Sequencing SFT Pull: Daily Report Automated Email'
+    email_recipients = objects['email_recipient_list']
+
+    # SEND THE EMAIL!!!  Transport (SMTP, maildir, file or Outlook) comes from the objects file.
+    # Not de-duplicated: a report that was asked for is always sent.
+    notifier = notifier_from_config(settings.notify_config(objects))
+    notifier.notify(email_subject, email_recipients, report['html'], report['text'], dedup=False)
+    if notifier.close():
+        raise RuntimeError('Daily report email was not sent (see the errors above)')
+
+    # Only a sent report uses up the "first submission" banner
+    update_known_submitters(manifest_directory, records, report_date, path_to_log, since)
+
+    return report
 
 ###############################################################################################################
-# Send email.  Seperated if-statement for clarity purposes
+# Command line (also `sft report`)
 ###############################################################################################################
 
-# Define subject and recipients
-email_subject = 'Sequencing SFT Pull: Daily Report Automated Email'
-email_recipients = objects['email_recipient_list']
-
-# Define the email body.  Old header color - #3366ff
-##########################
-
-if files_downloaded > 0:
-    
-    email_body = '''
-    <h1 style="text-align: left;"><span style="color: #6495ED;">SFT Pull Report: {date_today}</span></h1>
-    {header2}
-    <p>Hello,</p>
-    <p>See the table below for all files pulled from the SFT today.  Times are represented in a 24-hour format.</p>
-    {table}
-    <p>Have a great day!</p>
-    <p>-DIQA Epis</p>
-     '''.format(header2 = html_new_submitters, date_today=todays_date_formatted , table=html_table_foremail)
-     
-else:            
-    email_body = '''
-    <h1 style="text-align: center;"><span style="color: #3366ff;">SFT Pull Report: {date_today}</span></h1>
-    <p>Hello,</p>
-    <p>There were no files found in the SFT today.</p>
-    <p>Have a great day!</p>
-    <p>-DIQA Epis</p>
-     '''.format(date_today=todays_date_formatted)
-        
-# SEND THE EMAIL!!!
-
-msg = MIMEText(email_body, 'html')
-msg['Subject'] = email_subject
-msg['From'] = ''
-msg['To'] = ", ".join(email_recipients)
-
-# Send the message via our own SMTP server.
-s = smtplib.SMTP('')
-s.send_message(msg)
-s.quit()
+def main(argv=None):
+
+    '''
+    (Python)
+
+    Command line for the daily report.  Returns the process exit code.
+    '''
+
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Build and email the daily SFT pull report.')
+    parser.add_argument('--date', type=datetime.date.fromisoformat, default=None,
+                        help='day to report on (YYYY-MM-DD).  Default: today')
+    parser.add_argument('--since', type=datetime.date.fromisoformat, default=None,
+                        help='report on every day from this date through --date')
+    parser.add_argument('--dry-run', action='store_true', help='print the report instead of emailing it')
+    parser.add_argument('--format', choices=('text', 'html', 'json'), default='text',
+                        help='what --dry-run prints')
+    args = parser.parse_args(argv)
+
+    report = run_report(report_date=args.date, since=args.since, send=not args.dry_run)
+
+    if args.dry_run:
+        print(report[args.format])
+
+    return 0
+
+
+if __name__ == '__main__':
+    import sys
+    sys.exit(main())
@@ -7,25 +7,23 @@ Created on Tue Aug 31 17:58:35 2021
 ###############################################################################################################
 ###############################################################################################################
 
-# For selenium, a web-navigation tool
-from selenium import webdriver
-from selenium.webdriver.common.by import By
-from selenium.webdriver.common.keys import Keys
-from selenium.webdriver import ActionChains
-
-# Generic packages
+# Generic packages.  Selenium is imported inside the functions that use it,
+# so the report / config commands can import this module without it.
 import time
 import os
-import shutil
-import numpy as np
-import pandas as pd
-import regex as re
+import csv
 import datetime
 import pickle
-import keyring
+from typing import NamedTuple
+
+# Chunked, resumable, rate-limited writes to the share
+from sft_governor import get_governor
+
+# Paths and credentials, resolved once per process
+from sft_settings import get_settings
 
 # Packages related to email sending
-import win32com.client as win32
+from sft_notify import notifier_from_config
 
 ###############################################################################################################
 ###############################################################################################################
@@ -34,7 +32,13 @@ import win32com.client as win32
 # Deleting File/Folder
 ####################################################################################
 
-def delete_element_by_id(driver,element_id):
+def _pause(seconds, pace):
+    '''Sleeps seconds x pace (the adaptive speed-up, see sft_governor.AIMDController).  Returns the time slept.'''
+
+    time.sleep(seconds * pace)
+    return seconds * pace
+
+def delete_element_by_id(driver,element_id,pace=1.0):
     
     '''
     (Python)
@@ -49,12 +53,15 @@ def delete_element_by_id(driver,element_id):
     Keyword arguments:
     driver -- selenium webdriver 
     element_id -- the web element id.  Found in html structure.
+    pace -- multiplier for the waits between clicks (1.0: the original waits)
 
     --------------------------------------------------------------------------------------
     
     Example:
     html_element_id = 'somefile' # typically found using CTRL+SHIFT+C (web inspection mode) and manually finding ID
     delete_element_by_id(html_element_id)
+
+    Returns the seconds spent in the page itself (not counting the waits).
     
     --------------------------------------------------------------------------------------
 
@@ -64,28 +71,35 @@ def delete_element_by_id(driver,element_id):
     from selenium.webdriver import ActionChains
     '''
 
+    from selenium.webdriver import ActionChains
+
+    started = time.monotonic()
+    slept = 0.0
+
     # Find the proper web element
     element = driver.find_element_by_id(element_id)
-    time.sleep(1)
+    slept += _pause(1, pace)
     
     # Allow for right-clicking
     action = ActionChains(driver)
     
     # Click on file in question
     action.context_click(element).perform()
-    time.sleep(1)
+    slept += _pause(1, pace)
     
     # Delete file
     rightclick_delete = driver.find_element_by_id('allFiles_context::delete')
     rightclick_delete.click()
-    time.sleep(1)
+    slept += _pause(1, pace)
 
     # Confirm deletion
     confirm_delete = driver.find_element_by_id('delete_actions::delete')
     confirm_delete.click()
-    time.sleep(1)
+    slept += _pause(1, pace)
     
     print('Deletion Complete:  {}'.format(str(element_id)))
+
+    return time.monotonic() - started - slept
        
 ###############################################################################################################
 ###############################################################################################################
@@ -94,7 +108,7 @@ def delete_element_by_id(driver,element_id):
 # Downloading File
 ####################################################################################
 
-def download_element_by_id(driver,element_id):
+def download_element_by_id(driver,element_id,pace=1.0):
     
     '''
     (Python)
@@ -109,12 +123,15 @@ def download_element_by_id(driver,element_id):
     Keyword arguments:
     driver -- selenium webdriver 
     element_id -- the web element id.  Found in html structure.
+    pace -- multiplier for the waits between clicks (1.0: the original waits)
 
     --------------------------------------------------------------------------------------
     
     Example:
     html_element_id = 'somefile' # typically found using CTRL+SHIFT+C (web inspection mode) and manually finding ID
     download_element_by_id(html_element_id)
+
+    Returns the seconds spent in the page itself (not counting the waits).
     
     --------------------------------------------------------------------------------------
 
@@ -125,229 +142,183 @@ def download_element_by_id(driver,element_id):
     
     # RELIES ON the webdriver defined under the variable "driver"
     '''
+    from selenium.webdriver import ActionChains
+
+    started = time.monotonic()
+    slept = 0.0
+
     # Find the proper web element.  First sleep allowing files to finish rendering on page. 
-    time.sleep(5)
+    slept += _pause(5, pace)
     element = driver.find_element_by_id(element_id)
-    time.sleep(3)
+    slept += _pause(3, pace)
     
     # Allow for right-clicking
     action = ActionChains(driver)
     
     # Click on file in question
     action.context_click(element).perform()
-    time.sleep(1)
+    slept += _pause(1, pace)
     
     # Delete file
     rightclick_download = driver.find_element_by_id('allFiles_context::download')
     rightclick_download.click()
-    time.sleep(5)
+    slept += _pause(5, pace)
     
     print('Download Initiated:  {}'.format(str(element_id)))   
-    
-###############################################################################################################
-###############################################################################################################
 
-####################################################################################
-# Waiting for download
-####################################################################################
+    return time.monotonic() - started - slept
+    
 
-def wait_for_download(filename, download_directory):
+def download_elements_as_archive(driver,element_ids,pace=1.0):
 
     '''
     (Python)
 
-    Waits for a file to be downloaded
+    SPECIFIC TO SFT WEBSITE.  MAY NEED ADJUSTMENT IF SITE CHANGES STRUCTURE
 
-    --------------------------------------------------------------------------------------
-    Keyword arguments:
-    filename -- Name of the file that was downloaded
-    download_directory -- Full path to wherever things get downloaded to
+    Selects several files of the open folder (ctrl+click) and downloads them in one
+    request from the right-click menu.  Depending on the server this arrives as one zip
+    or as the individual files; see sft_main.bulk_download().
 
     --------------------------------------------------------------------------------------
 
-    Example:
-    file = 'monkey_picture.png'
-    dir_downloads = 'C:/Users/Downloads/'
+    Keyword arguments:
+    driver -- selenium webdriver
+    element_ids -- web element ids (file names) of the files to download
+    pace -- multiplier for the waits between clicks (1.0: the original waits)
 
-    wait_for_download( file, dir_downloads )
     --------------------------------------------------------------------------------------
 
-    Dependencies:
-    import os
-    import time
+    Returns the seconds spent in the page itself (not counting the waits).
     '''
 
-    # Convert filename to full file path with forward slashes.
-    full_downloads_path_forwardslash = download_directory + filename
-    
-    # Convert filename to full file path with last location specified as "...folder\file.extension"
-    full_downloads_path_backslash = download_directory[:-1] + '\\' + filename
-    
-    # Initialize conditions before while loop
-    conditions_met = 0
-    iteration = 1
-    
-    # Initiate while loop.  Waits for:
-    #### 1.  the file to be finished downloading -> both full file paths recognized via os.path.exists() function
-    #### OR
-    #### 2.  timeout occurs -> operation runs for 5 mins (300 seconds) without any action. 
-    
-    while (conditions_met != 2) & (iteration < 300):
-        
-        # Check to see if paths exist.  Returns boolean TRUE or FALSE
-        cond1 = os.path.exists(full_downloads_path_forwardslash)
-        cond2 = os.path.exists(full_downloads_path_backslash)
-        
-        # See how many conditions were met. (adding booleans produces INT value)
-        conditions_met = cond1 + cond2
-        
-        # Update iteration count
-        iteration += 1
-        
-        # Rest
-        time.sleep(1)
-        
-    # If timeout occured, you will see an iteration of 300 or greater.  Return output.
-    if iteration > 299:
-        raise TimeoutError('File never downloaded.  Timed out after 5 mins')
-        
-    # Otherwise print message indicating completion.    
-    else:
-        print('Action Complete:  {}'.format(str(filename)))
-            
+    from selenium.webdriver import ActionChains
+    from selenium.webdriver.common.keys import Keys
+
+    started = time.monotonic()
+    slept = _pause(5, pace)
+
+    # Select every file, holding ctrl
+    action = ActionChains(driver).key_down(Keys.CONTROL)
+    for element_id in element_ids:
+        action = action.click(driver.find_element_by_id(element_id))
+    action.key_up(Keys.CONTROL).perform()
+    slept += _pause(1, pace)
+
+    # Right-click the selection and download it
+    ActionChains(driver).context_click(driver.find_element_by_id(element_ids[-1])).perform()
+    slept += _pause(1, pace)
+
+    driver.find_element_by_id('allFiles_context::download').click()
+    slept += _pause(5, pace)
+
+    print('Bulk Download Initiated:  {} file(s)'.format(len(element_ids)))
+
+    return time.monotonic() - started - slept
+
 ###############################################################################################################
 ###############################################################################################################
 
 ####################################################################################
-# Moving a file
+# Names files get at their destination (shared with the dry-run planner)
 ####################################################################################
 
-def move_file(filename, source_directory, destination_directory):
+def collision_free_name(filename, destination_directory, taken=()):
 
     '''
     (Python)
 
-    Moves a file from one place to another, making sure that 
+    Name a file will be saved under in destination_directory.  If the name already
+    exists, follows windows formatting for adding a version to the name:
+    file.txt -> file (1).txt -> file (2).txt ...
 
     --------------------------------------------------------------------------------------
+
     Keyword arguments:
-    filename -- Name of the file that was downloaded
-    source_directory -- Full path to source.  Ends in /
-    destination_directory -- Full path to where you want the file to go.  End with /
+    filename -- Name of the file
+    destination_directory -- Full path to where the file will go.  Ends in /
+    taken -- extra names to treat as existing (e.g. files planned but not yet moved)
 
     --------------------------------------------------------------------------------------
 
-    Example:
-    file = 'monkey_picture.png'
-    dir_downloads = 'C:/Users/Downloads/'
-    dir_dest = 'C:/Some/Location/on/Yourdrive/'
+    Returns:
+    (name, copy number or None if the name was free)
+    '''
+
+    stem, dot, extension = str(filename).rpartition('.')
+    if not dot:
+        stem, extension = str(filename), ''
+
+    new_filename = filename
+    copy_num = 0
+
+    while new_filename in taken or os.path.exists(destination_directory + new_filename):
+        copy_num += 1
+        new_filename = '{} ({}){}{}'.format(stem, copy_num, dot, extension)
+
+    return new_filename, (copy_num or None)
+
+
+def archive_filename(filename, today_date, now=None):
+
+    '''
+    (Python)
+
+    Archive copy name: the file name prefixed with the date and time, '%Y%m%d_%H%M%S_<file>'.
 
-    move_file( file, dir_downloads, dir_dest )
     --------------------------------------------------------------------------------------
 
-    Dependencies:
-    import shutil
-    import 
-    import time
+    Keyword arguments:
+    filename -- Name of the file
+    today_date -- todays date as string (YYYYMMDD)
+    now -- datetime for the time part.  Defaults to now.
     '''
 
-    # Specify full path of the source
-    full_source_path = source_directory + filename
+    current_time = (now or datetime.datetime.now()).strftime('%H%M%S')
 
-    # Specify full path of the destination
-    full_destination_path = destination_directory + filename
-    
-    # Initialize copy #
-    copy_num = 1
-    
-    # If the file already exists, follow windows formatting for adding version extension to name
-    #### ex: file (1).txt or file (2).txt
-    while os.path.exists(full_destination_path):
-        
-        version_extension = ' ({})'.format(str(copy_num))
-        filename_split = str(filename).split('.')
-        new_filename = str(''.join(filename_split[:-1])) + version_extension + str(filename_split[-1])
-        full_destination_path = destination_directory + new_filename
-        copy_num += 1
-        time.sleep(2)
+    return today_date + '_' + current_time + '_' + filename
 
-        
-    # Move the file
-    shutil.move( full_source_path , full_destination_path)
-    
-    # Print output
-    print('Moved File:  {}'.format(str(filename)))
-    
 ###############################################################################################################
 ###############################################################################################################
 
 ####################################################################################
-# Copying a file to archive with unique name
+# Log the action
 ####################################################################################
 
-def copy_file_to_archive(filename, source_directory, destination_directory, today_date):
+class LogRecord(NamedTuple):
+    '''One row of sft_automated_pull_log.csv, in column order.'''
 
-    '''
-    (Python)
+    date: str
+    filename: str
+    folder_dest: str
+    path_dest: str
+    archive_filename: str
+    archive_full_filepath: str
 
-    Copies file to an archive with datetime prefix for emergency backup purposes
 
-    --------------------------------------------------------------------------------------
-    
-    Keyword arguments:
-    filename -- Name of the file that was downloaded
-    source_directory -- Full path to source.  Ends in /
-    destination_directory -- Full path to where you want the file to go.  End with /
-    today_date -- todays date as string
+# Header written if the log file doesn't exist yet
+LOG_COLUMNS = ('Date', 'FileName', 'DestinationName', 'DestinationPath', 'ArchiveFileName', 'ArchiveFilePath')
 
-    --------------------------------------------------------------------------------------
 
-    Example:
-    file = 'monkey_picture.png'
-    dir_downloads = 'C:/Users/Downloads/'
-    dir_dest = 'C:/Some/Location/on/Yourdrive/'
+def append_log_records(path_to_log, records):
 
-    copy_file_to_archive( file, dir_downloads, dir_dest, '20210830' )
-    --------------------------------------------------------------------------------------
+    '''
+    (Python)
 
-    Dependencies:
-    import pandas as pd
-    import numpy as np
-    import os
-    import shutil
-    import time
+    Appends LogRecords to the pull log in one buffered write, so the cost doesn't grow
+    with the size of the log.  Writes the header first if the log is new.
     '''
 
-    # Get full path of the source dir
-    full_source_path = source_directory + filename
+    write_header = not os.path.exists(path_to_log) or os.path.getsize(path_to_log) == 0
 
-    # Eventually file with get saved with prefix "%Y%m%d_%h%m_"
-    current_time = str(datetime.datetime.now().time()).replace(':','')[:6]
-    current_date = today_date
-    current_datetime = current_date + '_' + current_time + '_'
-    
-    # Specify the full destination output with prefix
-    full_destination_path = destination_directory + current_datetime + filename
-    
-    # Specify archive file name
-    output_file = current_datetime + filename
-    
-    # Copy the file!
-    shutil.copyfile( full_source_path , full_destination_path)
-    
-    # print output
-    print('Copy File to Archive:  {}'.format(str(output_file)))
-    
-    return output_file
-    
-###############################################################################################################
-###############################################################################################################
+    with open(path_to_log, 'a', newline='') as f:
+        writer = csv.writer(f)
+        if write_header:
+            writer.writerow(LOG_COLUMNS)
+        writer.writerows(records)
 
-####################################################################################
-# Log the action
-####################################################################################
 
-def log_action( date, filename, folder_dest, path_dest, archive_filename, archive_full_filepath):
+def log_action( date, filename, folder_dest, path_dest, archive_filename, archive_full_filepath, settings=None, governor=None):
     
     '''
     (Python)
@@ -363,6 +334,8 @@ def log_action( date, filename, folder_dest, path_dest, archive_filename, archiv
     path_dest -- full path that the file was sent to
     archive_filename -- file name saved to the archive location with timestamp prefix
     archive_full_filepath -- full path that the file was saved to 
+    settings -- sft_settings.Settings.  Defaults to the process-wide settings (resolved once).
+    governor -- sft_governor.IOGovernor for share writes.  Defaults to the process-wide one.
 
     --------------------------------------------------------------------------------------
 
@@ -378,43 +351,26 @@ def log_action( date, filename, folder_dest, path_dest, archive_filename, archiv
     --------------------------------------------------------------------------------------
 
     Dependencies:
-    import pandas as pd
-    import pickle
+    import csv
     '''
-    
-    # Define sequencing filepath location
-    sequencing_path = keyring.get_password('sequencing', 'fpath')    
-    
-    # Read in the .csv log file
-    df = pd.read_csv( f'{sequencing_path}/Submissions/sft_automated_pull_log.csv' )
-
-    # Read in the columns
-    df_columns = df.columns
-
-    # Get a list of the entries we will put into log
-    newrow = [date, filename, folder_dest, path_dest, archive_filename, archive_full_filepath]
-
-    # Convert to row-like pandas dataframe
-    pd_newrow = pd.DataFrame(newrow).transpose()
 
-    # Name the columns of the newly created dataframe using existing
-    pd_newrow.columns = df_columns
+    # Location of the log file.  Resolved once per process, not per file.
+    path_to_log = (settings or get_settings()).pull_log_path
 
-    # Append the new row to the dataframe
-    df = df.append(pd_newrow,ignore_index=True)
-    
-    # Overwrite to the newly appended log file
-    df.to_csv( f'{sequencing_path}/Submissions/sft_automated_pull_log.csv' , index=False )
+    # Append the new row.  The existing log is not read.
+    record = LogRecord(date, filename, folder_dest, path_dest, archive_filename, archive_full_filepath)
+    with (governor or get_governor()).write_small(sum(len(str(v)) + 1 for v in record), 'pull log'):
+        append_log_records(path_to_log, [record])
 
 ###############################################################################################################
 ###############################################################################################################
     
-def send_email(subject, recipients, html_content):
+def send_email(subject, recipients, html_content, notifier=None, config=None):
     
     '''
     (Python)
 
-    Sends an email using outlook
+    Sends an email through the SFT notifier (SMTP, maildir, file or Outlook; see sft_notify)
 
     --------------------------------------------------------------------------------------
     
@@ -422,6 +378,9 @@ def send_email(subject, recipients, html_content):
     subject:  str, required. Will be displayed in subject line.
     recipients: list, required.  List of strings detailing email addresses to send email to.
     html_content:  str, required.  String of HTML content that makes up body of email.
+    notifier:  sft_notify.Notifier, optional.  Queue the email on a running notifier and return immediately.
+    config:  dict, optional.  Settings used to build a one-off notifier (see sft_notify.transport_from_config).
+             Without a notifier or config, Outlook is used on Windows and an outbox folder elsewhere.
 
     --------------------------------------------------------------------------------------
 
@@ -437,27 +396,16 @@ def send_email(subject, recipients, html_content):
     --------------------------------------------------------------------------------------
 
     Dependencies:
-    import win32com.client as win32
+    from sft_notify import notifier_from_config
     '''
     
-    # Connect to outlook
-    outlook = win32.Dispatch('outlook.application')
-    
-    # Create the item
-    mail = outlook.CreateItem(0)
-    
-    # Define the recipient(s)
-    mail.To = ';'.join(recipients)
-
-    # Define the subject
-    mail.Subject = subject
-        
-    # Define the body
-    mail.HTMLBody = html_content
-    
-    # Send email
-    mail.Send()
-    
-    # Print success
-    print('Email Successfully Sent!')
-    
\ No newline at end of file
+    # Queue on the caller's notifier.  It sends in the background.
+    if notifier is not None:
+        notifier.notify(subject, recipients, html_content)
+        return
+
+    # Otherwise send through a one-off notifier and wait for it to finish
+    notifier = notifier_from_config(config or {})
+    notifier.notify(subject, recipients, html_content)
+    if notifier.close():
+        raise RuntimeError('Email not sent:  {}'.format(subject))
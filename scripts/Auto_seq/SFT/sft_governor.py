@@ -0,0 +1,497 @@
+# -*- coding: utf-8 -*-
+"""
+I/O governor for writes to the Sequence Data and Reporting share.
+
+The pull writes every file to the share several times (archive copy, placed file, log row,
+manifest line, objects pickle) while the roster and read_all_data jobs use the same
+share.  The governor caps those writes with
+
+- a token bucket on bytes per second (shared by every write in the process),
+- a maximum number of writes in flight, handed out smallest-first so metadata (log rows,
+  pickles, small CSVs) isn't stuck behind a multi-GB FASTA bundle,
+
+and keeps queue-wait and throttle-wait statistics for the end-of-run summary.
+
+The number of writes in flight can also be tuned as the run goes (adaptive): an
+AIMDController adds a slot after each round of writes whose latency holds near its
+baseline and halves the slots on an error or a latency spike.  The same controller paces
+the pull's SFT downloads and deletes (see sft_main).
+"""
+###############################################################################################################
+###############################################################################################################
+
+import os
+import json
+import time
+import heapq
+import datetime
+import itertools
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+from sft_transfer import copy_file_chunked
+
+# Writes up to this size count as 'small' in the statistics
+SMALL_WRITE_BYTES = 1024 * 1024
+
+# Queue aging: a waiting write moves up as if it were this many bytes smaller per second waited
+DEFAULT_AGING_BYTES_PER_SECOND = 10 * 1024 * 1024
+
+###############################################################################################################
+###############################################################################################################
+
+####################################################################################
+# Token bucket
+####################################################################################
+
+class TokenBucket:
+
+    '''
+    (Python)
+
+    Thread-safe token bucket.  consume(n) blocks until n bytes' worth of tokens are
+    available; requests larger than the burst are paid for in burst-sized pieces.
+
+    --------------------------------------------------------------------------------------
+
+    Keyword arguments:
+    rate -- tokens (bytes) added per second.  None means unlimited.
+    burst -- bucket size.  Defaults to one second of rate.
+    '''
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or rate
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def consume(self, amount):
+        '''Takes amount tokens, sleeping as needed.  Returns the seconds spent waiting.'''
+
+        if not self.rate or amount <= 0:
+            return 0.0
+
+        waited = 0.0
+        while amount > 0:
+            piece = min(amount, self.burst)
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                self.tokens -= piece
+                # Negative balance = debt, paid off by sleeping outside the lock
+                delay = -self.tokens / self.rate if self.tokens < 0 else 0.0
+            if delay:
+                time.sleep(delay)
+                waited += delay
+            amount -= piece
+
+        return waited
+
+###############################################################################################################
+###############################################################################################################
+
+####################################################################################
+# AIMD concurrency controller
+####################################################################################
+
+class AIMDController:
+
+    '''
+    (Python)
+
+    Additive-increase / multiplicative-decrease limit, tuned from the latency and
+    errors of the operations it governs.
+
+    Every operation reports its latency (record(), or the operation() context manager).
+    After a round of limit operations whose latency stayed within latency_tolerance x the
+    baseline (a slow moving average of healthy latencies), the limit goes up by increase;
+    an error or a latency spike multiplies it by decrease, at most once per round so one
+    bad burst isn't punished repeatedly.  Every change is kept in decisions for metrics().
+
+    --------------------------------------------------------------------------------------
+
+    Keyword arguments:
+    name -- label for reports and metrics
+    initial, minimum, maximum -- starting limit and its bounds
+    increase -- added after a healthy round
+    decrease -- factor applied on an error or spike
+    latency_tolerance -- a latency above this multiple of the baseline is a spike
+    baseline_alpha -- weight of each new healthy latency in the baseline
+    history -- latencies and decisions kept for metrics
+
+    --------------------------------------------------------------------------------------
+
+    Example:
+    downloads = AIMDController('sft_downloads', initial=1, maximum=4)
+    with downloads.operation():
+        ...
+    downloads.value      # current limit, a whole number
+    '''
+
+    def __init__(self, name, initial=1, minimum=1, maximum=8, increase=1.0, decrease=0.5,
+                 latency_tolerance=2.0, baseline_alpha=0.1, history=200):
+        self.name = name
+        self.minimum = minimum
+        self.maximum = max(minimum, maximum)
+        self.increase = increase
+        self.decrease = decrease
+        self.latency_tolerance = latency_tolerance
+        self.baseline_alpha = baseline_alpha
+        self.limit = float(min(self.maximum, max(self.minimum, initial)))
+        self.baseline = None
+        self.latencies = deque(maxlen=history)
+        self.decisions = deque(maxlen=history)
+        self.stats = {'operations': 0, 'errors': 0, 'spikes': 0, 'increases': 0, 'decreases': 0}
+        self._round = 0
+        self._last_decrease = None
+        self._cooldown = 0
+        self._lock = threading.Lock()
+
+    @property
+    def value(self):
+        '''The limit as a whole number of operations (or speed-up steps).'''
+
+        return max(self.minimum, int(self.limit))
+
+    def _decide(self, new_limit, reason):
+        old = self.limit
+        self.limit = float(min(self.maximum, max(self.minimum, new_limit)))
+        if self.limit != old:
+            self.decisions.append({'at': datetime.datetime.now().isoformat(timespec='seconds'),
+                                   'from': round(old, 2), 'to': round(self.limit, 2), 'reason': reason})
+            self.stats['increases' if self.limit > old else 'decreases'] += 1
+        self._round = 0
+
+    def _back_off(self, reason):
+        # Once per round: the operations that were in flight under the old limit saw the same trouble
+        if self._last_decrease is None or self.stats['operations'] - self._last_decrease >= self._cooldown:
+            self._last_decrease = self.stats['operations']
+            self._cooldown = self.value
+            self._decide(self.limit * self.decrease, reason)
+
+    def record(self, seconds, ok=True):
+        '''Reports one finished operation: its latency in seconds and whether it succeeded.'''
+
+        with self._lock:
+            self.stats['operations'] += 1
+
+            if not ok:
+                self.stats['errors'] += 1
+                self._back_off('error')
+                return
+
+            self.latencies.append(seconds)
+
+            if self.baseline is None:
+                self.baseline = seconds
+            elif seconds > self.latency_tolerance * self.baseline and seconds > 0.01:
+                self.stats['spikes'] += 1
+                self._back_off('latency {:.2f}s vs baseline {:.2f}s'.format(seconds, self.baseline))
+                # A lasting slow-down still moves the baseline, slowly
+                self.baseline += self.baseline_alpha * (self.latency_tolerance * self.baseline - self.baseline)
+                return
+            else:
+                self.baseline += self.baseline_alpha * (seconds - self.baseline)
+
+            self._round += 1
+            if self._round >= self.value:
+                self._decide(self.limit + self.increase, 'steady round')
+
+    @contextmanager
+    def operation(self):
+        '''Times the block as one operation; an exception counts as an error (and is re-raised).'''
+
+        started = time.monotonic()
+        try:
+            yield self
+        except Exception:
+            self.record(time.monotonic() - started, ok=False)
+            raise
+        self.record(time.monotonic() - started)
+
+    # ---- state and metrics ----
+
+    def state(self):
+        '''What to carry to the next run: the learned limit and baseline.'''
+
+        return {'limit': self.limit, 'baseline': self.baseline}
+
+    def restore(self, state):
+        '''Starts from a state() saved by an earlier run (bounds still apply).'''
+
+        if state:
+            self.limit = float(min(self.maximum, max(self.minimum, state.get('limit', self.limit))))
+            self.baseline = state.get('baseline')
+
+    def metrics(self):
+        '''Limit, baseline, counts, latency percentiles and the recent decisions.'''
+
+        with self._lock:
+            latencies = sorted(self.latencies)
+            decisions = list(self.decisions)
+
+        def percentile(p):
+            return round(latencies[min(len(latencies) - 1, int(p / 100 * len(latencies)))], 3) if latencies else None
+
+        return dict(self.stats, name=self.name, limit=round(self.limit, 2), minimum=self.minimum, maximum=self.maximum,
+                    baseline=round(self.baseline, 3) if self.baseline is not None else None,
+                    latency_p50=percentile(50), latency_p95=percentile(95), decisions=decisions)
+
+    def report(self):
+        '''One-line summary for the end of a run.'''
+
+        m = self.metrics()
+        return ('{}:  limit {} (range {}-{}), {} ops, {} errors, {} spikes, {} up / {} down, '
+                'latency p50 {} / p95 {}').format(
+                    self.name, m['limit'], self.minimum, self.maximum, m['operations'], m['errors'], m['spikes'],
+                    m['increases'], m['decreases'], m['latency_p50'], m['latency_p95'])
+
+
+def load_controller_state(path):
+    '''Saved controller states and recent run metrics ({'controllers': {name: state}, 'runs': [...]}).'''
+
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {'controllers': {}, 'runs': []}
+
+
+def save_controller_state(path, controllers, run_id=None, keep_runs=30):
+
+    '''
+    (Python)
+
+    Saves the controllers' learned limits for the next run, plus this run's metrics
+    (the last keep_runs runs are kept), atomically.
+    '''
+
+    saved = load_controller_state(path)
+    saved['controllers'].update({c.name: c.state() for c in controllers})
+    saved['runs'] = (saved['runs'] + [{'run_id': run_id, 'finished_at': datetime.datetime.now().isoformat(timespec='seconds'),
+                                       'controllers': {c.name: c.metrics() for c in controllers}}])[-keep_runs:]
+
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w') as f:
+        json.dump(saved, f, indent=1)
+    os.replace(temp_path, path)
+
+###############################################################################################################
+###############################################################################################################
+
+####################################################################################
+# The governor
+####################################################################################
+
+class IOGovernor:
+
+    '''
+    (Python)
+
+    Limits byte rate and concurrency of share writes.  Waiting writes get a slot
+    smallest-first (ties in arrival order), aged like the pull order (see
+    sft_schedule.effective_priority): every second a write waits counts as
+    aging_bytes_per_second off its size, so a big write is never starved by a steady
+    stream of small ones.
+
+    --------------------------------------------------------------------------------------
+
+    Keyword arguments:
+    bytes_per_second -- token-bucket rate for all governed writes.  None: unlimited.
+    max_concurrent_writes -- writes allowed in flight at once (the starting point when adaptive)
+    burst_bytes -- token-bucket size (default: one second of bytes_per_second)
+    adaptive_ceiling -- if set, the writes in flight are tuned by an AIMDController
+                        between 1 and this, from each write's seconds per MB (not counting
+                        time spent waiting on the byte rate)
+    aging_bytes_per_second -- how fast a waiting write moves up the queue (0: strictly smallest-first)
+
+    --------------------------------------------------------------------------------------
+
+    Example:
+    governor = IOGovernor(bytes_per_second=20 * 1024 * 1024, max_concurrent_writes=2)
+    governor.copy_file('C:/tmp/run/bundle.fasta', '//share/ARCHIVE_copies/20210831_140102_bundle.fasta')
+    with governor.write_small(300, 'pull log'):
+        append_log_records(path_to_log, rows)
+    print(governor.report())
+    '''
+
+    def __init__(self, bytes_per_second=None, max_concurrent_writes=2, burst_bytes=None, adaptive_ceiling=None,
+                 aging_bytes_per_second=DEFAULT_AGING_BYTES_PER_SECOND):
+        self.bucket = TokenBucket(bytes_per_second, burst_bytes)
+        self.max_concurrent_writes = max(1, int(max_concurrent_writes))
+        self.aging_bytes_per_second = aging_bytes_per_second or 0
+        self.controller = None
+        if adaptive_ceiling:
+            self.controller = AIMDController('share_writes', initial=self.max_concurrent_writes, minimum=1,
+                                             maximum=max(self.max_concurrent_writes, int(adaptive_ceiling)))
+        self._condition = threading.Condition()
+        self._waiting = []
+        self._order = itertools.count()
+        self._active = 0
+        self._local = threading.local()
+        self.stats = {'writes': 0, 'bytes': 0, 'small_writes': 0,
+                      'queue_wait_seconds': 0.0, 'max_queue_wait_seconds': 0.0, 'max_queue_wait_label': None,
+                      'throttle_seconds': 0.0}
+
+    # ---- slots ----
+
+    @property
+    def slots(self):
+        '''Writes allowed in flight right now.'''
+
+        return self.controller.value if self.controller is not None else self.max_concurrent_writes
+
+    @property
+    def slot_ceiling(self):
+        '''The most writes that can ever be in flight (how many writer threads are worth having).'''
+
+        return self.controller.maximum if self.controller is not None else self.max_concurrent_writes
+
+    @contextmanager
+    def write_slot(self, size, label=''):
+
+        '''
+        Context manager holding one of the concurrent-write slots.  size (bytes) sets the
+        priority: smaller writes are let in first, less what they have waited.
+        '''
+
+        queued = time.monotonic()
+
+        # size - aging * waited orders the same as size + aging * queued (everyone ages at one rate)
+        ticket = ((size or 0) + self.aging_bytes_per_second * queued, next(self._order))
+
+        with self._condition:
+            heapq.heappush(self._waiting, ticket)
+            while self._active >= self.slots or self._waiting[0] != ticket:
+                self._condition.wait()
+            heapq.heappop(self._waiting)
+            self._active += 1
+
+            wait = time.monotonic() - queued
+            self.stats['writes'] += 1
+            self.stats['small_writes'] += (size or 0) <= SMALL_WRITE_BYTES
+            self.stats['queue_wait_seconds'] += wait
+            if wait > self.stats['max_queue_wait_seconds']:
+                self.stats['max_queue_wait_seconds'] = wait
+                self.stats['max_queue_wait_label'] = label
+
+            # The next smallest waiter may also fit
+            self._condition.notify_all()
+
+        # Byte-rate waits inside the slot are the cap working, not share latency: throttle()
+        # adds them up for this thread and they are taken off the time the controller sees
+        outer_throttled = getattr(self._local, 'throttled', None)
+        self._local.throttled = 0.0
+        started = time.monotonic()
+        ok = False
+        try:
+            yield wait
+            ok = True
+        finally:
+            throttled = self._local.throttled
+            self._local.throttled = outer_throttled if outer_throttled is None else outer_throttled + throttled
+
+            # Seconds per MB (small writes count as 1 MB), so big and small writes compare
+            if self.controller is not None:
+                self.controller.record(max(0.0, time.monotonic() - started - throttled) / max(1.0, (size or 0) / SMALL_WRITE_BYTES), ok)
+            with self._condition:
+                self._active -= 1
+                self._condition.notify_all()
+
+    def throttle(self, num_bytes):
+        '''Pays for num_bytes of writing.  Pass as the throttle callback of copy_file_chunked().'''
+
+        waited = self.bucket.consume(num_bytes)
+        if getattr(self._local, 'throttled', None) is not None:
+            self._local.throttled += waited
+        with self._condition:
+            self.stats['bytes'] += num_bytes
+            self.stats['throttle_seconds'] += waited
+
+    # ---- governed operations ----
+
+    def copy_file(self, source_path, destination_path, label=None, expected_sha256=None):
+        '''copy_file_chunked() under a slot and the byte rate.  Returns (bytes, sha256).'''
+
+        size = os.path.getsize(source_path)
+        with self.write_slot(size, label or os.path.basename(destination_path)):
+            return copy_file_chunked(source_path, destination_path, throttle=self.throttle, expected_sha256=expected_sha256)
+
+    @contextmanager
+    def write_small(self, num_bytes, label=''):
+        '''Slot and byte accounting for a small write done by the caller (log row, pickle, manifest line).'''
+
+        with self.write_slot(num_bytes, label) as wait:
+            self.throttle(num_bytes)
+            yield wait
+
+    # ---- reporting ----
+
+    def report(self):
+        '''One-line summary for the end of a run.'''
+
+        s = self.stats
+        if not s['writes']:
+            return 'Share writes:  none'
+
+        return ('Share writes:  {} ({} small), {:.1f} MB, queue wait {:.1f}s total / {:.1f}s max ({}), '
+                'throttled {:.1f}s').format(
+                    s['writes'], s['small_writes'], s['bytes'] / 1024 / 1024, s['queue_wait_seconds'],
+                    s['max_queue_wait_seconds'], s['max_queue_wait_label'] or '-', s['throttle_seconds']) + (
+                    '\n' + self.controller.report() if self.controller is not None else '')
+
+
+###############################################################################################################
+###############################################################################################################
+
+####################################################################################
+# Process-wide governor
+####################################################################################
+
+_governor = None
+
+
+def governor_from_config(config):
+
+    '''
+    (Python)
+
+    Builds a governor from a settings dict (e.g. the sft_objects.p objects).
+
+    Keys:
+    share_write_mb_per_second -- byte-rate cap in MB/s (default: unlimited)
+    share_max_concurrent_writes -- writes in flight (default 2; the starting point when adaptive)
+    share_adaptive_writes -- tune the writes in flight from their latency (default True)
+    share_max_concurrent_writes_ceiling -- upper bound for the adaptive tuning (default 6)
+    share_write_aging_mb_per_second -- MB taken off a waiting write's size per second it waits (default 10)
+    '''
+
+    rate = config.get('share_write_mb_per_second')
+    aging = config.get('share_write_aging_mb_per_second', DEFAULT_AGING_BYTES_PER_SECOND / 1024 / 1024)
+
+    return IOGovernor(bytes_per_second=rate * 1024 * 1024 if rate else None,
+                      max_concurrent_writes=config.get('share_max_concurrent_writes', 2),
+                      adaptive_ceiling=config.get('share_max_concurrent_writes_ceiling', 6) if config.get('share_adaptive_writes', True) else None,
+                      aging_bytes_per_second=aging * 1024 * 1024 if aging else 0)
+
+
+def get_governor():
+    '''The process-wide governor (unlimited until set_governor() is called).'''
+
+    global _governor
+
+    if _governor is None:
+        _governor = IOGovernor()
+
+    return _governor
+
+
+def set_governor(governor):
+    '''Replaces the process-wide governor.'''
+
+    global _governor
+
+    _governor = governor
@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+"""
+Listing-snapshot cache for the SFT pull.
+
+Remembers what every routed folder looked like the last time it was visited, plus the
+signature the directory tree showed for it afterwards.  On the next run a folder is only
+clicked into when its tree signature changed, its snapshot expired, or it was left with
+content in it.
+"""
+###############################################################################################################
+###############################################################################################################
+
+import os
+import time
+import pickle
+
+###############################################################################################################
+###############################################################################################################
+
+####################################################################################
+# Tree signature
+####################################################################################
+
+def tree_signature(node, tree_nodes):
+
+    '''
+    (Python)
+
+    Builds a cheap change signature for a folder from the directory tree alone (no clicks):
+    the size/mtime the tree exposes for it plus the names of its direct sub-folders.
+
+    Returns None if the tree exposes neither size nor mtime for the folder, since then a
+    new file could arrive without the signature changing.  Folders with no signature are
+    always visited.
+
+    --------------------------------------------------------------------------------------
+
+    Keyword arguments:
+    node -- sft_parsing.SFTNode of the folder
+    tree_nodes -- all nodes from sft_parsing.read_tree()
+
+    --------------------------------------------------------------------------------------
+
+    Example:
+    tree_nodes = read_tree(driver)
+    signature = tree_signature(tree_nodes[0], tree_nodes)
+    '''
+
+    if node.size is None and node.mtime is None:
+        return None
+
+    child_prefix = node.id + ':'
+    children = tuple(sorted(n.name for n in tree_nodes
+                            if n.id.startswith(child_prefix) and n.depth == node.depth + 1))
+
+    return (node.size, node.mtime, children)
+
+###############################################################################################################
+###############################################################################################################
+
+####################################################################################
+# Listing cache
+####################################################################################
+
+class ListingCache:
+
+    '''
+    (Python)
+
+    Persistent cache of per-folder listing snapshots with TTL-based eviction.
+
+    Each entry (keyed by the folder's tree id) holds:
+    observed_at -- epoch seconds of the last visit
+    child_count, names, sizes, mtimes -- what the file list showed at that visit
+    signature -- tree signature recorded once the folder was settled (None until then)
+
+    --------------------------------------------------------------------------------------
+
+    Keyword arguments:
+    path -- pickle file the cache is stored in
+    ttl_seconds -- snapshots older than this are evicted, forcing a visit
+
+    --------------------------------------------------------------------------------------
+
+    Example:
+    cache = ListingCache('//Sequence Data and Reporting/Data_Objects/SFT/sft_listing_cache.p')
+    if cache.needs_visit(folder_id, tree_signature(node, tree_nodes)):
+        nodes = read_file_list(driver)
+        cache.record(folder_id, nodes)
+    ...
+    cache.settle(folder_id, tree_signature(node_after, tree_nodes_after))
+    cache.save()
+    '''
+
+    def __init__(self, path, ttl_seconds=24 * 60 * 60):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self.entries = {}
+        self.skipped = 0
+        self.visited = 0
+        self.load()
+
+    def load(self):
+        '''Reads the cache from disk (empty if missing or unreadable) and evicts expired entries.'''
+
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, 'rb') as f:
+                    self.entries = pickle.load(f)
+            except (pickle.UnpicklingError, EOFError, OSError) as e:
+                print('Listing cache unreadable, starting empty:  {}'.format(str(e)))
+                self.entries = {}
+
+        self.evict_expired()
+
+    def evict_expired(self, now=None):
+        '''Drops snapshots older than the TTL.  Returns the number evicted.'''
+
+        now = time.time() if now is None else now
+        expired = [k for k, v in self.entries.items() if now - v['observed_at'] > self.ttl_seconds]
+        for key in expired:
+            del self.entries[key]
+
+        return len(expired)
+
+    def needs_visit(self, folder_id, signature):
+        '''True unless the folder has a settled, unexpired snapshot with the same tree signature.'''
+
+        entry = self.entries.get(folder_id)
+        visit = (signature is None
+                 or entry is None
+                 or entry['signature'] is None
+                 or time.time() - entry['observed_at'] > self.ttl_seconds
+                 or entry['signature'] != signature)
+
+        if visit:
+            self.visited += 1
+        else:
+            self.skipped += 1
+
+        return visit
+
+    def diff(self, folder_id, content_nodes):
+        '''Names added / removed / changed (size or mtime) since the last snapshot of the folder.'''
+
+        entry = self.entries.get(folder_id) or {'names': (), 'sizes': (), 'mtimes': ()}
+        before = {n: (s, m) for n, s, m in zip(entry['names'], entry['sizes'], entry['mtimes'])}
+        after = {n.id: (n.size, n.mtime) for n in content_nodes}
+
+        return {
+            'added': sorted(set(after) - set(before)),
+            'removed': sorted(set(before) - set(after)),
+            'changed': sorted(k for k in set(after) & set(before) if after[k] != before[k]),
+        }
+
+    def record(self, folder_id, content_nodes):
+        '''Stores what the folder's file list showed.  The folder is unsettled until settle() is called.'''
+
+        now = time.time()
+
+        # Files still there from an unsettled earlier listing keep the time they were first seen
+        before = self.entries.get(folder_id) or {}
+        first_seen = dict(zip(before.get('names', ()), before.get('first_seen', ()))) if before.get('signature') is None else {}
+
+        self.entries[folder_id] = {
+            'observed_at': now,
+            'child_count': len(content_nodes),
+            'names': tuple(n.id for n in content_nodes),
+            'sizes': tuple(n.size for n in content_nodes),
+            'mtimes': tuple(n.mtime for n in content_nodes),
+            'first_seen': tuple(first_seen.get(n.id, now) for n in content_nodes),
+            'signature': None,
+        }
+
+    def first_seen(self, folder_id, name):
+        '''When a name was first listed in the folder (epoch seconds), or None.'''
+
+        entry = self.entries.get(folder_id) or {}
+        return dict(zip(entry.get('names', ()), entry.get('first_seen', ()))).get(name)
+
+    def waiting_since(self, folder_id):
+        '''First-seen time of the oldest entry an earlier run listed but didn't clear (None if the folder was emptied).'''
+
+        entry = self.entries.get(folder_id)
+        if entry is None or entry['signature'] is not None or not entry.get('first_seen'):
+            return None
+
+        return min(entry['first_seen'])
+
+    def settle(self, folder_id, signature):
+        '''Records the tree signature seen after the folder was emptied, so an unchanged folder is skipped next run.'''
+
+        if folder_id in self.entries:
+            self.entries[folder_id]['signature'] = signature
+
+    def save(self):
+        '''Writes the cache atomically (temp file + rename).'''
+
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'wb') as f:
+            pickle.dump(self.entries, f)
+        os.replace(temp_path, self.path)
+
+        print('Listing cache saved:  {} visited, {} skipped'.format(self.visited, self.skipped))
@@ -9,784 +9,759 @@ Created on Tue Aug 31 18:13:25 2021
 # Load all libraries
 ###############################################################################################################
 
-from selenium import webdriver
-from selenium.webdriver.common.by import By
-from selenium.webdriver.common.keys import Keys
-from selenium.webdriver import ActionChains
-
 import time
 import os
-import shutil
-import numpy as np
-import pandas as pd
-import regex as re
+import csv
 import datetime
 import pickle
-import keyring
-import smtplib
-from email.message import EmailMessage
-from email.mime.text import MIMEText
+from collections import deque
+from typing import NamedTuple
+
+###############################################################################################################
+# Load all functions
+###############################################################################################################
 
-import win32com.client as win32
+# Import customized functions .py file from the working directory
+from sft_functions import *
+from sft_driver import create_chrome_driver, make_run_download_directory, remove_run_download_directory
+from sft_transfer import wait_for_download_progress, wait_for_new_download, unpack_zip
+from sft_parsing import read_tree, read_file_list
+from sft_listing_cache import ListingCache, tree_signature
+from sft_manifest import ManifestWriter, new_run_id, describe_file
+from sft_settings import get_settings
+from sft_governor import governor_from_config, set_governor, AIMDController, load_controller_state, save_controller_state
+from sft_staging import StagingArea, sha256_of
+from sft_sidecar import SidecarConverter, sidecars_available
+from sft_dupindex import DuplicateIndex
+from sft_schedule import priority_of, order_navigation_key, order_files, waiting_since, arrival_time, availability_report
 
 ###############################################################################################################
-# Define all functions
+# Steps of the pull
 ###############################################################################################################
 
-# Deleting File/Folder
+####################################################################################
+# Login to the SFT website
+####################################################################################
+
+def login(driver, username, password):
 
-def delete_element_by_id(driver, element_id):
     '''
     (Python)
 
-    SPECIFIC TO SFT WEBSITE.  MAY NEED ADJUSTMENT IF SITE CHANGES STRUCTURE
-
-    Deletes an element based on the web element's id.
-    Used for deleting file after download/transfer
+    Opens the SFT website and logs in.
 
     --------------------------------------------------------------------------------------
 
     Keyword arguments:
     driver -- selenium webdriver
-    element_id -- the web element id.  Found in html structure.
-
-    --------------------------------------------------------------------------------------
-
-    Example:
-    html_element_id = 'somefile' # typically found using CTRL+SHIFT+C (web inspection mode) and manually finding ID
-    delete_element_by_id(html_element_id)
-
-    --------------------------------------------------------------------------------------
-
-    Dependencies:
-    import time
-    from selenium import webdriver
-    from selenium.webdriver import ActionChains
+    username -- SFT username
+    password -- SFT password
     '''
 
-    # Find the proper web element
-    element = driver.find_element_by_id(element_id)
-    time.sleep(1)
-
-    # Allow for right-clicking
-    action = ActionChains(driver)
+    # Go to website
+    driver.get('https://sft.wa.gov/')
+    time.sleep(15)
 
-    # Click on file in question
-    action.context_click(element).perform()
-    time.sleep(1)
+    # Find username field and enter username
+    username_field = driver.find_element_by_name('user')
+    username_field.send_keys(username)
 
-    # Delete file
-    rightclick_delete = driver.find_element_by_id('allFiles_context::delete')
-    rightclick_delete.click()
-    time.sleep(1)
+    # Find password field and enter password
+    password_field = driver.find_element_by_name('password')
+    password_field.send_keys(password)
 
-    # Confirm deletion
-    confirm_delete = driver.find_element_by_id('delete_actions::delete')
-    confirm_delete.click()
-    time.sleep(1)
+    # Login and wait
+    driver.find_element_by_id('loginButon').click()
+    time.sleep(15)
 
-    print('Deletion Complete:  {}'.format(str(element_id)))
+####################################################################################
+# Iteritively open every single directory
+####################################################################################
 
-# Downloading File
+def expand_all_directories(driver):
 
-def download_element_by_id(driver, element_id):
     '''
     (Python)
 
-    SPECIFIC TO SFT WEBSITE.  MAY NEED ADJUSTMENT IF SITE CHANGES STRUCTURE
-
-    Downloads an element based on the web element's id.
-    Used for downloading relevant files from SFT
+    Clicks open every directory in the SFT tree until nothing is left collapsed.
+    Returns the parsed tree nodes of the fully expanded tree.
 
     --------------------------------------------------------------------------------------
 
     Keyword arguments:
-    driver -- selenium webdriver
-    element_id -- the web element id.  Found in html structure.
-
-    --------------------------------------------------------------------------------------
-
-    Example:
-    html_element_id = 'somefile' # typically found using CTRL+SHIFT+C (web inspection mode) and manually finding ID
-    download_element_by_id(html_element_id)
-
-    --------------------------------------------------------------------------------------
-
-    Dependencies:
-    import time
-    from selenium import webdriver
-    from selenium.webdriver import ActionChains
-
-    # RELIES ON the webdriver defined under the variable "driver"
-    '''
-    # Find the proper web element.  First sleep allowing files to finish rendering on page.
-    time.sleep(5)
-    element = driver.find_element_by_id(element_id)
-    time.sleep(3)
-
-    # Allow for right-clicking
-    action = ActionChains(driver)
-
-    # Click on file in question
-    action.context_click(element).perform()
-    time.sleep(1)
-
-    # Delete file
-    rightclick_download = driver.find_element_by_id('allFiles_context::download')
-    rightclick_download.click()
-    time.sleep(5)
-
-    print('Download Initiated:  {}'.format(str(element_id)))
-
-# Waiting for download
-
-def wait_for_download(filename, download_directory):
+    driver -- selenium webdriver, logged in
     '''
-    (Python)
-
-    Waits for a file to be downloaded
 
-    --------------------------------------------------------------------------------------
-    Keyword arguments:
-    filename -- Name of the file that was downloaded
-    download_directory -- Full path to wherever things get downloaded to
-
-    --------------------------------------------------------------------------------------
+    # initialize the number of unopned directories to some non-zero value
+    num_unopened_directories = 1
 
-    Example:
-    file = 'monkey_picture.png'
-    dir_downloads = 'C:/Users/Downloads/'
+    # open anything unopened until everything is opened
+    while num_unopened_directories > 0:
 
-    wait_for_download( file, dir_downloads )
-    --------------------------------------------------------------------------------------
+        # Get a snapshot of all open directories, parsed into one node per directory
+        tree_nodes = read_tree(driver)
 
-    Dependencies:
-    import os
-    import time
-    '''
+        # Find out what isn't expanded yet (aria-expanded="false").  Get all id's that meet this criteria.
+        remaining_ids_to_click = [node.id for node in tree_nodes if node.expanded is False]
 
-    # Convert filename to full file path with forward slashes.
-    full_downloads_path_forwardslash = download_directory + filename
+        # For every element that is still closed...
+        for cur_id_toclick in remaining_ids_to_click:
 
-    # Convert filename to full file path with last location specified as "...folder\file.extension"
-    full_downloads_path_backslash = download_directory[:-1] + '\\' + filename
+            # click on that id (of the folder) to open it
+            driver.find_element_by_id(cur_id_toclick).click()
 
-    # Initialize conditions before while loop
-    conditions_met = 0
-    iteration = 1
+            # wait a sec
+            time.sleep(1)
 
-    # Initiate while loop.  Waits for:
-    #### 1.  the file to be finished downloading -> both full file paths recognized via os.path.exists() function
-    #### OR
-    #### 2.  timeout occurs -> operation runs for 5 mins (300 seconds) without any action.
+        # Get another view of the open/unopened directories and find out if anything is still unopened
+        num_unopened_directories = sum(node.expanded is False for node in read_tree(driver))
 
-    while (conditions_met != 2) & (iteration < 300):
-        # Check to see if paths exist.  Returns boolean TRUE or FALSE
-        cond1 = os.path.exists(full_downloads_path_forwardslash)
-        cond2 = os.path.exists(full_downloads_path_backslash)
+        # wait 2 seconds
+        time.sleep(2)
 
-        # See how many conditions were met. (adding booleans produces INT value)
-        conditions_met = cond1 + cond2
+    return read_tree(driver)
 
-        # Update iteration count
-        iteration += 1
+####################################################################################
+# Define a key we will use to guide the downloads / map folders to the net drive.
+# NECISSARY STEP FOR COMPLEX FILE STRUCTURES
+####################################################################################
 
-        # Rest
-        time.sleep(1)
+class NavigationEntry(NamedTuple):
+    '''One SFT folder the pull visits and where its files go.'''
 
-    # If timeout occured, you will see an iteration of 300 or greater.  Return output.
-    if iteration > 299:
-        raise TimeoutError('File never downloaded.  Timed out after 5 mins')
+    id: str                     # tree id to click (allFiles_Tree::...)
+    colons: int                 # ':' count in the id.  Deeper folders have more; visited first.
+    dir1: str                   # top-level SFT folder (the submitter)
+    net_Drive_Mapping: str      # destination folder on the net drive
+    crosswalk: dict             # the folder's full sft_expected_directories.csv row
 
-    # Otherwise print message indicating completion.
-    else:
-        print('Action Complete:  {}'.format(str(filename)))
 
-# Moving a file
+def read_expected_directories(path):
 
-def move_file(filename, source_directory, destination_directory):
     '''
     (Python)
 
-    Moves a file from one place to another, making sure that
-
-    --------------------------------------------------------------------------------------
-    Keyword arguments:
-    filename -- Name of the file that was downloaded
-    source_directory -- Full path to source.  Ends in /
-    destination_directory -- Full path to where you want the file to go.  End with /
-
-    --------------------------------------------------------------------------------------
-
-    Example:
-    file = 'monkey_picture.png'
-    dir_downloads = 'C:/Users/Downloads/'
-    dir_dest = 'C:/Some/Location/on/Yourdrive/'
-
-    move_file( file, dir_downloads, dir_dest )
-    --------------------------------------------------------------------------------------
-
-    Dependencies:
-    import shutil
-    import
-    import time
+    Reads the sft_expected_directories.csv crosswalk into {DirName: row dict}.
+    Rows without a net_Drive_Mapping are left out, as they can't be routed.
     '''
 
-    # Specify full path of the source
-    full_source_path = source_directory + filename
-
-    # Specify full path of the destination
-    full_destination_path = destination_directory + filename
-
-    # Initialize copy #
-    copy_num = 1
-
-    # If the file already exists, follow windows formatting for adding version extension to name
-    #### ex: file (1).txt or file (2).txt
-    while os.path.exists(full_destination_path):
-        version_extension = ' ({})'.format(str(copy_num))
-        filename_split = str(filename).split('.')
-        new_filename = str(''.join(filename_split[:-1])) + version_extension + str(filename_split[-1])
-        full_destination_path = destination_directory + new_filename
-        copy_num += 1
-        time.sleep(2)
-
-    # Move the file
-    shutil.move(full_source_path, full_destination_path)
+    with open(path, 'r', newline='') as f:
+        return {row['DirName']: row for row in csv.DictReader(f) if (row.get('net_Drive_Mapping') or '').strip()}
 
-    # Print output
-    print('Moved File:  {}'.format(str(filename)))
 
-# Copying a file to archive with unique name
+def build_navigation_key(tree_nodes, expected_dirs):
 
-def copy_file_to_archive(filename, source_directory, destination_directory, today_date):
     '''
     (Python)
 
-    Copies file to an archive with datetime prefix for emergency backup purposes
+    Maps every SFT folder we pull from to its net drive destination, in visiting order
+    (per top-level folder, deepest sub-folders first).
 
     --------------------------------------------------------------------------------------
 
     Keyword arguments:
-    filename -- Name of the file that was downloaded
-    source_directory -- Full path to source.  Ends in /
-    destination_directory -- Full path to where you want the file to go.  End with /
-    today_date -- todays date as string
+    tree_nodes -- parsed nodes of the fully expanded tree
+    expected_dirs -- the crosswalk from read_expected_directories()
 
     --------------------------------------------------------------------------------------
 
-    Example:
-    file = 'monkey_picture.png'
-    dir_downloads = 'C:/Users/Downloads/'
-    dir_dest = 'C:/Some/Location/on/Yourdrive/'
+    Returns:
+    list of NavigationEntry
+    '''
 
-    copy_file_to_archive( file, dir_downloads, dir_dest, '20210830' )
-    --------------------------------------------------------------------------------------
+    navigation_key = []
 
-    Dependencies:
-    import pandas as pd
-    import numpy as np
-    import os
-    import shutil
-    import time
-    '''
+    for node in tree_nodes:
 
-    # Get full path of the source dir
-    full_source_path = source_directory + filename
+        # Get the base directory and the second directory (None for top-level folders)
+        dir1 = node.path_parts[0]
+        dir2 = node.path_parts[1] if node.depth > 1 else None
 
-    # Eventually file with get saved with prefix "%Y%m%d_%h%m_"
-    current_time = str(datetime.datetime.now().time()).replace(':', '')[:6]
-    current_date = today_date
-    current_datetime = current_date + '_' + current_time + '_'
+        # Filter out sentinal labs that we don't want to click through
+        if dir1 == 'SENTINEL_LABS' and dir2 != 'NW_Genomics':
+            continue
 
-    # Specify the full destination output with prefix
-    full_destination_path = destination_directory + current_datetime + filename
+        # Merge with net drive mapping information.  Folders without a mapping are not pulled.
+        crosswalk = expected_dirs.get(dir1)
+        if crosswalk is None:
+            continue
 
-    # Specify archive file name
-    output_file = current_datetime + filename
+        navigation_key.append(NavigationEntry(node.id, node.id.count(':'), dir1, crosswalk['net_Drive_Mapping'], crosswalk))
 
-    # Copy the file!
-    shutil.copyfile(full_source_path, full_destination_path)
+    # Order: by top-level folder, deepest first
+    navigation_key.sort(key=lambda entry: (entry.dir1, -entry.colons))
 
-    # print output
-    print('Copy File to Archive:  {}'.format(str(output_file)))
+    return navigation_key
 
-    return output_file
+####################################################################################
+# Open a folder and list its contents
+####################################################################################
 
-# Log the action
+def open_folder(driver, folder_id, pace=1.0):
 
-def log_action(date, filename, folder_dest, path_dest, archive_filename, archive_full_filepath):
     '''
     (Python)
 
-    Creates new row in log-file for SFT pull script
+    Clicks into an SFT folder and returns the parsed nodes of its file list.
 
     --------------------------------------------------------------------------------------
 
     Keyword arguments:
-    date -- current date formatted as YYYYmmdd (ex: 20210130)
-    filename -- name of file that was downloaded (ex: metadata_someplace.csv)
-    folder_dest -- folder name that the file was saved to
-    path_dest -- full path that the file was sent to
-    archive_filename -- file name saved to the archive location with timestamp prefix
-    archive_full_filepath -- full path that the file was saved to
-
-    --------------------------------------------------------------------------------------
-
-    Example:
-    date_now = '20210831'
-    file = 'file.txt'
-    destination = 'labsubmitter'
-    path_dest = 'C:/path/to/labsubmitter/'
-    file_archival = '20210831_1401_file.txt'
-    path_archival = 'C:/path/to/archival/location'
-
-    log_action( date_now, file, destination, path_dest, file_archival, path_archival )
-    --------------------------------------------------------------------------------------
-
-    Dependencies:
-    import pandas as pd
-    import pickle
+    driver -- selenium webdriver, logged in
+    folder_id -- tree id of the folder (allFiles_Tree::...)
+    pace -- multiplier for the waits between clicks (1.0: the original waits)
     '''
 
-    # Read in the .csv log file
-    df = pd.read_csv('//Sequence Data and Reporting/Submissions/sft_automated_pull_log.csv')
+    xpath_folder_to_click = '//*[@id="'+str(folder_id)+'"]/a/span'
 
-    # Read in the columns
-    df_columns = df.columns
-
-    # Get a list of the entries we will put into log
-    newrow = [date, filename, folder_dest, path_dest, archive_filename, archive_full_filepath]
-
-    # Convert to row-like pandas dataframe
-    pd_newrow = pd.DataFrame(newrow).transpose()
+    # Click on the relevant folder
+    ##### First click by id.  Exposes the underlying /a/span/ element that we actually want.
+    ##### Then click on the element that shows us the folder contents
+    driver.find_element_by_id(folder_id).click()
+    time.sleep(pace)
+    driver.find_element_by_xpath(xpath_folder_to_click).click()
+    time.sleep(pace)
 
-    # Name the columns of the newly created dataframe using existing
-    pd_newrow.columns = df_columns
+    # Get the files/folders in the filelist, one parsed node each
+    content_nodes = read_file_list(driver)
+    time.sleep(pace)
 
-    # Append the new row to the dataframe
-    df = df.append(pd_newrow, ignore_index=True)
+    return content_nodes
 
-    # Overwrite to the newly appended log file
-    df.to_csv('//Sequence Data and Reporting/Submissions/sft_automated_pull_log.csv', index=False)
 
-# Send the email
+def bulk_download(driver, file_nodes, dir_downloads, stall_timeout=120, pace=1.0):
 
-def send_email(subject, recipients, html_content):
     '''
     (Python)
 
-    Sends an email using outlook
+    Downloads a folder's files in one request and checks each one: a zip is unpacked
+    member by member (CRC-checked and hashed as it streams), individual files are hashed
+    as they are, and every file is compared with the size the SFT listed.  Only files
+    that pass are returned; the rest are removed locally, to be downloaded one by one.
 
     --------------------------------------------------------------------------------------
 
     Keyword arguments:
-    subject:  str, required. Will be displayed in subject line.
-    recipients: list, required.  List of strings detailing email addresses to send email to.
-    html_content:  str, required.  String of HTML content that makes up body of email.
+    driver -- selenium webdriver, in the folder
+    file_nodes -- the folder's file nodes (id = name, size as listed)
+    dir_downloads -- the run's download directory.  Ends in /
+    stall_timeout -- seconds without progress before giving up
+    pace -- multiplier for the waits between clicks
 
     --------------------------------------------------------------------------------------
 
-    Example:
-    subject = 'test email'
-    recipient_list = ['youremailhere@gmail.com']
-    content = '<p>Hello World!.</p>'
-
-    send_email( subject , recipient_list , content )
-
-    # Check your inbox!!
-
-    --------------------------------------------------------------------------------------
-
-    Dependencies:
-    import win32com.client as win32
+    Returns:
+    ({name: {'size', 'sha256'}} of the files now in dir_downloads, seconds taken)
     '''
 
-    # Connect to outlook
-    outlook = win32.Dispatch('outlook.application')
-
-    # Create the item
-    mail = outlook.CreateItem(0)
+    wanted = {node.id: node.size for node in file_nodes}
+    known = set(os.listdir(dir_downloads))
+    started = time.monotonic()
+    ready = {}
+
+    try:
+        download_elements_as_archive(driver, list(wanted), pace=pace)
+        new_names = wait_for_new_download(dir_downloads, known, stall_timeout=stall_timeout, expected_names=wanted)
+
+        for name in new_names:
+            if name in wanted:
+                # The server sent the files themselves
+                ready[name] = {'size': os.path.getsize(dir_downloads + name), 'sha256': sha256_of(dir_downloads + name)}
+            elif name.lower().endswith('.zip'):
+                unpacked, problems = unpack_zip(dir_downloads + name, dir_downloads, expected_names=set(wanted) - set(ready))
+                ready.update(unpacked)
+                for member, reason in problems.items():
+                    print('Bulk download member skipped:  {}  ({})'.format(member, reason))
+                os.remove(dir_downloads + name)
+            else:
+                print('Unexpected file from the bulk download, removed:  {}'.format(name))
+                os.remove(dir_downloads + name)
+
+    except Exception:
+        # Nothing half-done may be mistaken for a download later
+        for name in set(os.listdir(dir_downloads)) - known:
+            os.remove(dir_downloads + name)
+        raise
+
+    # Every file must match the size the SFT listed for it (within display rounding: '3.5 MB')
+    for name, described in list(ready.items()):
+        if wanted[name] is not None and abs(described['size'] - wanted[name]) > max(1024, wanted[name] * 0.05):
+            print('Bulk download size mismatch, downloading on its own:  {}  ({} bytes, listed {})'.format(name, described['size'], wanted[name]))
+            os.remove(dir_downloads + name)
+            del ready[name]
+
+    return ready, time.monotonic() - started
+
+
+def paced_action(controller, action, *args, attempts=1):
 
-    # Define the recipient(s)
-    mail.To = ';'.join(recipients)
+    '''
+    (Python)
 
-    # Define the subject
-    mail.Subject = subject
+    Runs an SFT click action (download or delete) at the pace the controller allows
+    (1 / limit of the original waits) and reports how long the page took.  On an error
+    the controller slows down and, with attempts > 1, the action is retried at the
+    slower pace.
 
-    # Define the body
-    mail.HTMLBody = html_content
+    --------------------------------------------------------------------------------------
 
-    # Send email
-    mail.Send()
+    Keyword arguments:
+    controller -- sft_governor.AIMDController whose limit is the speed-up over the original waits
+    action -- function taking (*args, pace=...) and returning the seconds spent in the page
+    attempts -- tries before the error is raised (only for actions safe to repeat)
+    '''
 
-    # Print success
-    print('Email Successfully Sent!')
+    for attempt in range(attempts):
+        started = time.monotonic()
+        try:
+            result = action(*args, pace=1.0 / controller.value)
+        except Exception:
+            controller.record(time.monotonic() - started, ok=False)
+            if attempt + 1 >= attempts:
+                raise
+            print('SFT action failed, retrying slower:  {}{}'.format(getattr(action, '__name__', action), args[1:]))
+            continue
 
+        controller.record(result)
+        return result
 
 ###############################################################################################################
 # Pull all files from the sft
 ###############################################################################################################
 
-####################################################################################
-# Define all variables of interest to be used later on
-####################################################################################
-
-# Read in required data_objects and define objects.
-py_creds = pickle.load( open( f'C:/Users/{os.getlogin()}/Projects/Sequencing/Data_Objects/py_creds.p', "rb" ) )
-
-# Reload the objects file from the right location
-objects = pickle.load( open( '//Sequence Data and Reporting/Data_Objects/SFT/sft_objects.p', "rb" ) )
-
-# Load in our expected directories crosswalk -> links SFT dirs to net drive locs
-expected_dirs = pd.read_csv('//Sequence Data and Reporting/Data_Objects/SFT/sft_expected_directories.csv')
-
-# Define credentials to sft website
-username = py_creds['sft_user']
-password = py_creds['sft_pw']
-
-# Define todays date
-todays_date = str(datetime.datetime.now().date()).replace('-','')
+def stop_if_lock_lost(lock_lost):
+    '''Raises before an SFT delete once the run lock has been taken over (another run now owns the SFT).'''
 
-####################################################################################
-# Get selenium up and running
-####################################################################################
-
-# Define URL path to website we want.
-base_page = 'https://sft.wa.gov/'
-
-# Initiate Chrome
-driver = webdriver.Chrome()
-
-# Allow for right-clicking
-action = ActionChains(driver)
-
-# Go to website
-driver.get(base_page)
-
-time.sleep(15)
-
-####################################################################################
-# Login to the SFT website
-####################################################################################
-
-
-# Find username field and enter username
-username_field = driver.find_element_by_name('user')
-username_field.send_keys(username)
-
-# Find password field and enter password
-password_field = driver.find_element_by_name('password')
-password_field.send_keys(password)
-
-# Login and wait
-driver.find_element_by_id('loginButon').click()
-time.sleep(15)
-
-####################################################################################
-# Iteritively open every single directory
-####################################################################################
-
-# initialize the number of unopned directories to some non-zero value
-num_unopened_directories = 1
-
-# open anything unopened until everything is opened
-while num_unopened_directories > 0:
-
-    # Get a snapshot of all open directories
-    DirectoryTree_RawText_CurrentView = driver.find_element_by_id('allFiles_Tree::').get_attribute('outerHTML')
-
-    # Find all the ids of the directories
-    ids = np.array(re.findall('id="(allFiles_Tree::[^"]+)"',DirectoryTree_RawText_CurrentView))
-
-    # Find out whether or not they have already been clicked (aria-expanded="true")
-    is_expanded = np.char.lower(np.array(re.findall('aria-expanded="([^"]+)"',DirectoryTree_RawText_CurrentView)[1:]))
-
-    # Find out what isn't expanded.  Get all id's that meet this criteria.
-    condition_needs_expanding = (is_expanded=='false')
-    remaining_ids_to_click = ids[condition_needs_expanding]
+    if lock_lost is not None and lock_lost.is_set():
+        raise RuntimeError('Run lock lost to another run; stopping before the next SFT delete')
 
-    # For every element that is still open...
-    for j in np.arange(0,len(remaining_ids_to_click)):
-
-        # get the id to click
-        cur_id_toclick = remaining_ids_to_click[j]
-
-        # click on that id (of the folder) to open it
-        driver.find_element_by_id(cur_id_toclick).click()
-
-        # wait a sec
-        time.sleep(1)
-
-    # Get another view of the open/unopened directories
-    DirectoryTree_RawText_PostView = driver.find_element_by_id('allFiles_Tree::').get_attribute('outerHTML')
-
-    # find out using regular expressions if anything is still unopen
-    num_unopened_directories = len(re.findall('aria-expanded="(false)"',DirectoryTree_RawText_PostView))
-
-    # wait 2 seconds
-    time.sleep(2)
-
-####################################################################################
-# Define a key we will use to guide the downloads / map folders to the net drive.
-# NECISSARY STEP FOR COMPLEX FILE STRUCTURES
-####################################################################################
-
-# Get a snapshot of all open directories
-DirectoryTree_RawText_CurrentView = driver.find_element_by_id('allFiles_Tree::').get_attribute('outerHTML')
-
-# Find all the ids of the directories we could navigate to
-ids = pd.Series(re.findall('id="(allFiles_Tree::[^"]+)"',DirectoryTree_RawText_CurrentView))
-
-# Count the number of colans in each id.  Later used to sort on
-NumColans_inIDstring = ids.str.count(':')
-
-# Get the base directory
-dir1 = ids.str.split('::',expand=True)[1].str.split(':',expand=True)[0]
-
-# Get the second directory
-dir2 = ids.str.split('::',expand=True)[1].str.split(':',expand=True)[1]
-
-# Get a nice pandas dataframe containing all relevant information to folder paths
-pandas_navigation_key_unfiltered = pd.DataFrame(np.array([ids,NumColans_inIDstring,dir1,dir2]).transpose(),
-                                     columns=['id','OrderByMe','dir1','dir2'])
-
-# Filter out sentinal labs that we don't want to click through
-pandas_navigation_key_filtered = pandas_navigation_key_unfiltered.query('(dir1 != "SENTINEL_LABS")|(dir2 == "NW_Genomics")')
-
-# FINALLY, merge with net drive mapping information.
-pandas_naviagtion_key_final = pandas_navigation_key_filtered.merge(expected_dirs, left_on='dir1', right_on='DirName', how='left')\
-                                                   .drop('DirName',axis=1)\
-                                                   .drop('dir2',axis=1)\
-                                                   .dropna(subset=['net_Drive_Mapping'])
-
-# Order & reset index
-pandas_naviagtion_key_final.sort_values(['dir1','OrderByMe'], ascending=[True, False], inplace=True)
-pandas_naviagtion_key_final.reset_index(inplace=True,drop=True)
-
-
-####################################################################################
-# Walk through each file downloading, moving, archiving, logging, and deleting files (in that order)
-####################################################################################
 
-# for each folder/subfolder we will click into...
-for i in np.arange(0,len(pandas_naviagtion_key_final)):
+def run_pull(run_id=None, settings=None, lock_lost=None):
 
-    # Define the net drive location we will map to, folder we are looking at.  Contained in the key we just made
-    path_to_destination_dir = pandas_naviagtion_key_final.loc[i,'net_Drive_Mapping']
-    destination_name = pandas_naviagtion_key_final.loc[i,'dir1']
-
-    # Get information on the web element location we will click on
-    id_of_folder_to_click = pandas_naviagtion_key_final.loc[i,'id']
-    xpath_folder_to_click = '//*[@id="'+str(id_of_folder_to_click)+'"]/a/span'
-
-    # Click on the relevant folder
-    ##### First click by id.  Exposes the underlying /a/span/ element that we actually want.
-    ##### Then click on the element that shows us the folder contents
-    driver.find_element_by_id(id_of_folder_to_click).click()
-    time.sleep(1)
-    driver.find_element_by_xpath(xpath_folder_to_click).click()
-    time.sleep(1)
-
-    # Get the HTML information for the filelist
-    filelist = driver.find_element_by_id('filelist-grid').get_attribute('outerHTML')
-    time.sleep(1)
-
-    # Use regex to get list of all web element ID's of the files/folders
-    content_ids = re.findall('div index="\d{1,3}".*?id="([^"]+)"', filelist)
-
-    # IF the folder contains anything (has 1+ id to work with)
-    if len(content_ids) > 0:
-
-        # Convert to pandas series to make easy to work with
-        content_ids = pd.Series(content_ids)
-
-        # Directories begin with a ':' character.  Define condition that exposes these.
-        condition_isDirectory = (content_ids.str[0] == ':')
+    '''
+    (Python)
 
-        # Define the directories as a list
-        directory_ids = list(content_ids[condition_isDirectory])
+    Pulls every routed file from the SFT.  Each download is staged locally (archive copy,
+    placed file, log row) and synced to the share in the background; a file is deleted
+    from the SFT and recorded in the run manifest only once its share copies are
+    verified and its log row is written.  Marks today as the last completed date in the objects file when done.
 
-        # Define the files as a list.  Note that the '~' character represents a NOT logical expression.
-        file_ids = list(content_ids[~condition_isDirectory])
+    Downloads in flight, the pace of SFT clicks and the share writes in flight are tuned
+    as the run goes (AIMD, see sft_governor.AIMDController), starting from what the last
+    run learned (sft_concurrency.json next to the manifest).
 
+    With bulk_download on, a folder of at least bulk_download_min_files files is first
+    fetched in one request (see bulk_download); files it doesn't deliver intact are
+    downloaded one by one as usual.  Either way nothing is deleted before its copies verify.
 
-        # For all of the files...
-        for j in np.arange(0,len(file_ids)):
+    --------------------------------------------------------------------------------------
 
-            # Grab the iteration's file ID
-            file_name = file_ids[j]
+    Keyword arguments:
+    run_id -- id for this run (see sft_manifest.new_run_id).  Generated if not given.
+    settings -- sft_settings.Settings (paths and SFT login).  Defaults to the process-wide settings.
+    lock_lost -- optional threading.Event set when the run lock is taken over (sft_run.RunLock.lost).
+                 The run stops with an error before its next SFT delete.
 
-            # Wait
-            time.sleep(2)
+    --------------------------------------------------------------------------------------
 
-            # 1. Download a file
-            download_element_by_id(driver,file_name)
-            wait_for_download(file_name, f'C:/Users/{os.getlogin()}/Downloads/')
+    Returns:
+    list of manifest records written by this run
+    '''
 
-            # 2. Copy to archive
-            copy_filename = copy_file_to_archive(file_name, f'C:/Users/{os.getlogin()}/Downloads/', '//Sequence Data and Reporting/Submissions/ARCHIVE_copies/', todays_date)
-            wait_for_download(copy_filename, '//Sequence Data and Reporting/Submissions/ARCHIVE_copies/')
+    ####################################################################################
+    # Define all variables of interest to be used later on
+    ####################################################################################
+
+    # Paths and SFT login.  Resolved once (environment, encrypted file, creds.yml or keyring).
+    if settings is None:
+        settings = get_settings()
+
+    # Reload the objects file from the right location
+    objects = pickle.load( open( settings.objects_path, "rb" ) )
+
+    # Load in our expected directories crosswalk -> links SFT dirs to net drive locs
+    expected_dirs = read_expected_directories(settings.expected_dirs_path)
+
+    # Where archive copies go
+    archive_directory = settings.archive_directory
+
+    # Rate and concurrency limits for everything this run writes to the share
+    governor = governor_from_config(objects)
+    set_governor(governor)
+
+    # Define todays date
+    todays_date = str(datetime.datetime.now().date()).replace('-','')
+
+    # Unique id for this run.  Stamped on every manifest record.
+    if run_id is None:
+        run_id = new_run_id()
+
+    # Adaptive limits: downloads in flight, and the speed-up of the SFT clicks over their original waits
+    manifest_directory = objects.get('manifest_directory', '//Sequence Data and Reporting/Submissions/manifest/')
+    concurrency_state_path = objects.get('concurrency_state_path', os.path.join(manifest_directory, 'sft_concurrency.json'))
+    download_window = AIMDController('sft_downloads', initial=1, maximum=objects.get('sft_max_downloads_in_flight', 4))
+    sft_actions = AIMDController('sft_actions', initial=1, maximum=objects.get('sft_max_click_speedup', 4))
+    controllers = [download_window, sft_actions] + ([governor.controller] if governor.controller is not None else [])
+    saved_state = load_controller_state(concurrency_state_path)['controllers']
+    for controller in controllers:
+        controller.restore(saved_state.get(controller.name))
+
+    ####################################################################################
+    # Get selenium up and running
+    ####################################################################################
+
+    # Dedicated download directory for this run.  Nothing else writes here.
+    dir_downloads = make_run_download_directory(objects.get('download_base_directory'))
+
+    # Initiate Chrome.  Headless, low-footprint profile by default.  Settings live in sft_objects.p
+    driver = create_chrome_driver(dir_downloads,
+                                  headless=objects.get('chrome_headless', True),
+                                  memory_cap_mb=objects.get('chrome_memory_cap_mb'),
+                                  profile_directory=objects.get('chrome_profile_directory'))
+
+    staging = None
+    converter = None
+    duplicate_index = None
+
+    try:
+        login(driver, settings.sft_user, settings.sft_pw)
+
+        # Open every directory, then work out where each one maps to on the net drive
+        tree_nodes = expand_all_directories(driver)
+        navigation_key = build_navigation_key(tree_nodes, expected_dirs)
+
+        # Look up tree nodes by id (used for the listing cache's change signatures)
+        tree_nodes_by_id = {node.id: node for node in tree_nodes}
+
+        # Load last run's folder snapshots.  Folders whose tree signature is unchanged are not clicked into.
+        listing_cache = ListingCache(objects.get('listing_cache_path', '//Sequence Data and Reporting/Data_Objects/SFT/sft_listing_cache.p'),
+                                     ttl_seconds=objects.get('listing_cache_ttl_hours', 24) * 60 * 60)
+        visited_folder_ids = []
+
+        # Tree signature of each visited folder taken right after it was emptied (or found empty)
+        emptied_signatures = {}
+
+        # Most urgent submitters first (Priority column of the crosswalk).  Submitters with files
+        # left waiting by an earlier run move up a level per priority_aging_hours waited.
+        navigation_key = order_navigation_key(navigation_key, waiting_since(listing_cache, navigation_key),
+                                              aging_hours=objects.get('priority_aging_hours', 6))
+
+        # Open the run manifest.  One JSON line per placed file for downstream incremental readers.
+        manifest = ManifestWriter(manifest_directory, run_id)
+        run_records = []
+
+        # Local staging with write-behind sync to the share.  Re-queues anything an earlier run left unsynced.
+        staging = StagingArea(objects.get('staging_directory', os.path.join(os.path.expanduser('~'), 'sft_staging')),
+                              governor,
+                              workers=objects.get('sync_workers', governor.slot_ceiling),
+                              verify=objects.get('sync_verify', 'sha256'))
+
+        # Row fingerprints of placed workbooks/CSVs, checked against every earlier submission
+        if objects.get('duplicate_index', True):
+            duplicate_index = DuplicateIndex(objects.get('duplicate_index_path', '//Sequence Data and Reporting/Data_Objects/SFT/sft_row_index.sqlite'))
+
+        # Parquet sidecars for placed workbooks/CSVs and their rows in the consolidated dataset,
+        # converted in a process pool (needs pyarrow).  The same pass fingerprints the rows.
+        write_sidecars = objects.get('sidecars', True) and sidecars_available()
+        if write_sidecars or duplicate_index is not None:
+            converter = SidecarConverter(os.path.join(staging.local_root, 'sidecars'), staging,
+                                         workers=objects.get('sidecar_workers', 2),
+                                         dataset_directory=objects.get('consolidated_directory', '//Sequence Data and Reporting/Submissions/consolidated/'),
+                                         duplicate_index=duplicate_index,
+                                         write_sidecars=write_sidecars)
+
+        # Submitters / folders with a file whose sync wasn't confirmed: no directory deletes, no cache settling
+        unconfirmed_submitters = set()
+        unsettled_folder_ids = set()
+
+        ####################################################################################
+        # Walk through each file: download, stage archive copy / placed file / log row, then delete once synced
+        ####################################################################################
+
+        # for each folder/subfolder we will click into...
+        for folder in navigation_key:
+
+            # Define the net drive location we will map to, folder we are looking at.  Contained in the key we just made
+            path_to_destination_dir = folder.net_Drive_Mapping
+            destination_name = folder.dir1
+            priority = priority_of(folder.crosswalk)
+
+            # Get information on the web element location we will click on
+            id_of_folder_to_click = folder.id
+
+            # Skip the folder if nothing changed since it was last emptied
+            if not listing_cache.needs_visit(id_of_folder_to_click, tree_signature(tree_nodes_by_id[id_of_folder_to_click], tree_nodes)):
+                print('Unchanged, skipping:  {}'.format(str(id_of_folder_to_click)))
+                continue
+
+            # Click into the folder and list what is in it
+            content_nodes = open_folder(driver, id_of_folder_to_click, pace=1.0 / sft_actions.value)
+
+            # Report what changed since the last visit and remember this listing
+            listing_diff = listing_cache.diff(id_of_folder_to_click, content_nodes)
+            if listing_diff['added'] or listing_diff['changed']:
+                print('New/changed in {}:  {}'.format(destination_name, ', '.join(listing_diff['added'] + listing_diff['changed'])))
+            listing_cache.record(id_of_folder_to_click, content_nodes)
+            visited_folder_ids.append(id_of_folder_to_click)
+
+            # Found empty: the signature read before the listing is the empty folder's
+            if len(content_nodes) == 0:
+                emptied_signatures[id_of_folder_to_click] = tree_signature(tree_nodes_by_id[id_of_folder_to_click], tree_nodes)
+
+            # IF the folder contains anything (has 1+ id to work with)
+            if len(content_nodes) > 0:
+
+                # Directories begin with a ':' character.  Split them from the files.
+                # Files smallest first, so most of them are available early in the run
+                directory_ids = [node.id for node in content_nodes if node.is_directory]
+                file_nodes = order_files(content_nodes)
+                file_ids = [node.id for node in file_nodes]
+
+                # When each file arrived on the SFT (for time to availability)
+                arrivals = {node.id: arrival_time(node, listing_cache.first_seen(id_of_folder_to_click, node.id)) for node in file_nodes}
+
+
+                # Files of this folder waiting for their share copies before the SFT delete
+                pending_deletes = []
+
+                # Folder-level bulk download (opt-in, bulk_download): the folder's files in one request,
+                # each one hashed and checked.  Whatever it doesn't deliver intact is downloaded on its own.
+                bulk_ready, bulk_seconds = {}, 0.0
+                if objects.get('bulk_download', False) and len(file_ids) >= objects.get('bulk_download_min_files', 5):
+                    try:
+                        bulk_ready, bulk_seconds = bulk_download(driver, file_nodes, dir_downloads,
+                                                                 stall_timeout=objects.get('download_stall_timeout', 120),
+                                                                 pace=1.0 / sft_actions.value)
+                        print('Bulk download:  {} of {} file(s) in {:.1f}s'.format(len(bulk_ready), len(file_ids), bulk_seconds))
+                    except Exception as e:
+                        print('Bulk download failed, downloading one by one:  {}  ({}: {})'.format(destination_name, type(e).__name__, str(e)))
+                bulk_finished_at = datetime.datetime.now()
+
+                # Files already delivered by the bulk download, then the ones still to download.
+                # Downloads started and not yet handled are in_flight, oldest first.
+                ready_files = deque(f for f in file_ids if f in bulk_ready)
+                queued_files = deque(f for f in file_ids if f not in bulk_ready)
+                in_flight = deque()
+
+                # For all of the files...
+                while ready_files or queued_files or in_flight:
+
+                    if ready_files:
+                        # 1. From the bulk download: its share of the bulk time counts as the download
+                        file_name = ready_files.popleft()
+                        downloaded_at = bulk_finished_at
+                        stage_seconds = {'download': bulk_seconds / len(bulk_ready)}
+
+                    else:
+                        # 1. Start downloads until the adaptive window is full, then take the oldest once it has landed.
+                        #    A download click is never retried: a second click would download the file twice.
+                        while queued_files and len(in_flight) < download_window.value:
+                            file_name = queued_files.popleft()
+                            time.sleep(2.0 / sft_actions.value)
+                            started, clicked_at = time.monotonic(), time.time()
+                            paced_action(sft_actions, download_element_by_id, driver, file_name)
+                            in_flight.append((file_name, started, clicked_at))
+
+                        file_name, stage_started, clicked_at = in_flight.popleft()
+                        try:
+                            wait_for_download_progress(file_name, dir_downloads, stall_timeout=objects.get('download_stall_timeout', 120))
+                        except Exception:
+                            download_window.record(time.monotonic() - stage_started, ok=False)
+                            raise
+                        downloaded_at = datetime.datetime.now()
+                        stage_seconds = {'download': time.monotonic() - stage_started}
+
+                        # Latency per MB from the click to when Chrome finished the file (not to when we looked)
+                        download_window.record(max(0.0, os.path.getmtime(dir_downloads + file_name) - clicked_at)
+                                               / max(1.0, os.path.getsize(dir_downloads + file_name) / (1024 * 1024)))
+
+                    # Size, hash and row count of the downloaded file (one local read)
+                    file_description = describe_file(dir_downloads + file_name)
+
+                    # A bulk-delivered file must still be the member that was hashed out of the download
+                    if file_name in bulk_ready and file_description['sha256'] != bulk_ready[file_name]['sha256']:
+                        print('Changed since the bulk download, downloading on its own:  {}'.format(file_name))
+                        os.remove(dir_downloads + file_name)
+                        del bulk_ready[file_name]
+                        queued_files.append(file_name)
+                        continue
+
+                    # 2-4. Stage the archive copy, the placed file and the log row locally.
+                    #      The sync workers push them to the share in the background and verify them.
+                    stage_started = time.monotonic()
+                    convert = converter is not None and converter.wants(file_name)
+                    copy_filename = archive_filename(file_name, todays_date)
+                    moved_filename, _ = collision_free_name(file_name, path_to_destination_dir, staging.reserved_names(path_to_destination_dir))
+
+                    archive_ticket = staging.stage_file(dir_downloads + file_name, archive_directory + copy_filename,
+                                                        sha256=file_description['sha256'], keep_source=True)
+                    placed_ticket = staging.stage_file(dir_downloads + file_name, path_to_destination_dir + moved_filename,
+                                                       sha256=file_description['sha256'], keep_source=convert)
+                    log_ticket = staging.stage_log_rows(settings.pull_log_path,
+                                           [LogRecord(todays_date, file_name, destination_name, path_to_destination_dir, copy_filename, archive_directory + copy_filename)],
+                                           after=[archive_ticket, placed_ticket])
+                    stage_seconds['stage'] = time.monotonic() - stage_started
+
+                    # Hand the download to the sidecar pool.  The sidecar is not needed for the SFT delete.
+                    sidecar_job = None
+                    if convert:
+                        sidecar_job = converter.submit(dir_downloads + file_name, path_to_destination_dir + moved_filename,
+                                         file_description['sha256'], metadata={'submitter': destination_name, 'run_id': run_id},
+                                         partition={'submitter': destination_name, 'month': downloaded_at.strftime('%Y-%m'),
+                                                    'run_id': run_id, 'pulled_on': downloaded_at.date().isoformat()})
+
+                    print('Staged:  {} -> {}'.format(file_name, path_to_destination_dir + moved_filename))
+
+                    pending_deletes.append((file_name, [archive_ticket, placed_ticket, log_ticket], sidecar_job, {
+                        'submitter': destination_name,
+                        'sft_id': file_name,
+                        'file_name': moved_filename,
+                        'destination_path': path_to_destination_dir + moved_filename,
+                        'archive_name': copy_filename,
+                        'archive_path': archive_directory + copy_filename,
+                        'sha256': file_description['sha256'],
+                        'size': file_description['size'],
+                        'row_count': file_description['row_count'],
+                        'downloaded_at': downloaded_at.isoformat(timespec='seconds'),
+                        'first_seen_at': datetime.datetime.fromtimestamp(arrivals[file_name]).isoformat(timespec='seconds'),
+                        'priority': priority,
+                        'stage_seconds': stage_seconds,
+                    }))
+
+                # 5.  Delete from the SFT only what the share has confirmed, then record it in the run manifest
+                folder_confirmed = True
+                for file_name, tickets, sidecar_job, record in pending_deletes:
+
+                    stage_started = time.monotonic()
+                    if not staging.wait(tickets, timeout=objects.get('sync_timeout_seconds', 30 * 60)):
+                        print('Sync not confirmed, leaving on the SFT:  {}  ({})'.format(file_name, '; '.join(t.error or t.state for t in tickets)))
+                        folder_confirmed = False
+                        continue
+                    record['stage_seconds']['sync_wait'] = time.monotonic() - stage_started
+
+                    # Time to availability: first seen on the SFT -> placed copy verified on the share
+                    record['available_seconds'] = round(tickets[1].synced_at - arrivals[file_name], 1)
+
+                    stage_started = time.monotonic()
+                    stop_if_lock_lost(lock_lost)
+                    paced_action(sft_actions, delete_element_by_id, driver, file_name, attempts=2)
+                    record['stage_seconds']['delete'] = time.monotonic() - stage_started
+                    record['stage_seconds'] = {k: round(v, 3) for k, v in record['stage_seconds'].items()}
+
+                    # Duplicate row counts from the fingerprint index (None if not checked in time).
+                    # The file is confirmed now, so its rows join the index.
+                    if sidecar_job is not None and duplicate_index is not None:
+                        sidecar_job.confirm()
+                        record['duplicates'] = sidecar_job.duplicates(timeout=objects.get('duplicate_check_timeout_seconds', 5 * 60))
+
+                    # 6.  Record in the run manifest
+                    with governor.write_small(1024, 'manifest'):
+                        run_records.append(manifest.write(record))
+
+                    print('\n\n')
+
+                # Sub-directories (and their contents) are only deleted if every file of the folder made it
+                if not folder_confirmed:
+                    unconfirmed_submitters.add(destination_name)
+                    unsettled_folder_ids.add(id_of_folder_to_click)
+
+                # For all the directories...
+                for dir_name in ([] if destination_name in unconfirmed_submitters else directory_ids):
+
+                    # Delete directory
+                    stop_if_lock_lost(lock_lost)
+                    paced_action(sft_actions, delete_element_by_id, driver, dir_name, attempts=2)
+
+                    print('\n\n')
+
+                # Signature of the emptied folder, read now rather than at the end of the run: a file
+                # arriving in the meantime would otherwise be folded into the settled signature and skipped
+                if destination_name not in unconfirmed_submitters:
+                    tree_nodes_emptied = read_tree(driver)
+                    emptied_node = next((node for node in tree_nodes_emptied if node.id == id_of_folder_to_click), None)
+                    if emptied_node is not None:
+                        emptied_signatures[id_of_folder_to_click] = tree_signature(emptied_node, tree_nodes_emptied)
+
+                # Rest between iterations
+                time.sleep(1.0 / sft_actions.value)
+
+        ####################################################################################
+        # Settle the listing cache with the signatures taken as each folder was emptied
+        ####################################################################################
+
+        # Index this run's manifest records
+        manifest.close()
+
+        # Folders that still hold unconfirmed files must be visited again next run
+        visited_folder_ids = [i for i in visited_folder_ids if i not in unsettled_folder_ids]
+
+        # A folder whose signature moved since it was emptied got something new during the run: left unsettled
+        tree_nodes_after = read_tree(driver)
+        tree_nodes_after_by_id = {node.id: node for node in tree_nodes_after}
+
+        for folder_id in visited_folder_ids:
+            signature = emptied_signatures.get(folder_id)
+            if folder_id in tree_nodes_after_by_id and signature is not None \
+                    and tree_signature(tree_nodes_after_by_id[folder_id], tree_nodes_after) == signature:
+                listing_cache.settle(folder_id, signature)
+
+        listing_cache.save()
+
+    ####################################################################################
+    # Close out
+    ####################################################################################
+
+    finally:
+        driver.close()
+
+        # Finish the conversions first: their sidecars still have to be staged
+        if converter is not None:
+            converter.close()
+            print(converter.report())
+
+        if duplicate_index is not None:
+            duplicate_index.close()
+
+        # Let the sync workers finish.  Anything still unsynced stays on the SFT for the next run.
+        if staging is not None:
+            unsynced = staging.close(timeout=objects.get('sync_timeout_seconds', 30 * 60))
+            print(staging.report())
+            for ticket in unsynced:
+                print('Not synced ({}):  {}  {}'.format(ticket.state, ticket.share_path, ticket.error or ''))
 
-            # 3.  Move to folder
-            move_file( file_name, f'C:/Users/{os.getlogin()}/Downloads/', path_to_destination_dir )
-            wait_for_download(file_name, path_to_destination_dir)
+        print(governor.report())
 
-            # 4.  Delete file
-            delete_element_by_id(driver,file_name)
+        # Metrics of the adaptive limits, and what they learned for the next run
+        for controller in controllers[:2]:
+            print(controller.report())
+        try:
+            save_controller_state(concurrency_state_path, controllers, run_id)
+        except OSError as e:
+            print('Could not save the concurrency state:  {}'.format(str(e)))
 
-            # 5.  Log to archive
-            log_action( todays_date, file_name, destination_name, path_to_destination_dir, copy_filename, '//Sequence Data and Reporting/Submissions/ARCHIVE_copies/'+copy_filename)
-            
-            print('\n\n')
-            
-        # For all the directories...
-        for k in np.arange(0,len(directory_ids)):
-            
-            # Get directory web element id
-            dir_name = directory_ids[k]
-            
-            # Delete directory
-            delete_element_by_id(driver,dir_name)
-            
-            print('\n\n')
-            
-        # Rest between iterations    
-        time.sleep(1)
+    print(availability_report(run_records, objects.get('priority_sla_minutes')))
 
-####################################################################################
-# Close out
-####################################################################################
+    # Remove the run's download directory if everything made it out
+    remove_run_download_directory(dir_downloads)
 
-driver.close()
+    ####################################################################################
+    # Log in our objects file that the last completed date was today
+    ####################################################################################
 
-####################################################################################
-# Log in our objects file that the last completed date was today
-####################################################################################
+    objects = pickle.load( open( settings.objects_path, "rb" ) )
+    objects['last_completed_date'] = str(datetime.datetime.now().date())
+    with governor.write_small(4096, 'objects file'):
+        pickle.dump( objects, open( settings.objects_path, "wb" ) )
 
-objects = pickle.load( open( '//Sequence Data and Reporting/Data_Objects/SFT/sft_objects.p', "rb" ) )
-objects['last_completed_date'] = str(datetime.datetime.now().date())
-pickle.dump( objects, open( '//Sequence Data and Reporting/Data_Objects/SFT/sft_objects.p', "wb" ) )
+    return run_records
 
 ###############################################################################################################
-# Send email
+# Run the pull, then send the daily report.  Goes through the runner so it takes the run lock.
 ###############################################################################################################
 
-# Define todays date
-todays_date_formatted = str(datetime.datetime.now().date())
-todays_date_unformatted = todays_date_formatted.replace('-', '')
-
-# Define path to log file
-path_to_log = '//Sequence Data and Reporting/Submissions/sft_automated_pull_log.csv'
-
-####################################################################################
-#  Basic error handling to make sure that the main script ran successfully
-####################################################################################
-
-# If the script didn't run correctly, this will error out
-if (objects['last_completed_date'] == todays_date_formatted):
-    print('Main script ran succesfully.  Proceeding as normal.')
-
-else:
-    raise ValueError('Morning did not run successfully')
-
-####################################################################################
-# Read in / analyze today's log file for new downloads
-####################################################################################
-
-# Read in the logfile
-logfile = pd.read_csv(path_to_log)
-
-# Query our dataframe to see what we downloaded today.
-### NOTE: Used copy() to avoid warning.  Not essential, but cleans up output.
-todays_downloads = logfile.copy().query('Date == {0}'.format(todays_date_unformatted))
-
-# Count anything we downloaded
-files_downloaded = len(todays_downloads)
-
-if files_downloaded > 0:
-    # Redefine the Logfile's column to be more digestible
-    todays_downloads['Folder'] = todays_downloads['DestinationName']
-
-    # Similarly redefine Logfile column "FileName" to be simpler
-    todays_downloads['File'] = todays_downloads['FileName']
-
-    # Parse out the time that it was downloaded
-    todays_downloads['TimeOfDownload'] = todays_downloads['ArchiveFileName'].str[9:13]
-    todays_downloads['TimeOfDownload'] = todays_downloads['TimeOfDownload'].str[:2] + ':' + todays_downloads[
-                                                                                                'TimeOfDownload'].str[
-                                                                                            -2:]
+if __name__ == '__main__':
 
-    # order our output
-    todays_downloads.sort_values('Folder', inplace=True)
-
-    # Select columns we want to use and set the date as the index
-    todays_downloads = todays_downloads[['Date', 'Folder', 'File', 'TimeOfDownload']]
-    todays_downloads.reset_index(drop=True, inplace=True)
-
-    # Convert to html for email.
-    html_table_foremail = todays_downloads.to_html(classes='table table-striped')
-
-####################################################################################
-# Look for new lab submitters
-####################################################################################
-
-# Find out what was downloaded today vs. what was downloaded before
-todays_downloads = logfile.copy().query('Date == {0}'.format(todays_date_unformatted))
-previous_downloads = logfile.copy().query('Date < {0}'.format(todays_date_unformatted))
-
-# Using set differences, find out any first-submission-drops based on our log file.
-new_submitters = list(
-    set(todays_downloads['DestinationName'].tolist()) - set(previous_downloads['DestinationName'].tolist()))
-
-# Initialize empty list, will go into email as empty if no new submission folders located.
-html_new_submitters = ''
-
-# Looping through each new submitter, format the correct header2 to potentially use in the email.
-for i in np.arange(0, len(new_submitters)):
-    html_new_submitters += '<h2 style="text-align: left;"><span style="color: #DE3163;">Please review first submission:  {}</span></h2>'.format(
-        new_submitters[i])
-
-####################################################################################
-# Send email
-####################################################################################
+    import sys
+    from sft_run import main
 
-# Define subject and recipients
-email_subject = 'Sequencing SFT Pull: Daily Report'
-email_recipients = ['']
-
-# Define the email body.  Old header color - #3366ff
-##########################
-
-if files_downloaded > 0:
-
-    email_body = '''
-    <h1 style="text-align: left;"><span style="color: #6495ED;">SFT Pull Report: {date_today}</span></h1>
-    {header2}
-    <p>Hello,</p>
-    <p>See the table below for all files pulled from the SFT today.  Times are represented in a 24-hour format.</p>
-    {table}
-    <p>Have a great day!</p>
-    <p>-DIQA Epis</p>
-     '''.format(header2=html_new_submitters, date_today=todays_date_formatted, table=html_table_foremail)
-
-else:
-    email_body = '''
-    <h1 style="text-align: center;"><span style="color: #3366ff;">SFT Pull Report: {date_today}</span></h1>
-    <p>Hello,</p>
-    <p>There were no files found in the SFT today.</p>
-    <p>Have a great day!</p>
-    <p>-DIQA Epis</p>
-     '''.format(date_today=todays_date_formatted)
-
-# SEND THE EMAIL!!!
-
-msg = MIMEText(email_body, 'html')
-msg['Subject'] = email_subject
-msg['From'] = 'your.name@your.email.address'
-msg['To'] = ", ".join(email_recipients)
-
-# Send the message via our own SMTP server.
-s = smtplib.SMTP('your.mail.server')
-s.send_message(msg)
-s.quit()
+    sys.exit(main())
@@ -0,0 +1,389 @@
+# -*- coding: utf-8 -*-
+"""
+Run manifest for the SFT pull.
+
+Every file the pull places is recorded as one JSON line in an append-only manifest
+(sft_manifest.jsonl) with a global, monotonically increasing sequence number.  A small
+index (sft_manifest_index.json) stores each run's sequence range and byte offset, so a
+consumer holding a cursor (the last seq it processed) can seek straight to new records
+instead of re-walking the Submissions / Completed_Submissions trees.
+"""
+###############################################################################################################
+###############################################################################################################
+
+import os
+import json
+import uuid
+import hashlib
+import datetime
+
+MANIFEST_FILENAME = 'sft_manifest.jsonl'
+INDEX_FILENAME = 'sft_manifest_index.json'
+CURSOR_DIRECTORY = 'cursors'
+
+# Text formats whose rows we count by newlines while hashing
+LINE_COUNTED_EXTENSIONS = ('.csv', '.tsv', '.txt', '.tab')
+
+###############################################################################################################
+###############################################################################################################
+
+####################################################################################
+# Run IDs
+####################################################################################
+
+def new_run_id():
+
+    '''
+    (Python)
+
+    Unique, sortable id for a pull run, e.g. '20210831T140102-3f9a1c'.
+    '''
+
+    return '{}-{}'.format(datetime.datetime.now().strftime('%Y%m%dT%H%M%S'), uuid.uuid4().hex[:6])
+
+###############################################################################################################
+###############################################################################################################
+
+####################################################################################
+# Describing a file: size, hash and row count in one streaming pass
+####################################################################################
+
+def count_xlsx_rows(path):
+
+    '''
+    (Python)
+
+    Data rows (excluding one header row per sheet) across all sheets of a workbook.
+    Uses the sheet dimensions in read-only mode, so the cells themselves are not loaded.
+    Returns None if openpyxl isn't installed or the workbook can't be read.
+    '''
+
+    try:
+        import openpyxl
+    except ImportError:
+        return None
+
+    try:
+        workbook = openpyxl.load_workbook(path, read_only=True)
+        try:
+            return sum(max((sheet.max_row or 0) - 1, 0) for sheet in workbook.worksheets)
+        finally:
+            workbook.close()
+    except Exception as e:
+        print('Could not count rows in {}:  {}'.format(path, str(e)))
+        return None
+
+
+def describe_file(path, chunk_size=1024 * 1024):
+
+    '''
+    (Python)
+
+    Size, sha256 and row count of a file.  Text files are hashed and line-counted in the
+    same streaming pass; FASTA files count records ('>' header lines); XLSX rows come
+    from the sheet dimensions.  Other formats get row_count None.
+
+    --------------------------------------------------------------------------------------
+
+    Keyword arguments:
+    path -- full path of the file
+    chunk_size -- bytes per read
+
+    --------------------------------------------------------------------------------------
+
+    Returns:
+    dict with keys size, sha256, row_count
+
+    --------------------------------------------------------------------------------------
+
+    Example:
+    describe_file('C:/tmp/sft_downloads/20210831_140102/metadata.csv')
+    # -> {'size': 5120, 'sha256': '9f86d0...', 'row_count': 96}
+    '''
+
+    extension = os.path.splitext(path)[1].lower()
+    count_lines = extension in LINE_COUNTED_EXTENSIONS
+    count_fasta = extension in ('.fasta', '.fa', '.fna')
+
+    sha = hashlib.sha256()
+    size = 0
+    newlines = 0
+    records = 0
+    last_byte = b'\n'
+
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha.update(chunk)
+            size += len(chunk)
+            if count_lines:
+                newlines += chunk.count(b'\n')
+            if count_fasta:
+                # '>' at the start of a line.  Chunk boundaries are handled through last_byte.
+                records += chunk.count(b'\n>') + (1 if last_byte == b'\n' and chunk[:1] == b'>' else 0)
+            last_byte = chunk[-1:]
+
+    row_count = None
+    if count_lines:
+        # Count an unterminated last line, then drop the header
+        lines = newlines + (1 if size > 0 and last_byte != b'\n' else 0)
+        row_count = max(lines - 1, 0)
+    elif count_fasta:
+        row_count = records
+    elif extension in ('.xlsx', '.xlsm'):
+        row_count = count_xlsx_rows(path)
+
+    return {'size': size, 'sha256': sha.hexdigest(), 'row_count': row_count}
+
+###############################################################################################################
+###############################################################################################################
+
+####################################################################################
+# Index helpers
+####################################################################################
+
+def read_index(manifest_directory):
+    '''Loads the manifest index, or an empty one.'''
+
+    path = os.path.join(manifest_directory, INDEX_FILENAME)
+    if not os.path.exists(path):
+        return {'last_seq': 0, 'end_offset': 0, 'runs': []}
+
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def _write_json_atomic(path, data):
+
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w') as f:
+        json.dump(data, f, indent=1)
+    os.replace(temp_path, path)
+
+
+def _scan_tail(manifest_path, offset):
+    '''Records written after the indexed end offset (e.g. by a run that crashed before closing).'''
+
+    if not os.path.exists(manifest_path):
+        return
+
+    with open(manifest_path, 'rb') as f:
+        f.seek(offset)
+        for line in f:
+            # Skip blank lines and a half-written line left by a crash
+            if line.endswith(b'\n') and line.strip():
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    continue
+
+###############################################################################################################
+###############################################################################################################
+
+####################################################################################
+# Writing the manifest
+####################################################################################
+
+class ManifestWriter:
+
+    '''
+    (Python)
+
+    Appends one JSON line per placed file to the run manifest and updates the index when closed.
+    Records are flushed as they are written, so a crashed run still leaves its records behind.
+
+    --------------------------------------------------------------------------------------
+
+    Keyword arguments:
+    manifest_directory -- folder holding sft_manifest.jsonl and its index
+    run_id -- id of the current run (see new_run_id())
+
+    --------------------------------------------------------------------------------------
+
+    Example:
+    manifest = ManifestWriter('//Sequence Data and Reporting/Submissions/manifest/', new_run_id())
+    manifest.write({'submitter': 'LAB_A', 'file_name': 'metadata.csv', ...})
+    manifest.close()
+    '''
+
+    def __init__(self, manifest_directory, run_id):
+
+        os.makedirs(manifest_directory, exist_ok=True)
+
+        self.manifest_directory = manifest_directory
+        self.manifest_path = os.path.join(manifest_directory, MANIFEST_FILENAME)
+        self.run_id = run_id
+        self.started_at = datetime.datetime.now().isoformat(timespec='seconds')
+        self.index = read_index(manifest_directory)
+
+        # Index records a crashed run wrote after the last index update
+        self._recover_tail()
+
+        self.next_seq = self.index['last_seq'] + 1
+        self.first_seq = None
+
+        self._file = open(self.manifest_path, 'ab')
+        self.start_offset = self._file.tell()
+
+    def _recover_tail(self):
+
+        if not os.path.exists(self.manifest_path):
+            return
+
+        recovered = {}
+        with open(self.manifest_path, 'rb') as f:
+            f.seek(self.index['end_offset'])
+            offset = f.tell()
+            line = b'\n'
+            for line in f:
+                try:
+                    record = json.loads(line) if line.endswith(b'\n') and line.strip() else None
+                except ValueError:
+                    record = None
+                if record is not None:
+                    run = recovered.setdefault(record['run_id'], {
+                        'run_id': record['run_id'], 'first_seq': record['seq'], 'offset': offset,
+                        'started_at': None, 'finished_at': None, 'recovered': True})
+                    run['last_seq'] = record['seq']
+                    self.index['last_seq'] = max(self.index['last_seq'], record['seq'])
+                offset += len(line)
+
+        # Terminate a half-written last line so our first record starts on a fresh line
+        if not line.endswith(b'\n'):
+            with open(self.manifest_path, 'ab') as f:
+                f.write(b'\n')
+            offset += 1
+
+        self.index['runs'].extend(recovered.values())
+        self.index['end_offset'] = offset
+
+    def write(self, record):
+        '''Stamps the record with run_id, seq and recorded_at, appends it and returns it.'''
+
+        record = dict(record)
+        record['run_id'] = self.run_id
+        record['seq'] = self.next_seq
+        record.setdefault('recorded_at', datetime.datetime.now().isoformat(timespec='seconds'))
+
+        self._file.write((json.dumps(record, default=str) + '\n').encode('utf-8'))
+        self._file.flush()
+
+        if self.first_seq is None:
+            self.first_seq = self.next_seq
+        self.next_seq += 1
+
+        return record
+
+    def close(self):
+        '''Closes the manifest and records this run's range in the index.'''
+
+        end_offset = self._file.tell()
+        self._file.close()
+
+        # Runs that placed nothing don't get an index entry, but still advance end_offset
+        if self.first_seq is not None:
+            self.index['runs'].append({
+                'run_id': self.run_id,
+                'first_seq': self.first_seq,
+                'last_seq': self.next_seq - 1,
+                'offset': self.start_offset,
+                'started_at': self.started_at,
+                'finished_at': datetime.datetime.now().isoformat(timespec='seconds'),
+            })
+
+        self.index['last_seq'] = self.next_seq - 1
+        self.index['end_offset'] = end_offset
+        _write_json_atomic(os.path.join(self.manifest_directory, INDEX_FILENAME), self.index)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+###############################################################################################################
+###############################################################################################################
+
+####################################################################################
+# Reading the manifest incrementally
+####################################################################################
+
+def read_since(manifest_directory, cursor=0):
+
+    '''
+    (Python)
+
+    Manifest records with seq greater than cursor.  Seeks to the first run that can
+    contain them using the index, so cost is proportional to the new records only.
+
+    --------------------------------------------------------------------------------------
+
+    Keyword arguments:
+    manifest_directory -- folder holding sft_manifest.jsonl and its index
+    cursor -- last seq already processed (0 for everything)
+
+    --------------------------------------------------------------------------------------
+
+    Returns:
+    (list of records, new cursor)
+
+    --------------------------------------------------------------------------------------
+
+    Example:
+    records, cursor = read_since(manifest_dir, load_cursor(manifest_dir, 'roster_compile'))
+    ...process records...
+    save_cursor(manifest_dir, 'roster_compile', cursor)
+    '''
+
+    index = read_index(manifest_directory)
+    manifest_path = os.path.join(manifest_directory, MANIFEST_FILENAME)
+
+    # Offset of the first indexed run holding anything newer than the cursor, else the indexed end
+    offset = next((run['offset'] for run in index['runs'] if run['last_seq'] > cursor), index['end_offset'])
+
+    records = [r for r in _scan_tail(manifest_path, offset) if r['seq'] > cursor]
+    new_cursor = max([cursor] + [r['seq'] for r in records])
+
+    return records, new_cursor
+
+
+def cursor_for_date(manifest_directory, date):
+
+    '''
+    (Python)
+
+    Cursor just before the first run that finished on or after date (a datetime.date).
+    read_since() with it returns that day's records onwards without reading older runs.
+    '''
+
+    day = date.isoformat()
+    cursor = 0
+
+    for run in read_index(manifest_directory)['runs']:
+        # Recovered runs have no timestamps.  Stop there to be safe.
+        finished = run.get('finished_at')
+        if finished is None or finished[:10] >= day:
+            break
+        cursor = run['last_seq']
+
+    return cursor
+
+
+def load_cursor(manifest_directory, consumer):
+    '''Last seq processed by a named consumer (0 if it has never run).'''
+
+    path = os.path.join(manifest_directory, CURSOR_DIRECTORY, consumer + '.json')
+    if not os.path.exists(path):
+        return 0
+
+    with open(path, 'r') as f:
+        return json.load(f)['cursor']
+
+
+def save_cursor(manifest_directory, consumer, cursor):
+    '''Stores the last seq processed by a named consumer.'''
+
+    cursor_directory = os.path.join(manifest_directory, CURSOR_DIRECTORY)
+    os.makedirs(cursor_directory, exist_ok=True)
+
+    _write_json_atomic(os.path.join(cursor_directory, consumer + '.json'),
+                       {'cursor': cursor, 'saved_at': datetime.datetime.now().isoformat(timespec='seconds')})
@@ -0,0 +1,591 @@
+# -*- coding: utf-8 -*-
+"""
+Notification transport for the SFT scripts.
+
+One Notifier queues messages and sends them from a background thread in batches through
+a pluggable transport, so the pull never waits on mail.  Repeat alerts inside a window
+are dropped.  Transports:
+
+SMTPTransport -- pooled, reusable connections with STARTTLS
+MaildirTransport -- local maildir (readable with any mail client)
+FileTransport -- one .eml file per message in a folder
+OutlookTransport -- the original Outlook/win32com path, for Windows desktops
+LocalSMTPServer -- in-process SMTP stand-in that records what it receives (for testing)
+"""
+###############################################################################################################
+###############################################################################################################
+
+import os
+import time
+import json
+import queue
+import hashlib
+import smtplib
+import mailbox
+import tempfile
+import threading
+import socketserver
+from email.message import EmailMessage
+from email import message_from_bytes
+from email.utils import formatdate, make_msgid
+
+###############################################################################################################
+###############################################################################################################
+
+####################################################################################
+# Building a message
+####################################################################################
+
+def build_message(subject, recipients, html_content, text_content=None, sender=''):
+
+    '''
+    (Python)
+
+    Builds an email with an HTML body and an optional plain-text alternative.
+
+    --------------------------------------------------------------------------------------
+
+    Keyword arguments:
+    subject -- subject line
+    recipients -- list of email addresses
+    html_content -- HTML body
+    text_content -- optional plain-text body shown by clients that don't render HTML
+    sender -- From address
+
+    --------------------------------------------------------------------------------------
+
+    Example:
+    msg = build_message('test email', ['youremailhere@gmail.com'], '<p>Hello World!.</p>')
+    '''
+
+    msg = EmailMessage()
+    msg['Subject'] = subject
+    msg['From'] = sender
+    msg['To'] = ', '.join(recipients)
+    msg['Date'] = formatdate(localtime=True)
+    msg['Message-ID'] = make_msgid()
+
+    if text_content is not None:
+        msg.set_content(text_content)
+        msg.add_alternative(html_content, subtype='html')
+    else:
+        msg.set_content(html_content, subtype='html')
+
+    return msg
+
+###############################################################################################################
+###############################################################################################################
+
+####################################################################################
+# Transports
+####################################################################################
+
+class SMTPTransport:
+
+    '''
+    (Python)
+
+    Sends through an SMTP server, reusing a small pool of open connections.
+    Connections are checked with NOOP before reuse and dropped after idle_timeout seconds.
+
+    --------------------------------------------------------------------------------------
+
+    Keyword arguments:
+    host, port -- SMTP server
+    starttls -- upgrade the connection with STARTTLS ('auto' only does so if the server offers it)
+    username, password -- optional SMTP AUTH credentials
+    pool_size -- maximum number of open connections
+    idle_timeout -- seconds an unused connection is kept open
+    timeout -- socket timeout in seconds
+    '''
+
+    def __init__(self, host, port=25, starttls=True, username=None, password=None,
+                 pool_size=2, idle_timeout=60, timeout=30):
+        self.host = host
+        self.port = port
+        self.starttls = starttls
+        self.username = username
+        self.password = password
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(pool_size)
+
+    def _connect(self):
+
+        connection = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        connection.ehlo()
+
+        if self.starttls is True or (self.starttls == 'auto' and connection.has_extn('starttls')):
+            connection.starttls()
+            connection.ehlo()
+
+        if self.username:
+            connection.login(self.username, self.password)
+
+        return connection
+
+    def _acquire(self):
+
+        self._slots.acquire()
+
+        # Reuse the most recently used connection that is still alive
+        while True:
+            try:
+                connection, last_used = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            if time.monotonic() - last_used > self.idle_timeout:
+                self._quit(connection)
+                continue
+            try:
+                if connection.noop()[0] == 250:
+                    return connection
+            except smtplib.SMTPException:
+                pass
+            except OSError:
+                pass
+            self._quit(connection)
+
+        try:
+            return self._connect()
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def _release(self, connection, healthy=True):
+
+        if healthy:
+            self._idle.put((connection, time.monotonic()))
+        else:
+            self._quit(connection)
+        self._slots.release()
+
+    @staticmethod
+    def _quit(connection):
+        try:
+            connection.quit()
+        except (smtplib.SMTPException, OSError):
+            pass
+
+    def send_many(self, messages):
+        '''Sends a batch of messages over one pooled connection.'''
+
+        connection = self._acquire()
+        try:
+            for msg in messages:
+                connection.send_message(msg)
+        except BaseException:
+            self._release(connection, healthy=False)
+            raise
+        self._release(connection)
+
+    def close(self):
+        while True:
+            try:
+                connection, _ = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            self._quit(connection)
+
+
+class MaildirTransport:
+
+    '''
+    (Python)
+
+    Delivers messages into a local maildir.
+
+    --------------------------------------------------------------------------------------
+
+    Keyword arguments:
+    path -- maildir folder (created if missing)
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self._maildir = mailbox.Maildir(path, create=True)
+
+    def send_many(self, messages):
+        for msg in messages:
+            self._maildir.add(msg)
+
+    def close(self):
+        pass
+
+
+class FileTransport:
+
+    '''
+    (Python)
+
+    Writes each message as a .eml file into a folder.
+
+    --------------------------------------------------------------------------------------
+
+    Keyword arguments:
+    path -- output folder (created if missing)
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def send_many(self, messages):
+        for msg in messages:
+            name = '{}_{}.eml'.format(time.strftime('%Y%m%d_%H%M%S'), hashlib.sha1(bytes(msg)).hexdigest()[:10])
+            with open(os.path.join(self.path, name), 'wb') as f:
+                f.write(bytes(msg))
+
+    def close(self):
+        pass
+
+
+class OutlookTransport:
+
+    '''
+    (Python)
+
+    Sends through the locally installed Outlook client (Windows only).  win32com is imported on first use.
+    '''
+
+    def send_many(self, messages):
+
+        import win32com.client as win32
+
+        outlook = win32.Dispatch('outlook.application')
+
+        for msg in messages:
+            mail = outlook.CreateItem(0)
+            mail.To = ';'.join(a.strip() for a in msg['To'].split(','))
+            mail.Subject = msg['Subject']
+            html = msg.get_body(preferencelist=('html',))
+            mail.HTMLBody = html.get_content() if html is not None else msg.get_body().get_content()
+            mail.Send()
+
+    def close(self):
+        pass
+
+###############################################################################################################
+###############################################################################################################
+
+####################################################################################
+# Local SMTP stand-in
+####################################################################################
+
+class _SMTPSinkHandler(socketserver.StreamRequestHandler):
+
+    def _reply(self, line):
+        self.wfile.write((line + '\r\n').encode('ascii'))
+
+    def handle(self):
+
+        self._reply('220 localhost SFT test SMTP ready')
+        sender, recipients = None, []
+
+        for raw in self.rfile:
+            command = raw.decode('utf-8', 'replace').strip()
+            verb = command[:4].upper()
+
+            if verb in ('EHLO', 'HELO'):
+                self._reply('250 localhost')
+            elif verb == 'MAIL':
+                sender, recipients = command[10:].strip('<> '), []
+                self._reply('250 OK')
+            elif verb == 'RCPT':
+                recipients.append(command[8:].strip('<> '))
+                self._reply('250 OK')
+            elif verb == 'DATA':
+                self._reply('354 End data with <CR><LF>.<CR><LF>')
+                lines = []
+                for data_line in self.rfile:
+                    if data_line in (b'.\r\n', b'.\n'):
+                        break
+                    # Undo dot-stuffing
+                    lines.append(data_line[1:] if data_line.startswith(b'..') else data_line)
+                self.server.messages.append({'sender': sender, 'recipients': recipients,
+                                             'message': message_from_bytes(b''.join(lines))})
+                self._reply('250 OK')
+            elif verb in ('RSET', 'NOOP'):
+                self._reply('250 OK')
+            elif verb == 'QUIT':
+                self._reply('221 Bye')
+                return
+            else:
+                self._reply('502 Command not implemented')
+
+
+class LocalSMTPServer(socketserver.ThreadingTCPServer):
+
+    '''
+    (Python)
+
+    Minimal SMTP server on localhost that records every message it receives in .messages.
+    Stand-in for the real mail server when trying the notifier out.
+
+    --------------------------------------------------------------------------------------
+
+    Example:
+    with LocalSMTPServer() as server:
+        notifier = Notifier(SMTPTransport('127.0.0.1', server.port, starttls=False))
+        notifier.notify('test', ['a@b.c'], '<p>hi</p>')
+        notifier.close()
+        server.messages[0]['message']['Subject']   # -> 'test'
+    '''
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, host='127.0.0.1', port=0):
+        super().__init__((host, port), _SMTPSinkHandler)
+        self.messages = []
+        self.port = self.server_address[1]
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+
+    def __exit__(self, *exc):
+        self.shutdown()
+        super().__exit__(*exc)
+
+###############################################################################################################
+###############################################################################################################
+
+####################################################################################
+# Notifier: queueing, batching, de-duplication
+####################################################################################
+
+class Notifier:
+
+    '''
+    (Python)
+
+    Queues messages and sends them in batches from a background thread.  The same
+    alert (subject + recipients + body) is only sent once per dedup_window seconds.  An
+    alert counts as sent once the transport has taken it; one that failed can be sent again.
+
+    --------------------------------------------------------------------------------------
+
+    Keyword arguments:
+    transport -- any transport above
+    sender -- From address
+    batch_size -- maximum messages handed to the transport at once
+    flush_interval -- seconds to wait for more messages before sending a partial batch
+    dedup_window -- seconds within which a repeat alert is dropped
+    dedup_path -- optional JSON file so de-duplication also works across runs
+    max_retries -- attempts per batch before it is given up on
+
+    --------------------------------------------------------------------------------------
+
+    Example:
+    notifier = Notifier(SMTPTransport('smtp.example.org', 587), sender='sft@example.org')
+    notifier.notify('SFT pull failed', ['epi@example.org'], '<p>Login timed out</p>')
+    notifier.close()    # waits for the queue to drain; returns how many messages were not sent
+    '''
+
+    def __init__(self, transport, sender='', batch_size=20, flush_interval=2.0, dedup_window=3600,
+                 dedup_path=None, max_retries=3):
+        self.transport = transport
+        self.sender = sender
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.dedup_window = dedup_window
+        self.dedup_path = dedup_path
+        self.max_retries = max_retries
+        self.sent = 0
+        self.failed = 0
+        self.deduplicated = 0
+        self._recent = self._load_recent()
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._worker, name='sft-notifier', daemon=True)
+        self._thread.start()
+
+    # ---- de-duplication ----
+
+    def _load_recent(self):
+        if self.dedup_path and os.path.exists(self.dedup_path):
+            try:
+                with open(self.dedup_path, 'r') as f:
+                    return json.load(f)
+            except (OSError, ValueError):
+                pass
+        return {}
+
+    def _save_recent(self):
+        if self.dedup_path:
+            temp_path = self.dedup_path + '.tmp'
+            with open(temp_path, 'w') as f:
+                json.dump(self._recent, f)
+            os.replace(temp_path, self.dedup_path)
+
+    def _is_repeat(self, key):
+        '''True if the alert was sent within the window or is queued now.  Otherwise marks it queued.'''
+
+        now = time.time()
+        with self._lock:
+            self._recent = {k: t for k, t in self._recent.items() if now - t < self.dedup_window}
+            if key in self._recent or key in self._pending:
+                return True
+            self._pending.add(key)
+        return False
+
+    def _settle(self, keys, sent):
+        '''Releases queued alerts.  Only sent ones are remembered (and saved); failed ones may be sent again.'''
+
+        keys = [k for k in keys if k is not None]
+        if not keys:
+            return
+
+        now = time.time()
+        with self._lock:
+            self._pending.difference_update(keys)
+            if sent:
+                self._recent.update((k, now) for k in keys)
+                self._save_recent()
+
+    # ---- public interface ----
+
+    def notify(self, subject, recipients, html_content, text_content=None, dedup=True):
+        '''Queues a message and returns immediately.  Returns False if it was dropped as a repeat.'''
+
+        key = None
+        if dedup:
+            key = hashlib.sha256('\x1f'.join([subject, ','.join(recipients), html_content]).encode('utf-8')).hexdigest()
+            if self._is_repeat(key):
+                self.deduplicated += 1
+                print('Notification suppressed (repeat within {}s):  {}'.format(self.dedup_window, subject))
+                return False
+
+        self._queue.put((build_message(subject, recipients, html_content, text_content, self.sender), key))
+        return True
+
+    def flush(self):
+        '''Blocks until everything queued so far has been handed to the transport.'''
+        self._queue.join()
+
+    def close(self):
+        '''Flushes, stops the worker thread and closes the transport.  Returns the number of messages that failed.'''
+        self.flush()
+        self._queue.put(None)
+        self._thread.join()
+        self.transport.close()
+        return self.failed
+
+    # ---- worker ----
+
+    def _send_batch(self, batch):
+
+        messages = [message for message, _ in batch]
+        keys = [key for _, key in batch]
+
+        for attempt in range(1, self.max_retries + 1):
+            try:
+                self.transport.send_many(messages)
+                self.sent += len(batch)
+                print('Email Successfully Sent!  ({} message(s))'.format(len(batch)))
+                self._settle(keys, sent=True)
+                return
+            except Exception as e:
+                # Anything the transport raises (SMTP, socket, Outlook COM errors) must not kill the worker
+                print('Email send failed (attempt {} of {}):  {}: {}'.format(attempt, self.max_retries, type(e).__name__, str(e)))
+                time.sleep(min(2 ** attempt, 30))
+
+        self.failed += len(batch)
+        self._settle(keys, sent=False)
+
+    def _worker(self):
+
+        stopping = False
+        while not stopping:
+
+            first = self._queue.get()
+            if first is None:
+                self._queue.task_done()
+                return
+
+            # Gather whatever else arrives within the flush interval, up to a full batch
+            batch = [first]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                try:
+                    item = self._queue.get(timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+                if item is None:
+                    stopping = True
+                    self._queue.task_done()
+                    break
+                batch.append(item)
+
+            try:
+                self._send_batch(batch)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+###############################################################################################################
+###############################################################################################################
+
+####################################################################################
+# Building a transport from config
+####################################################################################
+
+def transport_from_config(config):
+
+    '''
+    (Python)
+
+    Builds a transport from a settings dict (e.g. the sft_objects.p objects).
+
+    Keys:
+    notify_backend -- 'smtp', 'maildir', 'file' or 'outlook'.  Defaults to 'smtp' when
+                      smtp_host is set, else 'outlook' on Windows, else 'file'.
+    smtp_host, smtp_port, smtp_starttls, smtp_username, smtp_password -- SMTP settings
+    notify_path -- folder for the maildir / file backends (default <tmp>/sft_outbox)
+
+    --------------------------------------------------------------------------------------
+
+    Example:
+    transport = transport_from_config({'smtp_host': 'smtp.example.org', 'smtp_port': 587})
+    '''
+
+    backend = config.get('notify_backend')
+    if backend is None:
+        backend = 'smtp' if config.get('smtp_host') else ('outlook' if os.name == 'nt' else 'file')
+
+    notify_path = config.get('notify_path') or os.path.join(tempfile.gettempdir(), 'sft_outbox')
+
+    if backend == 'smtp':
+        return SMTPTransport(config['smtp_host'],
+                             port=config.get('smtp_port', 25),
+                             starttls=config.get('smtp_starttls', True),
+                             username=config.get('smtp_username'),
+                             password=config.get('smtp_password'))
+    if backend == 'maildir':
+        return MaildirTransport(notify_path)
+    if backend == 'file':
+        return FileTransport(notify_path)
+    if backend == 'outlook':
+        return OutlookTransport()
+
+    raise ValueError('Unknown notify_backend:  {}'.format(backend))
+
+
+def notifier_from_config(config):
+
+    '''
+    Notifier built from the same settings dict as transport_from_config() (plus email_sender, notify_dedup_*).
+    email_sender is required except for Outlook, which sends from the signed-in account.
+    '''
+
+    transport = transport_from_config(config)
+    sender = config.get('email_sender') or ''
+    if not sender.strip() and not isinstance(transport, OutlookTransport):
+        transport.close()
+        raise ValueError('email_sender is not set (required for the {} backend)'.format(type(transport).__name__))
+
+    return Notifier(transport,
+                    sender=sender,
+                    dedup_window=config.get('notify_dedup_window', 3600),
+                    dedup_path=config.get('notify_dedup_path'))
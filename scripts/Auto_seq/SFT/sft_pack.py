@@ -0,0 +1,667 @@
+# -*- coding: utf-8 -*-
+"""
+Cold tier for ARCHIVE_copies: monthly pack files.
+
+Archive copies older than N days are moved into one append-only tar per pull month,
+
+    <archive_directory>/packs/archive-2021-08.tar
+    <archive_directory>/packs/archive-2021-08.tar.idx     (SQLite: name -> offset, size, sha256)
+
+so backups and listings of the share see a few large files instead of years of small
+ones.  The packs are plain uncompressed tar (`tar -xf archive-2021-08.tar <name>` works),
+but nothing needs to scan them: the archive name starts with the pull date, which picks
+the pack, and the pack's index gives the member's byte offset, so one copy is read with
+one index lookup and one seek.
+
+Packing runs incrementally (--max-minutes), a month at a time in small batches.  A batch
+is appended, fsynced, read back and checked, and only then recorded in the index and the
+loose copies deleted; a packer that dies mid-batch leaves the loose copies in place and
+the next run writes over the unrecorded tail.  Recent copies (the hot tier) are never
+touched.
+
+    python sft_pack.py --days 90 --max-minutes 60
+    python sft_pack.py --extract 20210815_101500_LAB_A_metadata.csv --output ./restored.csv
+"""
+###############################################################################################################
+###############################################################################################################
+
+import os
+import time
+import pickle
+import sqlite3
+import tarfile
+import hashlib
+import datetime
+import argparse
+import urllib.parse
+
+PACK_PREFIX = 'archive-'
+PACK_SUFFIX = '.tar'
+INDEX_SUFFIX = '.idx'
+COMPACT_SUFFIX = '.compact'
+
+BLOCK_SIZE = tarfile.BLOCKSIZE
+CHUNK_SIZE = 4 * 1024 * 1024
+
+# Loose copies appended per index commit
+BATCH_FILES = 200
+
+###############################################################################################################
+###############################################################################################################
+
+####################################################################################
+# Layout
+####################################################################################
+
+def default_pack_directory(objects, archive_directory):
+    '''archive_pack_directory from the objects file, or packs/ inside ARCHIVE_copies.'''
+
+    return objects.get('archive_pack_directory', os.path.join(archive_directory, 'packs', ''))
+
+
+def pack_month(archive_name):
+    '''YYYY-MM of an archive copy named 'YYYYMMDD_HHMMSS_<name>', or None for other names.'''
+
+    if len(archive_name) > 16 and archive_name[:8].isdigit() and archive_name[8] == '_':
+        return '{}-{}'.format(archive_name[:4], archive_name[4:6])
+
+    return None
+
+
+def pack_path(pack_directory, month):
+    return os.path.join(pack_directory, PACK_PREFIX + month + PACK_SUFFIX)
+
+
+class PackIndex:
+
+    '''
+    (Python)
+
+    A pack's offset index: members (name -> data offset, size, sha256, mtime) and the
+    offset where the next member goes.  Rollback journal, since it lives on the share.
+
+    --------------------------------------------------------------------------------------
+
+    Keyword arguments:
+    path -- index file (the pack path + '.idx')
+    read_only -- open the file read-only (lookups only; nothing is created or written)
+    '''
+
+    def __init__(self, path, read_only=False):
+        self.path = path
+
+        if read_only:
+            self.connection = sqlite3.connect(_read_only_uri(path), uri=True)
+            return
+
+        self.connection = sqlite3.connect(path)
+        self.connection.execute('''CREATE TABLE IF NOT EXISTS members (
+                                       name TEXT PRIMARY KEY,
+                                       offset INTEGER NOT NULL,
+                                       size INTEGER NOT NULL,
+                                       sha256 TEXT NOT NULL,
+                                       mtime REAL,
+                                       packed_at TEXT NOT NULL) WITHOUT ROWID''')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+        self.connection.commit()
+
+    @property
+    def end(self):
+        '''Offset just past the last recorded member (where the end-of-archive blocks start).'''
+
+        row = self.connection.execute("SELECT value FROM meta WHERE key = 'end'").fetchone()
+        return int(row[0]) if row else 0
+
+    def lookup(self, name):
+        '''(offset, size, sha256) of a member, or None.'''
+
+        return self.connection.execute('SELECT offset, size, sha256 FROM members WHERE name = ?', (name,)).fetchone()
+
+    def members(self):
+        '''{name: (size, mtime)} of every member.'''
+
+        return {name: (size, mtime) for name, size, mtime in self.connection.execute('SELECT name, size, mtime FROM members')}
+
+    def add(self, rows, end):
+        '''Records appended members [(name, offset, size, sha256, mtime)] and the new end, in one transaction.'''
+
+        now = datetime.datetime.now().isoformat(timespec='seconds')
+        with self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO members VALUES (?, ?, ?, ?, ?, ?)',
+                                        ((name, offset, size, sha256, mtime, now) for name, offset, size, sha256, mtime in rows))
+            self.connection.execute("INSERT OR REPLACE INTO meta VALUES ('end', ?)", (str(end),))
+
+    def remove(self, names):
+        '''Drops members from the index (their bytes stay in the pack until compact_pack()).  Returns bytes dropped.'''
+
+        removed = 0
+        with self.connection:
+            for name in names:
+                found = self.lookup(name)
+                if found is not None:
+                    removed += found[1]
+                    self.connection.execute('DELETE FROM members WHERE name = ?', (name,))
+            self.connection.execute("INSERT OR REPLACE INTO meta VALUES ('removed_bytes', ?)",
+                                    (str(self.removed_bytes + removed),))
+
+        return removed
+
+    @property
+    def removed_bytes(self):
+        '''Bytes of removed members still taking space in the pack.'''
+
+        row = self.connection.execute("SELECT value FROM meta WHERE key = 'removed_bytes'").fetchone()
+        return int(row[0]) if row else 0
+
+    @property
+    def live_bytes(self):
+        '''Bytes of the members still in the index.'''
+
+        return self.connection.execute('SELECT COALESCE(SUM(size), 0) FROM members').fetchone()[0]
+
+    def close(self):
+        self.connection.close()
+
+
+def _read_only_uri(path):
+    '''SQLite URI opening path read-only (also for Windows drive and UNC paths).'''
+
+    path = os.path.abspath(path).replace('\\', '/')
+    return 'file://{}{}?mode=ro'.format('' if path.startswith('/') else '/', urllib.parse.quote(path, safe='/:'))
+
+
+def open_index(pack_directory, month, create=False, read_only=False):
+
+    '''
+    (Python)
+
+    The PackIndex of a month's pack, or None if there is no pack (and create is False).
+
+    A compaction that died part way leaves '.compact' files behind.  Writers, which hold
+    pack_lock, clean them up here.  Readers (read_only) change nothing and open whichever
+    index matches the pack on disk, so scrub, reconcile and --extract can run at any time.
+    '''
+
+    pack = pack_path(pack_directory, month)
+    path = pack + INDEX_SUFFIX
+
+    if os.path.exists(path + COMPACT_SUFFIX):
+        if os.path.exists(pack + COMPACT_SUFFIX):
+            # Died before swapping in the new pack: the old pack and index are still current
+            if not read_only:
+                os.remove(pack + COMPACT_SUFFIX)
+                os.remove(path + COMPACT_SUFFIX)
+        elif read_only:
+            # The new pack is in place but its index isn't yet: read the new index
+            path += COMPACT_SUFFIX
+        else:
+            # Died after swapping in the new pack but before its index: finish it
+            os.replace(path + COMPACT_SUFFIX, path)
+
+    if (read_only or not create) and not os.path.exists(path):
+        return None
+
+    return PackIndex(path, read_only=read_only)
+
+
+def pack_lock(pack_directory, label):
+    '''sft_run.RunLock next to the packs, held by anything that appends to, compacts or prunes the archive.'''
+
+    from sft_run import RunLock
+
+    return RunLock(os.path.join(pack_directory, 'sft_pack.lock'), '{}-{:%Y%m%d_%H%M%S}'.format(label, datetime.datetime.now()))
+
+###############################################################################################################
+###############################################################################################################
+
+####################################################################################
+# Reading packed copies
+####################################################################################
+
+def locate(pack_directory, archive_name):
+
+    '''
+    (Python)
+
+    Where a packed archive copy is: one index lookup in its month's pack.
+
+    --------------------------------------------------------------------------------------
+
+    Returns:
+    (pack path, data offset, size, sha256), or None if the copy isn't packed
+    '''
+
+    month = pack_month(archive_name)
+    index = open_index(pack_directory, month, read_only=True) if month else None
+    if index is None:
+        return None
+
+    try:
+        found = index.lookup(archive_name)
+    finally:
+        index.close()
+
+    return (pack_path(pack_directory, month),) + tuple(found) if found else None
+
+
+def iter_packed(pack_directory, archive_name, chunk_size=CHUNK_SIZE, bucket=None):
+    '''Yields the bytes of a packed archive copy in chunks (KeyError if it isn't packed).'''
+
+    found = locate(pack_directory, archive_name)
+    if found is None:
+        raise KeyError(archive_name)
+
+    path, offset, size, _ = found
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        remaining = size
+        while remaining:
+            chunk = f.read(min(chunk_size, remaining))
+            if not chunk:
+                raise EOFError('{} ends inside {}'.format(path, archive_name))
+            if bucket is not None:
+                bucket.consume(len(chunk))
+            remaining -= len(chunk)
+            yield chunk
+
+
+def extract(pack_directory, archive_name, output_path):
+
+    '''
+    (Python)
+
+    Copies one packed archive copy out to output_path, checking its sha256.  Returns the
+    bytes written.
+    '''
+
+    found = locate(pack_directory, archive_name)
+    if found is None:
+        raise KeyError(archive_name)
+    expected = found[3]
+
+    sha = hashlib.sha256()
+    temp_path = output_path + '.part'
+    with open(temp_path, 'wb') as out:
+        for chunk in iter_packed(pack_directory, archive_name):
+            sha.update(chunk)
+            out.write(chunk)
+
+    if sha.hexdigest() != expected:
+        os.remove(temp_path)
+        raise IOError('{} is corrupted in its pack (sha256 {}, expected {})'.format(archive_name, sha.hexdigest(), expected))
+
+    os.replace(temp_path, output_path)
+
+    return os.path.getsize(output_path)
+
+
+def verify_packed(pack_directory, archive_name, size, sha256, bucket=None):
+
+    '''
+    (Python)
+
+    sft_scrub.verify_object() for a packed copy: same states, checked against the
+    manifest's size and sha256 (or the pack index's when the manifest has none).
+    '''
+
+    from sft_scrub import OK, MISSING, TRUNCATED, GROWN, CORRUPTED, UNREADABLE
+
+    found = locate(pack_directory, archive_name)
+    if found is None:
+        return MISSING, None
+
+    path, _, packed_size, packed_sha256 = found
+    if size is not None and packed_size != size:
+        return (TRUNCATED if packed_size < size else GROWN), 'packed {} bytes, expected {}'.format(packed_size, size)
+
+    sha = hashlib.sha256()
+    try:
+        for chunk in iter_packed(pack_directory, archive_name, bucket=bucket):
+            sha.update(chunk)
+    except (OSError, EOFError) as e:
+        return UNREADABLE, '{}: {}'.format(path, e)
+
+    if sha.hexdigest() != (sha256 or packed_sha256):
+        return CORRUPTED, 'packed sha256 {}, expected {}'.format(sha.hexdigest(), sha256 or packed_sha256)
+
+    return OK, None
+
+
+def packed_copies(pack_directory):
+    '''{archive name: (size, mtime)} of every packed copy (reads each month's index).'''
+
+    copies = {}
+    if not os.path.isdir(pack_directory):
+        return copies
+
+    for name in sorted(os.listdir(pack_directory)):
+        if name.startswith(PACK_PREFIX) and name.endswith(PACK_SUFFIX + INDEX_SUFFIX):
+            index = open_index(pack_directory, name[len(PACK_PREFIX):-len(PACK_SUFFIX + INDEX_SUFFIX)], read_only=True)
+            if index is None:
+                continue
+            try:
+                copies.update(index.members())
+            finally:
+                index.close()
+
+    return copies
+
+###############################################################################################################
+###############################################################################################################
+
+####################################################################################
+# Packing
+####################################################################################
+
+def _append_member(pack, source_path, name, governor):
+
+    '''
+    Writes one tar member (header, data, padding) at the pack's current position.
+    Returns (data offset, size, sha256, mtime).
+    '''
+
+    stat = os.stat(source_path)
+    info = tarfile.TarInfo(name)
+    info.size = stat.st_size
+    info.mtime = int(stat.st_mtime)
+    info.mode = 0o644
+
+    pack.write(info.tobuf(tarfile.PAX_FORMAT, 'utf-8', 'surrogateescape'))
+    offset = pack.tell()
+
+    sha = hashlib.sha256()
+    with governor.write_slot(stat.st_size, name), open(source_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            governor.throttle(len(chunk))
+            sha.update(chunk)
+            pack.write(chunk)
+
+    if stat.st_size % BLOCK_SIZE:
+        pack.write(b'\0' * (BLOCK_SIZE - stat.st_size % BLOCK_SIZE))
+
+    return offset, stat.st_size, sha.hexdigest(), stat.st_mtime
+
+
+def _read_back(pack, offset, size):
+    '''sha256 of size bytes at offset, re-read from the pack file.'''
+
+    sha = hashlib.sha256()
+    pack.seek(offset)
+    remaining = size
+    while remaining:
+        chunk = pack.read(min(CHUNK_SIZE, remaining))
+        if not chunk:
+            break
+        sha.update(chunk)
+        remaining -= len(chunk)
+
+    return sha.hexdigest()
+
+
+def pack_batch(pack_directory, month, batch, governor):
+
+    '''
+    (Python)
+
+    Appends a batch of loose archive copies to a month's pack, then deletes the copies.
+
+    --------------------------------------------------------------------------------------
+
+    Keyword arguments:
+    pack_directory -- folder holding the packs
+    month -- YYYY-MM
+    batch -- list of (archive name, loose path)
+    governor -- sft_governor.IOGovernor for the share writes
+
+    --------------------------------------------------------------------------------------
+
+    Returns:
+    (files packed, bytes packed)
+    '''
+
+    index = open_index(pack_directory, month, create=True)
+    path = pack_path(pack_directory, month)
+
+    try:
+        # Already recorded (a run that died between committing and deleting): just drop the loose copy
+        todo = []
+        for name, loose_path in batch:
+            if index.lookup(name) is None:
+                todo.append((name, loose_path))
+            else:
+                os.remove(loose_path)
+
+        if not todo:
+            return 0, 0
+
+        with open(path, 'r+b' if os.path.exists(path) else 'w+b') as pack:
+            pack.seek(index.end)
+            rows = [(name,) + _append_member(pack, loose_path, name, governor) for name, loose_path in todo]
+            end = pack.tell()
+
+            # End-of-archive marker, then drop anything an interrupted run left past it
+            pack.write(b'\0' * (2 * BLOCK_SIZE))
+            pack.truncate()
+            pack.flush()
+            os.fsync(pack.fileno())
+
+            for name, offset, size, sha256, _ in rows:
+                if _read_back(pack, offset, size) != sha256:
+                    raise IOError('{} did not read back intact from {}'.format(name, path))
+
+        index.add(rows, end)
+    finally:
+        index.close()
+
+    for _, loose_path in todo:
+        os.remove(loose_path)
+
+    return len(rows), sum(row[2] for row in rows)
+
+
+def cold_copies(archive_directory, older_than_days, today=None):
+    '''{month: [(archive name, loose path)]} of the loose archive copies pulled more than older_than_days ago.'''
+
+    cutoff = ((today or datetime.date.today()) - datetime.timedelta(days=older_than_days)).strftime('%Y%m%d')
+
+    months = {}
+    with os.scandir(archive_directory) as entries:
+        for entry in entries:
+            month = pack_month(entry.name)
+            if month and entry.name[:8] < cutoff and entry.is_file() and not entry.name.endswith('.part'):
+                months.setdefault(month, []).append((entry.name, entry.path))
+
+    for copies in months.values():
+        copies.sort()
+
+    return dict(sorted(months.items()))
+
+
+def pack_archive(archive_directory, pack_directory, older_than_days=90, max_seconds=None, batch_files=BATCH_FILES,
+                 governor=None, dry_run=False):
+
+    '''
+    (Python)
+
+    Moves cold archive copies into their monthly packs, oldest month first, until done
+    or out of time.
+
+    --------------------------------------------------------------------------------------
+
+    Keyword arguments:
+    archive_directory -- ARCHIVE_copies
+    pack_directory -- folder for the packs and their indexes
+    older_than_days -- copies pulled more recently than this stay loose (the hot tier)
+    max_seconds -- stop starting new batches after this long
+    batch_files -- copies appended per index commit
+    governor -- sft_governor.IOGovernor (default: the shared one)
+    dry_run -- only count what would be packed
+
+    --------------------------------------------------------------------------------------
+
+    Returns:
+    dict with files, bytes, months (YYYY-MM -> files), remaining, seconds
+    '''
+
+    from sft_governor import get_governor
+
+    governor = governor or get_governor()
+    started = time.monotonic()
+    months = cold_copies(archive_directory, older_than_days)
+
+    summary = {'files': 0, 'bytes': 0, 'months': {}, 'remaining': sum(len(c) for c in months.values())}
+    if dry_run:
+        summary['months'] = {month: len(copies) for month, copies in months.items()}
+        summary['seconds'] = time.monotonic() - started
+        return summary
+
+    os.makedirs(pack_directory, exist_ok=True)
+
+    for month, copies in months.items():
+        for start in range(0, len(copies), batch_files):
+            if max_seconds is not None and time.monotonic() - started > max_seconds:
+                summary['seconds'] = time.monotonic() - started
+                return summary
+
+            files, num_bytes = pack_batch(pack_directory, month, copies[start:start + batch_files], governor)
+            summary['files'] += files
+            summary['bytes'] += num_bytes
+            summary['months'][month] = summary['months'].get(month, 0) + files
+            summary['remaining'] -= len(copies[start:start + batch_files])
+
+    summary['seconds'] = time.monotonic() - started
+
+    return summary
+
+
+def compact_pack(pack_directory, month, governor=None):
+
+    '''
+    (Python)
+
+    Rewrites a month's pack without the members removed from its index (see
+    PackIndex.remove), then swaps the new pack and index in.  Returns bytes reclaimed.
+    '''
+
+    from sft_governor import get_governor
+
+    governor = governor or get_governor()
+    index = open_index(pack_directory, month)
+    if index is None or not index.removed_bytes:
+        if index is not None:
+            index.close()
+        return 0
+
+    path = pack_path(pack_directory, month)
+    before = os.path.getsize(path)
+    live = index.connection.execute('SELECT name, offset, size, sha256, mtime FROM members ORDER BY offset').fetchall()
+    index.close()
+
+    temp_index = PackIndex(path + INDEX_SUFFIX + COMPACT_SUFFIX)
+    rows = []
+    try:
+        with open(path, 'rb') as old, open(path + COMPACT_SUFFIX, 'w+b') as new, \
+                governor.write_slot(before, 'compact ' + month):
+            for name, offset, size, sha256, mtime in live:
+                info = tarfile.TarInfo(name)
+                info.size = size
+                info.mtime = int(mtime or 0)
+                info.mode = 0o644
+                new.write(info.tobuf(tarfile.PAX_FORMAT, 'utf-8', 'surrogateescape'))
+                rows.append((name, new.tell(), size, sha256, mtime))
+
+                old.seek(offset)
+                remaining = size
+                while remaining:
+                    chunk = old.read(min(CHUNK_SIZE, remaining))
+                    governor.throttle(len(chunk))
+                    new.write(chunk)
+                    remaining -= len(chunk)
+                if size % BLOCK_SIZE:
+                    new.write(b'\0' * (BLOCK_SIZE - size % BLOCK_SIZE))
+
+            end = new.tell()
+            new.write(b'\0' * (2 * BLOCK_SIZE))
+            new.flush()
+            os.fsync(new.fileno())
+
+            for name, offset, size, sha256, _ in rows:
+                if _read_back(new, offset, size) != sha256:
+                    raise IOError('{} did not read back intact from the compacted {}'.format(name, path))
+
+        temp_index.add(rows, end)
+    finally:
+        temp_index.close()
+
+    # New pack first; the next writer's open_index() finishes the swap if we die in between
+    os.replace(path + COMPACT_SUFFIX, path)
+    os.replace(path + INDEX_SUFFIX + COMPACT_SUFFIX, path + INDEX_SUFFIX)
+
+    return before - os.path.getsize(path)
+
+###############################################################################################################
+###############################################################################################################
+
+####################################################################################
+# Command line
+####################################################################################
+
+def main(argv=None):
+
+    '''
+    (Python)
+
+    Command line for the packer (also `sft pack`).  Holds a lock next to the packs so two
+    packers never append to the same pack.
+    '''
+
+    parser = argparse.ArgumentParser(description='Move cold ARCHIVE_copies into monthly pack files, or extract from them.')
+    parser.add_argument('--days', type=int, default=None, help='pack copies older than this (default: archive_pack_after_days, 90)')
+    parser.add_argument('--max-minutes', type=float, default=None, help='stop after this long and continue next time')
+    parser.add_argument('--dry-run', action='store_true', help='only show what would be packed')
+    parser.add_argument('--extract', metavar='ARCHIVE_NAME', help='copy one packed archive copy out and exit')
+    parser.add_argument('--output', help='where --extract writes (default: the archive name, here)')
+    args = parser.parse_args(argv)
+
+    from sft_settings import get_settings
+    settings = get_settings()
+    objects = pickle.load(open(settings.objects_path, 'rb'))
+    pack_directory = default_pack_directory(objects, settings.archive_directory)
+
+    if args.extract:
+        num_bytes = extract(pack_directory, args.extract, args.output or args.extract)
+        print('Extracted {} ({} bytes)'.format(args.output or args.extract, num_bytes))
+        return 0
+
+    from sft_run import LockHeld
+
+    os.makedirs(pack_directory, exist_ok=True)
+    lock = pack_lock(pack_directory, 'pack')
+    try:
+        lock.acquire()
+    except LockHeld as e:
+        print(e)
+        return 75
+
+    try:
+        summary = pack_archive(settings.archive_directory, pack_directory,
+                               older_than_days=args.days if args.days is not None else objects.get('archive_pack_after_days', 90),
+                               max_seconds=args.max_minutes * 60 if args.max_minutes else None,
+                               dry_run=args.dry_run)
+    finally:
+        lock.release()
+
+    if args.dry_run:
+        print('Would pack {} file(s)'.format(summary['remaining']))
+    else:
+        print('Packed {} file(s), {:.1f} MB in {:.1f}s; {} cold file(s) left for the next run'.format(
+            summary['files'], summary['bytes'] / 1024 / 1024, summary['seconds'], summary['remaining']))
+    for month, files in summary['months'].items():
+        print('  {}  {}'.format(month, files))
+
+    return 0
+
+
+if __name__ == '__main__':
+    import sys
+    sys.exit(main())
@@ -0,0 +1,715 @@
+# -*- coding: utf-8 -*-
+"""
+Parsing of the SFT file browser's HTML.
+
+Turns the directory tree ('allFiles_Tree::') and the file list ('filelist-grid') into
+structured node lists.  Attributes are read per element, so an id is always paired with
+its own aria-expanded flag and there is no cap on folder size.
+
+On a live page the nodes are read with one execute_script call that walks the DOM in the
+browser and returns plain rows (no outerHTML is sent over the wire or parsed).  For HTML
+text, a regex pass over the few tags that matter is used when the markup is plain
+(double-quoted attributes); anything else goes through the standard library's HTML
+tokenizer, which is slower but handles any markup.
+"""
+###############################################################################################################
+###############################################################################################################
+
+import re
+import html
+import time
+import datetime
+from dataclasses import dataclass
+from html.parser import HTMLParser
+
+# Every directory in the tree has an id starting with this prefix.  The bare prefix is the tree root.
+TREE_ID_PREFIX = 'allFiles_Tree::'
+
+# Precompiled patterns for the file list cells
+SIZE_PATTERN = re.compile(r'^\s*([\d.,]+)\s*(bytes|b|kb|mb|gb|tb)\s*$', re.IGNORECASE)
+SIZE_UNITS = {'bytes': 1, 'b': 1, 'kb': 1024, 'mb': 1024 ** 2, 'gb': 1024 ** 3, 'tb': 1024 ** 4}
+DATE_PATTERN = re.compile(r'^\d{1,4}[/-]\d{1,2}[/-]\d{1,4}')
+# The month/day/year forms the SFT displays, read without strptime (the bulk of a large folder's parse time)
+US_DATE_PATTERN = re.compile(r'^(\d{1,2})/(\d{1,2})/(\d{4})(?: (\d{1,2}):(\d{2})(?::(\d{2}))?(?: ([AaPp][Mm]))?)?$')
+DATE_FORMATS = ('%m/%d/%Y %I:%M %p', '%m/%d/%Y %I:%M:%S %p', '%m/%d/%Y %H:%M', '%m/%d/%Y %H:%M:%S',
+                '%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%dT%H:%M:%S', '%m/%d/%Y', '%Y-%m-%d')
+
+# Attributes that may carry size / modification time
+TREE_SIZE_ATTRS = ('data-size', 'data-bytes')
+TREE_MTIME_ATTRS = ('data-mtime', 'data-modified', 'data-date')
+ROW_ATTRS = ('data-size', 'data-mtime', 'data-modified')
+
+# Regex fast path: tags that matter, their attributes, and markup it can't read (then the tokenizer is used)
+TREE_ATTR_PATTERN = re.compile(r'(id|aria-expanded)="([^"]*)"')
+ROW_INDEX_PATTERN = re.compile(r'index="')
+ATTR_PATTERN = re.compile(r'([\w:.-]+)="([^"]*)"')
+DIV_TAG_PATTERN = re.compile(r'<(/?)div\b', re.IGNORECASE)
+TEXT_PATTERN = re.compile(r'>([^<]+)')
+COMMENT_PATTERN = re.compile(r'<!--.*?-->', re.DOTALL)
+UNQUOTED_ATTRIBUTE = re.compile(r'=\s*[^\s"]')
+RAW_TEXT_TAG = re.compile(r'<(?:script|style|textarea)\b', re.IGNORECASE)
+
+###############################################################################################################
+###############################################################################################################
+
+####################################################################################
+# Node record
+####################################################################################
+
+@dataclass
+class SFTNode:
+
+    '''
+    (Python)
+
+    One entry of the SFT file browser: a directory in the tree or a file/folder in the file list.
+
+    --------------------------------------------------------------------------------------
+
+    Attributes:
+    id -- web element id.  For files this is also the file name.
+    depth -- nesting level.  Top-level SFT folders are depth 1.
+    expanded -- tree only: True/False from aria-expanded, None if not exposed
+    is_directory -- True for folders
+    name -- display name (last path component for tree nodes)
+    size -- size in bytes, if the page exposes it
+    mtime -- modification time as ISO string, if the page exposes it
+    '''
+
+    id: str
+    depth: int
+    expanded: object = None
+    is_directory: bool = False
+    name: str = ''
+    size: object = None
+    mtime: object = None
+
+    @property
+    def path_parts(self):
+        '''Tree nodes: the folder path split into its components, e.g. ['LAB', 'Sub'].'''
+        return self.id[len(TREE_ID_PREFIX):].split(':')
+
+###############################################################################################################
+###############################################################################################################
+
+####################################################################################
+# Cell value helpers
+####################################################################################
+
+def parse_size(text):
+
+    '''
+    (Python)
+
+    Converts a displayed size ('12 KB', '1,024 bytes', '3.5 MB') to bytes.  Returns None if it isn't a size.
+    '''
+
+    if text is None:
+        return None
+
+    # Sizes start with a number; names and most other cells stop here
+    text = str(text).strip()
+    if not text or text[0] not in '0123456789.,':
+        return None
+
+    # Plain integers (e.g. from a data-size attribute)
+    stripped = text.replace(',', '')
+    if stripped.isdigit():
+        return int(stripped)
+
+    match = SIZE_PATTERN.match(text)
+    if match is None:
+        return None
+
+    return int(float(match.group(1).replace(',', '')) * SIZE_UNITS[match.group(2).lower()])
+
+
+def parse_mtime(text):
+
+    '''
+    (Python)
+
+    Converts a displayed timestamp to an ISO 8601 string.  Returns None if it isn't a recognised date.
+    '''
+
+    if text is None:
+        return None
+
+    text = str(text).strip()
+    if not text[:1].isdigit():
+        return None
+    text = ' '.join(text.split())
+
+    # Cheap rejection of anything that doesn't start like a date
+    if DATE_PATTERN.match(text) is None:
+        return None
+
+    match = US_DATE_PATTERN.match(text)
+    if match is not None:
+        month, day, year, hour, minute, second, meridiem = match.groups()
+        hour = int(hour or 0)
+        if meridiem is not None:
+            if not 1 <= hour <= 12:
+                return None
+            hour = hour % 12 + (12 if meridiem.lower() == 'pm' else 0)
+        try:
+            return datetime.datetime(int(year), int(month), int(day), hour, int(minute or 0), int(second or 0)).isoformat()
+        except ValueError:
+            return None
+
+    # Try the format that matched last time first.  A page uses one format throughout.
+    for fmt in _date_formats:
+        try:
+            value = datetime.datetime.strptime(text, fmt).isoformat()
+        except ValueError:
+            continue
+        if fmt is not _date_formats[0]:
+            _date_formats.remove(fmt)
+            _date_formats.insert(0, fmt)
+        return value
+
+    return None
+
+
+# Formats in the order parse_mtime() tries them
+_date_formats = list(DATE_FORMATS)
+
+###############################################################################################################
+###############################################################################################################
+
+####################################################################################
+# Building nodes (shared by the DOM, regex and tokenizer paths)
+####################################################################################
+
+def _tree_node(element_id, expanded, size=None, mtime=None):
+    '''A directory node from its element id, aria-expanded text and size/mtime attribute values.'''
+
+    path = element_id[len(TREE_ID_PREFIX):]
+    return SFTNode(id=element_id,
+                   depth=path.count(':') + 1,
+                   expanded=None if expanded is None else expanded.lower() == 'true',
+                   is_directory=True,
+                   name=path.split(':')[-1],
+                   size=parse_size(size),
+                   mtime=mtime)
+
+
+def _file_node(element_id, texts, data_size, data_mtime, depth):
+    '''A file list node from its element id, cell texts and data-size / data-mtime attribute values.'''
+
+    # Size / mtime: explicit attributes first, else the first cell that looks like one
+    size = parse_size(data_size)
+    if size is None:
+        size = next((s for s in map(parse_size, texts) if s is not None), None)
+
+    mtime = parse_mtime(data_mtime)
+    if mtime is None:
+        mtime = next((m for m in map(parse_mtime, texts) if m is not None), None)
+
+    # Folders in the file list have ids starting with ':'
+    is_directory = element_id.startswith(':')
+
+    return SFTNode(id=element_id,
+                   depth=depth,
+                   is_directory=is_directory,
+                   name=texts[0] if texts else element_id,
+                   size=None if is_directory else size,
+                   mtime=mtime)
+
+
+def _plain_markup(text):
+    '''True if every attribute value in text is double-quoted and nothing holds raw text (the fast paths' assumptions).'''
+    return UNQUOTED_ATTRIBUTE.search(text) is None and RAW_TEXT_TAG.search(text) is None
+
+
+def _attributes(tag):
+    return {name.lower(): html.unescape(value) if '&' in value else value for name, value in ATTR_PATTERN.findall(tag)}
+
+###############################################################################################################
+###############################################################################################################
+
+####################################################################################
+# Directory tree parser
+####################################################################################
+
+class _TreeParser(HTMLParser):
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.nodes = []
+        self._awaiting_expanded = None
+
+    def handle_starttag(self, tag, attrs):
+
+        attrs = dict(attrs)
+        element_id = attrs.get('id') or ''
+        expanded = attrs.get('aria-expanded')
+
+        # A directory node (the bare prefix is the root and isn't a node)
+        if element_id.startswith(TREE_ID_PREFIX) and len(element_id) > len(TREE_ID_PREFIX):
+
+            node = _tree_node(element_id, expanded,
+                              next((attrs[a] for a in TREE_SIZE_ATTRS if a in attrs), None),
+                              next((attrs[a] for a in TREE_MTIME_ATTRS if a in attrs), None))
+            self.nodes.append(node)
+
+            # If the flag isn't on the same element, take the next one seen before another node starts
+            self._awaiting_expanded = node if expanded is None else None
+            return
+
+        if expanded is not None and self._awaiting_expanded is not None:
+            self._awaiting_expanded.expanded = expanded.lower() == 'true'
+            self._awaiting_expanded = None
+
+
+def _parse_tree_fast(tree_html):
+    '''parse_tree() for plain markup: only the id / aria-expanded attributes are found, and the tags they sit in.'''
+
+    nodes = []
+    awaiting_expanded = None
+    with_data = 'data-' in tree_html
+
+    # (tag start, id, aria-expanded) per tag carrying either, in page order
+    tags = []
+    for match in TREE_ATTR_PATTERN.finditer(tree_html):
+        position = match.start()
+        if not tree_html[position - 1].isspace():
+            continue
+        tag_start = tree_html.rfind('<', 0, position)
+        if tag_start < 0 or tree_html.find('>', tag_start, position) >= 0:
+            continue
+        if not tags or tags[-1][0] != tag_start:
+            tags.append([tag_start, None, None])
+        tags[-1][1 if match.group(1) == 'id' else 2] = match.group(2)
+
+    for tag_start, element_id, expanded in tags:
+        element_id = html.unescape(element_id) if element_id and '&' in element_id else (element_id or '')
+
+        if element_id.startswith(TREE_ID_PREFIX) and len(element_id) > len(TREE_ID_PREFIX):
+            attrs = _attributes(tree_html[tag_start:tree_html.find('>', tag_start)]) if with_data else {}
+            node = _tree_node(element_id, expanded,
+                              next((attrs[a] for a in TREE_SIZE_ATTRS if a in attrs), None),
+                              next((attrs[a] for a in TREE_MTIME_ATTRS if a in attrs), None))
+            nodes.append(node)
+            awaiting_expanded = node if expanded is None else None
+        elif expanded is not None and awaiting_expanded is not None:
+            awaiting_expanded.expanded = expanded.lower() == 'true'
+            awaiting_expanded = None
+
+    return nodes
+
+
+def parse_tree(tree_html):
+
+    '''
+    (Python)
+
+    Parses the outerHTML of the 'allFiles_Tree::' element into a list of directory nodes, in page order.
+    Plain markup takes a regex pass over the relevant tags; other markup the HTML tokenizer.
+
+    --------------------------------------------------------------------------------------
+
+    Keyword arguments:
+    tree_html -- outerHTML of driver.find_element_by_id('allFiles_Tree::')
+
+    --------------------------------------------------------------------------------------
+
+    Example:
+    tree_html = driver.find_element_by_id('allFiles_Tree::').get_attribute('outerHTML')
+    unopened = [node.id for node in parse_tree(tree_html) if node.expanded is False]
+
+    --------------------------------------------------------------------------------------
+
+    Dependencies:
+    from html.parser import HTMLParser
+    '''
+
+    if '<!--' in tree_html:
+        tree_html = COMMENT_PATTERN.sub('', tree_html)
+    if _plain_markup(tree_html):
+        return _parse_tree_fast(tree_html)
+
+    parser = _TreeParser()
+    parser.feed(tree_html)
+    parser.close()
+
+    return parser.nodes
+
+###############################################################################################################
+###############################################################################################################
+
+####################################################################################
+# File list parser
+####################################################################################
+
+class _FileListParser(HTMLParser):
+
+    def __init__(self, depth):
+        super().__init__(convert_charrefs=True)
+        self.depth = depth
+        self.nodes = []
+        self._row_attrs = None
+        self._row_id = None
+        self._row_texts = []
+        self._div_depth = 0
+
+    def handle_starttag(self, tag, attrs):
+
+        attrs = dict(attrs)
+
+        # Start of a row.  Rows are divs carrying an 'index' attribute.
+        if self._row_attrs is None:
+            if tag == 'div' and 'index' in attrs:
+                self._row_attrs = attrs
+                self._row_id = attrs.get('id')
+                self._row_texts = []
+                self._div_depth = 1
+            return
+
+        # Inside a row: the first id we meet is the element id
+        if tag == 'div':
+            self._div_depth += 1
+        if self._row_id is None and attrs.get('id'):
+            self._row_id = attrs['id']
+
+        # Remember size/mtime attributes wherever they appear in the row
+        for key in ROW_ATTRS:
+            if key in attrs and key not in self._row_attrs:
+                self._row_attrs[key] = attrs[key]
+
+    def handle_endtag(self, tag):
+
+        if self._row_attrs is None or tag != 'div':
+            return
+
+        self._div_depth -= 1
+        if self._div_depth == 0:
+            self._finish_row()
+
+    def handle_data(self, data):
+        if self._row_attrs is not None and data.strip():
+            self._row_texts.append(data.strip())
+
+    def close(self):
+        super().close()
+        # Unterminated last row (truncated HTML)
+        if self._row_attrs is not None:
+            self._finish_row()
+
+    def _finish_row(self):
+
+        attrs, texts, element_id = self._row_attrs, self._row_texts, self._row_id
+        self._row_attrs, self._row_id, self._row_texts = None, None, []
+
+        if not element_id:
+            return
+
+        self.nodes.append(_file_node(element_id, texts, attrs.get('data-size'),
+                                     attrs.get('data-mtime') or attrs.get('data-modified'), self.depth))
+
+
+def _row_end(chunk):
+    '''Length of a row's HTML within chunk (up to the div closing the row), or None if it isn't closed.'''
+
+    depth = 0
+    for match in DIV_TAG_PATTERN.finditer(chunk):
+        depth += -1 if match.group(1) else 1
+        if depth == 0:
+            return match.end()
+
+    return None
+
+
+def _row_starts(filelist_html):
+    '''Offsets of the opening tags of rows (divs carrying an 'index' attribute).'''
+
+    starts = []
+    for match in ROW_INDEX_PATTERN.finditer(filelist_html):
+        position = match.start()
+        if not filelist_html[position - 1].isspace():
+            continue
+        tag_start = filelist_html.rfind('<', 0, position)
+        if filelist_html[tag_start:tag_start + 4].lower() == '<div' and filelist_html.find('>', tag_start, position) < 0:
+            starts.append(tag_start)
+
+    return starts
+
+
+def _first_attribute(chunk, name):
+    '''Value of the first name="..." attribute in chunk, or None.'''
+
+    needle = name + '="'
+    position = chunk.find(needle)
+    while position > 0 and not chunk[position - 1].isspace():
+        position = chunk.find(needle, position + 1)
+    if position <= 0:
+        return None
+
+    value = chunk[position + len(needle):chunk.index('"', position + len(needle))]
+    return html.unescape(value) if '&' in value else value
+
+
+def _parse_file_list_fast(filelist_html, depth):
+    '''
+    parse_file_list() for plain markup: the HTML is cut at each row's opening tag and each piece read with
+    string searches.  Returns None if a row is still open where the next one starts (nested rows), which
+    only the tokenizer reads the same way.
+    '''
+
+    nodes = []
+    starts = _row_starts(filelist_html) + [len(filelist_html)]
+
+    for start, end in zip(starts, starts[1:]):
+        chunk = filelist_html[start:end]
+
+        # The row ends at its own closing div; text after it isn't the row's
+        row_end = _row_end(chunk)
+        if row_end is None and end != len(filelist_html):
+            return None
+        chunk = chunk[:row_end]
+
+        # The row's own id, else the first id inside it
+        element_id = _first_attribute(chunk, 'id')
+        if not element_id:
+            continue
+
+        values = {key: _first_attribute(chunk, key) for key in ROW_ATTRS if key in chunk}
+        texts = [html.unescape(t.strip()) if '&' in t else t.strip() for t in TEXT_PATTERN.findall(chunk) if not t.isspace()]
+
+        nodes.append(_file_node(element_id, texts, values.get('data-size'),
+                                values.get('data-mtime') or values.get('data-modified'), depth))
+
+    return nodes
+
+
+def parse_file_list(filelist_html, depth=0):
+
+    '''
+    (Python)
+
+    Parses the outerHTML of the 'filelist-grid' element into a list of file/folder nodes, in page order.
+    Plain markup takes a regex pass cut at each row; other markup the HTML tokenizer.
+
+    --------------------------------------------------------------------------------------
+
+    Keyword arguments:
+    filelist_html -- outerHTML of driver.find_element_by_id('filelist-grid')
+    depth -- depth to record on the nodes (the depth of the folder being listed + 1)
+
+    --------------------------------------------------------------------------------------
+
+    Example:
+    filelist_html = driver.find_element_by_id('filelist-grid').get_attribute('outerHTML')
+    nodes = parse_file_list(filelist_html)
+    file_ids = [node.id for node in nodes if not node.is_directory]
+
+    --------------------------------------------------------------------------------------
+
+    Dependencies:
+    from html.parser import HTMLParser
+    '''
+
+    if '<!--' in filelist_html:
+        filelist_html = COMMENT_PATTERN.sub('', filelist_html)
+    if _plain_markup(filelist_html):
+        nodes = _parse_file_list_fast(filelist_html, depth)
+        if nodes is not None:
+            return nodes
+
+    parser = _FileListParser(depth)
+    parser.feed(filelist_html)
+    parser.close()
+
+    return parser.nodes
+
+###############################################################################################################
+###############################################################################################################
+
+####################################################################################
+# Driver helpers
+####################################################################################
+
+# Run in the browser: one row per element of interest, read straight from the DOM.  Same rules as the parsers above.
+READ_TREE_SCRIPT = '''
+var root = document.getElementById('allFiles_Tree::');
+if (!root) { return null; }
+var prefix = 'allFiles_Tree::', rows = [], awaiting = null;
+var first = function (el, names) {
+    for (var i = 0; i < names.length; i++) { if (el.hasAttribute(names[i])) { return el.getAttribute(names[i]); } }
+    return null;
+};
+var elements = [root].concat(Array.prototype.slice.call(root.getElementsByTagName('*')));
+for (var i = 0; i < elements.length; i++) {
+    var el = elements[i], id = el.getAttribute('id') || '', expanded = el.getAttribute('aria-expanded');
+    if (id.indexOf(prefix) === 0 && id.length > prefix.length) {
+        var row = [id, expanded, first(el, arguments[0]), first(el, arguments[1])];
+        rows.push(row);
+        awaiting = expanded === null ? row : null;
+    } else if (expanded !== null && awaiting !== null) {
+        awaiting[1] = expanded;
+        awaiting = null;
+    }
+}
+return rows;
+'''
+
+READ_FILE_LIST_SCRIPT = '''
+var grid = document.getElementById('filelist-grid');
+if (!grid) { return null; }
+var rows = [], names = arguments[0];
+var candidates = (grid.matches('div[index]') ? [grid] : []).concat(Array.prototype.slice.call(grid.querySelectorAll('div[index]')));
+for (var i = 0; i < candidates.length; i++) {
+    var row = candidates[i];
+    if (row !== grid && row.parentElement.closest('div[index]') && grid.contains(row.parentElement.closest('div[index]'))) { continue; }
+    var id = row.getAttribute('id') || null, attrs = {}, texts = [];
+    var inner = row.getElementsByTagName('*');
+    for (var n = 0; n < names.length; n++) { if (row.hasAttribute(names[n])) { attrs[names[n]] = row.getAttribute(names[n]); } }
+    for (var j = 0; j < inner.length; j++) {
+        if (!id && inner[j].getAttribute('id')) { id = inner[j].getAttribute('id'); }
+        for (var n = 0; n < names.length; n++) {
+            if (!(names[n] in attrs) && inner[j].hasAttribute(names[n])) { attrs[names[n]] = inner[j].getAttribute(names[n]); }
+        }
+    }
+    var walker = document.createTreeWalker(row, NodeFilter.SHOW_TEXT, null, false);
+    while (walker.nextNode()) {
+        var text = walker.currentNode.nodeValue.trim();
+        if (text) { texts.push(text); }
+    }
+    if (id) { rows.push([id, texts, attrs]); }
+}
+return rows;
+'''
+
+
+def _execute_rows(driver, script, *arguments):
+    '''Rows from one of the scripts above, or None if the driver can't run it (then the outerHTML is parsed).'''
+
+    try:
+        rows = driver.execute_script(script, *arguments)
+    except Exception:
+        return None
+
+    return rows if isinstance(rows, list) else None
+
+
+def read_tree(driver):
+    '''Snapshot and parse the directory tree of the current page.'''
+
+    rows = _execute_rows(driver, READ_TREE_SCRIPT, list(TREE_SIZE_ATTRS), list(TREE_MTIME_ATTRS))
+    if rows is None:
+        return parse_tree(driver.find_element_by_id('allFiles_Tree::').get_attribute('outerHTML'))
+
+    return [_tree_node(element_id, expanded, size, mtime) for element_id, expanded, size, mtime in rows]
+
+
+def read_file_list(driver, depth=0):
+    '''Snapshot and parse the file list of the currently opened folder.'''
+
+    rows = _execute_rows(driver, READ_FILE_LIST_SCRIPT, list(ROW_ATTRS))
+    if rows is None:
+        return parse_file_list(driver.find_element_by_id('filelist-grid').get_attribute('outerHTML'), depth)
+
+    return [_file_node(element_id, texts, attrs.get('data-size'), attrs.get('data-mtime') or attrs.get('data-modified'), depth)
+            for element_id, texts, attrs in rows]
+
+###############################################################################################################
+###############################################################################################################
+
+####################################################################################
+# Benchmark against the old regex approach
+####################################################################################
+
+def _synthetic_tree(num_labs, subfolders_per_lab):
+
+    parts = ['<ul id="allFiles_Tree::" aria-expanded="true">']
+    for i in range(num_labs):
+        lab = 'LAB_{}'.format(i)
+        parts.append('<li role="treeitem" aria-expanded="true" id="{}{}"><a><span>{}</span></a><ul>'.format(
+            TREE_ID_PREFIX, lab, lab))
+        for j in range(subfolders_per_lab):
+            parts.append('<li role="treeitem" aria-expanded="false" id="{}{}:Sub_{}"><a><span>Sub_{}</span></a></li>'.format(
+                TREE_ID_PREFIX, lab, j, j))
+        parts.append('</ul></li>')
+    parts.append('</ul>')
+
+    return ''.join(parts)
+
+
+def _synthetic_file_list(num_files):
+
+    parts = ['<div id="filelist-grid">']
+    for i in range(num_files):
+        parts.append('<div index="{0}" class="row"><div class="cell" id="metadata_{0}.csv">metadata_{0}.csv</div>'
+                     '<div class="cell">{1} KB</div><div class="cell">08/31/2021 2:01 PM</div></div>'.format(i, i % 900 + 1))
+    parts.append('</div>')
+
+    return ''.join(parts)
+
+
+def benchmark(num_labs=500, subfolders_per_lab=10, num_files=5000, repeat=5):
+
+    '''
+    (Python)
+
+    Times parse_tree()/parse_file_list() (regex fast path, and the HTML tokenizer they fall back to) against
+    the regex extraction previously used in sft_main.py, on synthetic large trees and large folders.
+    Prints and returns the best time of each in seconds.
+
+    --------------------------------------------------------------------------------------
+
+    Example:
+    python sft_parsing.py
+    '''
+
+    tree_html = _synthetic_tree(num_labs, subfolders_per_lab)
+    filelist_html = _synthetic_file_list(num_files)
+
+    def legacy_tree():
+        ids = re.findall('id="(allFiles_Tree::[^"]+)"', tree_html)
+        expanded = re.findall('aria-expanded="([^"]+)"', tree_html)[1:]
+        return list(zip(ids, expanded))
+
+    def legacy_files():
+        return re.findall(r'div index="\d{1,3}".*?id="([^"]+)"', filelist_html)
+
+    def tokenizer_tree():
+        parser = _TreeParser()
+        parser.feed(tree_html)
+        parser.close()
+        return parser.nodes
+
+    def tokenizer_files():
+        parser = _FileListParser(0)
+        parser.feed(filelist_html)
+        parser.close()
+        return parser.nodes
+
+    def best(fn):
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            fn()
+            times.append(time.perf_counter() - start)
+        return min(times)
+
+    results = {
+        'tree_nodes': len(parse_tree(tree_html)),
+        'file_nodes': len(parse_file_list(filelist_html)),
+        'legacy_file_ids_found': len(legacy_files()),
+        'paths_agree': parse_tree(tree_html) == tokenizer_tree() and parse_file_list(filelist_html) == tokenizer_files(),
+        'legacy_tree_seconds': best(legacy_tree),
+        'parse_tree_seconds': best(lambda: parse_tree(tree_html)),
+        'tokenizer_tree_seconds': best(tokenizer_tree),
+        'legacy_file_list_seconds': best(legacy_files),
+        'parse_file_list_seconds': best(lambda: parse_file_list(filelist_html)),
+        'tokenizer_file_list_seconds': best(tokenizer_files),
+    }
+
+    for key, value in results.items():
+        print('{:<28}{}'.format(key, round(value, 4) if isinstance(value, float) else value))
+
+    return results
+
+
+if __name__ == '__main__':
+    benchmark()
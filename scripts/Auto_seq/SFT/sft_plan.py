@@ -0,0 +1,442 @@
+# -*- coding: utf-8 -*-
+"""
+Dry-run planner for the SFT pull.
+
+Walks the SFT tree and routes it exactly like run_pull() in sft_main.py, but only reads:
+nothing is downloaded, moved, archived, logged or deleted, and the listing cache is not
+saved.  The result is the per-file plan the pull would carry out (source id, destination
+path, archive name, collision suffix, delete yes/no) with estimated bytes and time, plus
+the tree folders the routing leaves out and why.
+
+Run it after editing sft_expected_directories.csv or the SENTINEL_LABS filter:
+    python sft_plan.py --csv plan.csv
+"""
+###############################################################################################################
+###############################################################################################################
+
+import os
+import csv
+import json
+import pickle
+import datetime
+import argparse
+from dataclasses import dataclass, asdict
+
+from sft_functions import collision_free_name, archive_filename
+from sft_driver import create_chrome_driver, make_run_download_directory, remove_run_download_directory
+from sft_listing_cache import ListingCache, tree_signature
+from sft_manifest import read_index, read_since
+from sft_settings import get_settings
+from sft_main import login, expand_all_directories, build_navigation_key, open_folder, read_expected_directories
+from sft_schedule import order_navigation_key, order_files, waiting_since
+
+# Used for time estimates until the manifest has enough history
+DEFAULT_SECONDS_PER_FILE = 10.0
+DEFAULT_BYTES_PER_SECOND = 5 * 1024 * 1024
+
+# Fixed waits in run_pull(): per folder visited and per file pulled
+FOLDER_SECONDS = 3.0
+FILE_SECONDS = 2.0
+
+# How many recent manifest records the estimates are fitted on
+HISTORY_RECORDS = 500
+
+###############################################################################################################
+###############################################################################################################
+
+####################################################################################
+# Plan entries
+####################################################################################
+
+@dataclass
+class PlanEntry:
+
+    '''
+    (Python)
+
+    One thing the pull would do to one SFT file or directory.
+
+    folder_id -- tree id of the folder being visited
+    submitter -- top-level SFT folder (dir1)
+    source_id -- SFT file list id of the file/directory
+    kind -- 'file' or 'directory'
+    destination_path -- full net drive path the file would be saved as (None for directories)
+    collision_suffix -- ' (1)', ' (2)'... if the name is taken at the destination, else ''
+    archive_name -- archive copy name (the time part is the planning time)
+    delete -- whether the pull deletes it from the SFT
+    size -- bytes, as listed by the SFT (None if not shown)
+    estimated_seconds -- estimated time to pull it
+    mtime -- SFT timestamp as an ISO string (None if not shown)
+    '''
+
+    folder_id: str
+    submitter: str
+    source_id: str
+    kind: str
+    destination_path: str = None
+    collision_suffix: str = ''
+    archive_name: str = None
+    delete: bool = True
+    size: int = None
+    estimated_seconds: float = 0.0
+    mtime: str = None
+
+
+@dataclass
+class SkippedFolder:
+    '''A tree folder the pull would not visit, and why.'''
+
+    folder_id: str
+    path: str
+    reason: str
+
+###############################################################################################################
+###############################################################################################################
+
+####################################################################################
+# Time estimates from past runs
+####################################################################################
+
+def estimate_rates(manifest_directory, history_records=HISTORY_RECORDS):
+
+    '''
+    (Python)
+
+    Fits seconds = seconds_per_file + size / bytes_per_second to the most recent
+    manifest records (least squares on stage_seconds).  Falls back to the defaults when
+    there is too little history or the fit is meaningless.
+
+    Returns:
+    {'seconds_per_file': float, 'bytes_per_second': float, 'history': number of records used}
+    '''
+
+    rates = {'seconds_per_file': DEFAULT_SECONDS_PER_FILE, 'bytes_per_second': DEFAULT_BYTES_PER_SECOND, 'history': 0}
+
+    if not os.path.exists(os.path.join(manifest_directory, 'sft_manifest_index.json')):
+        return rates
+
+    last_seq = read_index(manifest_directory)['last_seq']
+    records, _ = read_since(manifest_directory, max(0, last_seq - history_records))
+
+    points = [(r['size'], sum(r['stage_seconds'].values())) for r in records
+              if r.get('size') is not None and r.get('stage_seconds')]
+    rates['history'] = len(points)
+
+    if len(points) < 2:
+        return rates
+
+    n = len(points)
+    mean_x = sum(x for x, _ in points) / n
+    mean_y = sum(y for _, y in points) / n
+    var_x = sum((x - mean_x) ** 2 for x, _ in points)
+    slope = sum((x - mean_x) * (y - mean_y) for x, y in points) / var_x if var_x else 0.0
+
+    if slope > 0:
+        rates['bytes_per_second'] = 1.0 / slope
+        rates['seconds_per_file'] = max(0.0, mean_y - slope * mean_x)
+    else:
+        # Sizes don't explain the times (or are all the same): use the average time per file
+        rates['seconds_per_file'] = mean_y
+
+    return rates
+
+
+def estimate_seconds(size, rates):
+    '''Estimated time to pull one file of size bytes (unknown size counts as the per-file time only).'''
+
+    return FILE_SECONDS + rates['seconds_per_file'] + (size or 0) / rates['bytes_per_second']
+
+###############################################################################################################
+###############################################################################################################
+
+####################################################################################
+# Building the plan
+####################################################################################
+
+def skipped_folders(tree_nodes, navigation_key):
+
+    '''
+    (Python)
+
+    Tree folders that build_navigation_key() drops, with the reason.
+    Mirrors the SENTINEL_LABS filter and the sft_expected_directories.csv merge.
+    '''
+
+    routed = {entry.id for entry in navigation_key}
+    skipped = []
+
+    for node in tree_nodes:
+        if node.id in routed:
+            continue
+
+        parts = node.path_parts
+        if parts[0] == 'SENTINEL_LABS' and not (len(parts) > 1 and parts[1] == 'NW_Genomics'):
+            reason = 'SENTINEL_LABS filter'
+        else:
+            reason = 'no net_Drive_Mapping in sft_expected_directories.csv'
+
+        skipped.append(SkippedFolder(node.id, '/'.join(parts), reason))
+
+    return skipped
+
+
+def plan_folder(folder_id, submitter, destination_directory, content_nodes, today_date, rates, taken, now=None):
+
+    '''
+    (Python)
+
+    Plan entries for one visited folder, in the order run_pull() handles them:
+    files (download, archive, move, delete), then sub-directories (delete).
+
+    --------------------------------------------------------------------------------------
+
+    Keyword arguments:
+    folder_id -- tree id of the folder
+    submitter -- dir1 of the folder
+    destination_directory -- its net_Drive_Mapping
+    content_nodes -- parsed file list of the folder
+    today_date -- YYYYMMDD string used for archive names
+    rates -- estimate_rates() output
+    taken -- dict of destination directory -> set of names already planned there (updated)
+    now -- datetime used for the archive name's time part
+    '''
+
+    entries = []
+    planned = taken.setdefault(destination_directory, set())
+
+    for node in order_files(content_nodes):
+
+        name, copy_num = collision_free_name(node.id, destination_directory, planned)
+        planned.add(name)
+
+        entries.append(PlanEntry(
+            folder_id=folder_id,
+            submitter=submitter,
+            source_id=node.id,
+            kind='file',
+            destination_path=destination_directory + name,
+            collision_suffix=' ({})'.format(copy_num) if copy_num else '',
+            archive_name=archive_filename(node.id, today_date, now),
+            delete=True,
+            size=node.size,
+            estimated_seconds=round(estimate_seconds(node.size, rates), 1),
+            mtime=node.mtime,
+        ))
+
+    for node in content_nodes:
+        if node.is_directory:
+            entries.append(PlanEntry(folder_id=folder_id, submitter=submitter, source_id=node.id,
+                                     kind='directory', delete=True))
+
+    return entries
+
+
+def plan_pull(driver, objects, expected_dirs, rates=None, use_listing_cache=True):
+
+    '''
+    (Python)
+
+    Read-only pass over the SFT producing the pull plan.  The driver must already be
+    logged in.  Folders the listing cache says are unchanged since they were emptied
+    are skipped, as the pull would skip them; the cache is not written.
+
+    --------------------------------------------------------------------------------------
+
+    Keyword arguments:
+    driver -- selenium webdriver, logged in
+    objects -- contents of sft_objects.p
+    expected_dirs -- the crosswalk from read_expected_directories()
+    rates -- estimate_rates() output.  Read from the manifest if not given.
+    use_listing_cache -- False visits every routed folder
+
+    --------------------------------------------------------------------------------------
+
+    Returns:
+    dict with keys 'entries' (PlanEntry list), 'skipped' (SkippedFolder list),
+    'unchanged' (folder ids skipped via the listing cache), 'rates', 'planned_at'
+    '''
+
+    now = datetime.datetime.now()
+    today_date = now.strftime('%Y%m%d')
+
+    if rates is None:
+        rates = estimate_rates(objects.get('manifest_directory', '//Sequence Data and Reporting/Submissions/manifest/'))
+
+    tree_nodes = expand_all_directories(driver)
+    navigation_key = build_navigation_key(tree_nodes, expected_dirs)
+    tree_nodes_by_id = {node.id: node for node in tree_nodes}
+
+    listing_cache = None
+    if use_listing_cache:
+        listing_cache = ListingCache(objects.get('listing_cache_path', '//Sequence Data and Reporting/Data_Objects/SFT/sft_listing_cache.p'),
+                                     ttl_seconds=objects.get('listing_cache_ttl_hours', 24) * 60 * 60)
+
+    navigation_key = order_navigation_key(navigation_key, waiting_since(listing_cache, navigation_key),
+                                          aging_hours=objects.get('priority_aging_hours', 6))
+
+    entries, unchanged, taken = [], [], {}
+
+    for folder in navigation_key:
+
+        if listing_cache is not None and not listing_cache.needs_visit(folder.id, tree_signature(tree_nodes_by_id[folder.id], tree_nodes)):
+            unchanged.append(folder.id)
+            continue
+
+        content_nodes = open_folder(driver, folder.id)
+        entries.extend(plan_folder(folder.id, folder.dir1, folder.net_Drive_Mapping, content_nodes,
+                                   today_date, rates, taken, now))
+
+    return {
+        'entries': entries,
+        'skipped': skipped_folders(tree_nodes, navigation_key),
+        'unchanged': unchanged,
+        'rates': rates,
+        'planned_at': now.isoformat(timespec='seconds'),
+    }
+
+###############################################################################################################
+###############################################################################################################
+
+####################################################################################
+# Output
+####################################################################################
+
+def plan_totals(plan):
+    '''Files, directories, known bytes, files of unknown size and estimated seconds of a plan.'''
+
+    files = [e for e in plan['entries'] if e.kind == 'file']
+
+    return {
+        'files': len(files),
+        'directories': sum(e.kind == 'directory' for e in plan['entries']),
+        'bytes': sum(e.size for e in files if e.size is not None),
+        'unknown_size': sum(e.size is None for e in files),
+        'collisions': sum(bool(e.collision_suffix) for e in files),
+        'estimated_seconds': round(sum(e.estimated_seconds for e in files)
+                                   + FOLDER_SECONDS * len({e.folder_id for e in plan['entries']}), 1),
+    }
+
+
+def format_plan(plan):
+    '''Human-readable plan: one line per entry, then skipped folders and totals.'''
+
+    from sft_report import format_bytes, format_seconds
+
+    lines = ['SFT pull plan ({})'.format(plan['planned_at']), '']
+
+    for e in plan['entries']:
+        if e.kind == 'file':
+            lines.append('{}  {} -> {}{}  archive {}  {}  ~{}  delete: {}'.format(
+                e.submitter, e.source_id, e.destination_path,
+                '  (renamed{})'.format(e.collision_suffix) if e.collision_suffix else '',
+                e.archive_name, format_bytes(e.size), format_seconds(e.estimated_seconds),
+                'yes' if e.delete else 'no'))
+        else:
+            lines.append('{}  {} (directory)  delete: {}'.format(e.submitter, e.source_id, 'yes' if e.delete else 'no'))
+
+    if plan['unchanged']:
+        lines += ['', 'Unchanged since last emptied (not visited):'] + ['  ' + i for i in plan['unchanged']]
+
+    if plan['skipped']:
+        lines += ['', 'Not routed:'] + ['  {}  ({})'.format(s.path, s.reason) for s in plan['skipped']]
+
+    totals = plan_totals(plan)
+    lines += ['', '{} file(s), {} director(ies), {}{}, {} renamed, about {} (fitted on {} past file(s))'.format(
+        totals['files'], totals['directories'], format_bytes(totals['bytes']),
+        ' + {} of unknown size'.format(totals['unknown_size']) if totals['unknown_size'] else '',
+        totals['collisions'], format_seconds(totals['estimated_seconds']), plan['rates']['history'])]
+
+    return '\n'.join(lines)
+
+
+def write_plan_csv(plan, path):
+    '''Writes the plan entries to a CSV file, one row per entry.'''
+
+    fields = list(PlanEntry.__dataclass_fields__)
+
+    with open(path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=fields)
+        writer.writeheader()
+        for entry in plan['entries']:
+            writer.writerow(asdict(entry))
+
+
+def plan_to_json(plan):
+    '''The whole plan as a JSON string.'''
+
+    return json.dumps({
+        'planned_at': plan['planned_at'],
+        'rates': plan['rates'],
+        'totals': plan_totals(plan),
+        'entries': [asdict(e) for e in plan['entries']],
+        'unchanged': plan['unchanged'],
+        'skipped': [asdict(s) for s in plan['skipped']],
+    }, indent=1)
+
+###############################################################################################################
+###############################################################################################################
+
+####################################################################################
+# Running a plan
+####################################################################################
+
+def run_plan(use_listing_cache=True, settings=None):
+
+    '''
+    (Python)
+
+    Logs in to the SFT and builds the pull plan.  Downloads nothing; the Chrome
+    download directory it creates is removed again.
+    '''
+
+    if settings is None:
+        settings = get_settings()
+
+    objects = pickle.load( open( settings.objects_path, "rb" ) )
+    expected_dirs = read_expected_directories(settings.expected_dirs_path)
+
+    dir_downloads = make_run_download_directory(objects.get('download_base_directory'), run_label='plan')
+    driver = create_chrome_driver(dir_downloads,
+                                  headless=objects.get('chrome_headless', True),
+                                  memory_cap_mb=objects.get('chrome_memory_cap_mb'),
+                                  profile_directory=objects.get('chrome_profile_directory'))
+
+    try:
+        login(driver, settings.sft_user, settings.sft_pw)
+        plan = plan_pull(driver, objects, expected_dirs, use_listing_cache=use_listing_cache)
+    finally:
+        driver.close()
+        remove_run_download_directory(dir_downloads)
+
+    return plan
+
+
+def main(argv=None):
+
+    '''
+    (Python)
+
+    Command line for the planner (also `sft plan`).  Returns the process exit code.
+    '''
+
+    parser = argparse.ArgumentParser(description='Show what the SFT pull would do, without doing it.')
+    parser.add_argument('--csv', help='also write the plan entries to this CSV file')
+    parser.add_argument('--json', help='also write the full plan to this JSON file')
+    parser.add_argument('--no-cache', action='store_true', help='visit every routed folder, ignoring the listing cache')
+    args = parser.parse_args(argv)
+
+    plan = run_plan(use_listing_cache=not args.no_cache)
+    print(format_plan(plan))
+
+    if args.csv:
+        write_plan_csv(plan, args.csv)
+    if args.json:
+        with open(args.json, 'w') as f:
+            f.write(plan_to_json(plan))
+
+    return 0
+
+
+if __name__ == '__main__':
+    import sys
+    sys.exit(main())
@@ -0,0 +1,542 @@
+# -*- coding: utf-8 -*-
+"""
+Three-way reconciliation: SFT listing, pull log and what is on disk.
+
+Builds an index of each side once and joins them in memory instead of checking files
+one os.path.exists() at a time:
+
+- disk: ARCHIVE_copies (plus the pack indexes of the cold tier, see sft_pack) and every
+  net_Drive_Mapping folder, listed in parallel with os.scandir (one directory read each),
+- log: sft_automated_pull_log.csv (plus the run manifest, for repairs),
+- SFT: the live file listing (only with --live, since it needs a browser login).
+
+Findings:
+missing_archive      -- log row whose archive copy is not in ARCHIVE_copies
+orphan_archive       -- archive copy no log row mentions
+missing_destination  -- log row whose file is not in its destination folder (downstream
+                        jobs move placed files on, so old rows show up here by design)
+orphan_destination   -- file in a destination folder no log row mentions
+never_deleted        -- SFT file that is a specific pulled copy (run manifest record with the
+                        same SFT name and size, from before the pull, with its archive copy
+                        on disk) but is still on the SFT
+same_name_on_sft     -- SFT file with the name of a pulled file that can't be matched to
+                        that copy (a resubmission, or not enough to tell).  Never deleted.
+
+    python sft_reconcile.py --since 2021-08-01
+    python sft_reconcile.py --live --repair
+"""
+###############################################################################################################
+###############################################################################################################
+
+import os
+import re
+import csv
+import json
+import pickle
+import datetime
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+from sft_functions import LOG_COLUMNS, LogRecord, append_log_records
+from sft_sidecar import SIDECAR_SUFFIX
+
+# 'name (3).csv' -> 'name.csv' (collision_free_name() renames)
+COLLISION_SUFFIX = re.compile(r' \(\d+\)(?=\.[^.]*$|$)')
+
+# How many examples of each finding the text report lists
+REPORT_LIMIT = 20
+
+###############################################################################################################
+###############################################################################################################
+
+####################################################################################
+# Building the indexes
+####################################################################################
+
+def scan_directory(path):
+    '''{file name: (size, mtime)} of a directory's files (one scandir), or None if it doesn't exist.'''
+
+    try:
+        with os.scandir(path) as entries:
+            return {e.name: (e.stat().st_size, e.stat().st_mtime) for e in entries if e.is_file()}
+    except FileNotFoundError:
+        return None
+
+
+def scan_directories(paths, workers=16):
+    '''scan_directory() of several directories at once (threads: the time is spent waiting on the share).'''
+
+    paths = sorted(set(paths))
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        return dict(zip(paths, pool.map(scan_directory, paths)))
+
+
+def normalise_directory(path):
+    '''Destination folders are compared with one trailing slash and forward slashes.'''
+
+    return path.replace('\\', '/').rstrip('/') + '/'
+
+
+def original_name(name):
+    '''The SFT name a placed file had before collision_free_name() renamed it.'''
+
+    return COLLISION_SUFFIX.sub('', name, count=1)
+
+
+def archive_key(archive_name):
+    '''(YYYYMMDD, original name) of an archive copy named 'YYYYMMDD_HHMMSS_<name>'.'''
+
+    return archive_name[:8], archive_name[16:]
+
+
+def read_log(path_to_log, since=None):
+
+    '''
+    (Python)
+
+    Pull log rows as LogRecords, optionally only those dated on or after since
+    (a datetime.date).
+    '''
+
+    if not os.path.exists(path_to_log):
+        return []
+
+    first_day = since.strftime('%Y%m%d') if since else ''
+
+    with open(path_to_log, 'r', newline='') as f:
+        rows = [LogRecord(*(row.get(column) or '' for column in LOG_COLUMNS)) for row in csv.DictReader(f)]
+
+    return [row for row in rows if str(row.date) >= first_day]
+
+###############################################################################################################
+###############################################################################################################
+
+####################################################################################
+# Joining them
+####################################################################################
+
+def pulled_copy(item, records):
+
+    '''
+    (Python)
+
+    The manifest record of the pulled copy an SFT file still is, or None.  A record
+    matches when the SFT shows the same size in bytes and the file was already there
+    when that copy was downloaded: its SFT timestamp, or else the time the pull first
+    listed it (listing cache), is not after the download and not before the record's
+    first_seen_at.  A lab resubmitting a new file under the same name fails one of these.
+
+    --------------------------------------------------------------------------------------
+
+    Keyword arguments:
+    item -- one live_sft_files() entry (submitter, folder_id, filename, size, mtime, first_seen)
+    records -- manifest records with the same submitter and SFT name
+    '''
+
+    if item.get('size') is None:
+        return None
+
+    arrived = item.get('mtime') or item.get('first_seen')
+    if not arrived:
+        return None
+
+    for record in sorted(records, key=lambda r: r.get('downloaded_at') or '', reverse=True):
+        if record.get('size') != item['size'] or not record.get('sha256') or not record.get('downloaded_at'):
+            continue
+        if item.get('mtime'):
+            if item['mtime'][:19] <= record['downloaded_at'][:19]:
+                return record
+        elif record.get('first_seen_at') and record['first_seen_at'][:19] <= arrived[:19] <= record['downloaded_at'][:19]:
+            return record
+
+    return None
+
+
+def reconcile(log_rows, archive_index, destination_indexes, destination_submitters, sft_files=None, since=None, retired=(),
+              manifest_records=()):
+
+    '''
+    (Python)
+
+    Joins the three sides.
+
+    --------------------------------------------------------------------------------------
+
+    Keyword arguments:
+    log_rows -- read_log() output
+    archive_index -- scan_directory() of ARCHIVE_copies
+    destination_indexes -- {normalised destination folder: scan_directory() output}
+    destination_submitters -- {normalised destination folder: submitter}
+    sft_files -- optional list of the files still on the SFT (live_sft_files() output)
+    since -- optional datetime.date: archive copies / placed files older than this are not
+             reported as orphans (their log rows weren't read)
+    retired -- archive names retention deleted on purpose (not reported missing)
+    manifest_records -- run manifest records, to match SFT files to pulled copies (never_deleted)
+
+    --------------------------------------------------------------------------------------
+
+    Returns:
+    dict of finding name -> list of dicts, plus 'counts'
+    '''
+
+    first_day = since.strftime('%Y%m%d') if since else ''
+    first_mtime = datetime.datetime.combine(since, datetime.time()).timestamp() if since else 0
+
+    archive_index = archive_index or {}
+    archive_names = set(archive_index)
+    archive_keys = {archive_key(name) for name in archive_names}
+
+    log_archive_names = {row.archive_filename for row in log_rows if row.archive_filename}
+    log_archive_keys = {(str(row.date), row.filename) for row in log_rows}
+
+    # Placed files by (folder, original name)
+    placed = {(folder, original_name(name))
+              for folder, index in destination_indexes.items() if index for name in index}
+    logged_placements = {(normalise_directory(row.path_dest), row.filename) for row in log_rows if row.path_dest}
+
+    findings = {name: [] for name in ('missing_archive', 'orphan_archive', 'missing_destination',
+                                      'orphan_destination', 'never_deleted', 'same_name_on_sft')}
+
+    for row in log_rows:
+        if (row.archive_filename not in archive_names and row.archive_filename not in retired
+                and (str(row.date), row.filename) not in archive_keys):
+            findings['missing_archive'].append(row._asdict())
+        if row.path_dest and (normalise_directory(row.path_dest), row.filename) not in placed:
+            findings['missing_destination'].append(row._asdict())
+
+    for name, (size, _) in archive_index.items():
+        if name[:8] >= first_day and name not in log_archive_names and archive_key(name) not in log_archive_keys:
+            findings['orphan_archive'].append({'archive_filename': name, 'size': size})
+
+    for folder, index in destination_indexes.items():
+        for name, (size, mtime) in (index or {}).items():
+            # Sidecars (placed next to their file before they moved to .sidecars/) and partial copies
+            # belong to a placed file, not the log
+            if name.endswith(SIDECAR_SUFFIX) and name[:-len(SIDECAR_SUFFIX)] in index or name.endswith('.part'):
+                continue
+            if mtime >= first_mtime and (folder, original_name(name)) not in logged_placements:
+                findings['orphan_destination'].append({'submitter': destination_submitters.get(folder), 'folder': folder,
+                                                       'filename': name, 'size': size})
+
+    if sft_files is not None:
+        pulled = {(row.folder_dest, row.filename) for row in log_rows}
+        copies = {}
+        for record in manifest_records:
+            if record.get('archive_name') in archive_names and record.get('archive_name') not in retired:
+                copies.setdefault((record.get('submitter'), record.get('sft_id') or original_name(record.get('file_name') or '')), []).append(record)
+
+        for item in sft_files:
+            key = (item['submitter'], item['filename'])
+            if key not in pulled and key not in copies:
+                continue
+            record = pulled_copy(item, copies.get(key, ()))
+            if record is None:
+                findings['same_name_on_sft'].append(dict(item))
+                continue
+            findings['never_deleted'].append(dict(item, archive_name=record['archive_name'], archive_path=record.get('archive_path'),
+                                                  sha256=record.get('sha256'), downloaded_at=record.get('downloaded_at')))
+
+    findings['counts'] = {name: len(items) for name, items in findings.items()}
+    findings['counts'].update(log_rows=len(log_rows), archive_files=len(archive_index),
+                              destination_files=sum(len(i or {}) for i in destination_indexes.values()),
+                              missing_destination_folders=sum(i is None for i in destination_indexes.values()),
+                              sft_files=None if sft_files is None else len(sft_files))
+
+    return findings
+
+###############################################################################################################
+###############################################################################################################
+
+####################################################################################
+# Repairs (through the normal pipeline pieces)
+####################################################################################
+
+def repair_missing_archives(findings, archive_directory, governor=None):
+
+    '''
+    (Python)
+
+    Restores missing archive copies from the placed file when it is still in its
+    destination folder: a governed, verified copy under the archive name the log expects.
+    Returns the archive names restored.
+    '''
+
+    from sft_governor import get_governor
+    from sft_scrub import verify_object
+
+    governor = governor or get_governor()
+    restored = []
+
+    for row in findings['missing_archive']:
+        source = normalise_directory(row['path_dest']) + row['filename']
+        if not row['archive_filename'] or not os.path.exists(source):
+            continue
+        destination = archive_directory + row['archive_filename']
+        size, sha256 = governor.copy_file(source, destination)
+        state, detail = verify_object(destination, size, sha256)
+        if state != 'ok':
+            print('Archive restore failed verification:  {}  {} {}'.format(destination, state, detail or ''))
+            continue
+        print('Restored archive copy:  {}'.format(destination))
+        restored.append(row['archive_filename'])
+
+    return restored
+
+
+def repair_log_rows(findings, manifest_directory, path_to_log, governor=None):
+
+    '''
+    (Python)
+
+    Adds the pull log rows for orphan archive copies the run manifest knows about (a run
+    that stopped between placing a file and logging it).  Returns the rows added.
+    '''
+
+    from sft_governor import get_governor
+    from sft_manifest import read_since
+
+    orphans = {item['archive_filename'] for item in findings['orphan_archive']}
+    if not orphans:
+        return []
+
+    records, _ = read_since(manifest_directory, 0)
+    rows = []
+    for record in records:
+        if record.get('archive_name') in orphans:
+            destination_directory = os.path.dirname(record.get('destination_path') or '') + '/'
+            rows.append(LogRecord(record['archive_name'][:8], record.get('file_name'), record.get('submitter'), destination_directory,
+                                  record['archive_name'], record.get('archive_path')))
+            orphans.discard(record['archive_name'])
+
+    if rows:
+        with (governor or get_governor()).write_small(200 * len(rows), 'pull log'):
+            append_log_records(path_to_log, rows)
+        print('Added {} missing pull log row(s)'.format(len(rows)))
+
+    return rows
+
+
+def repair_never_deleted(findings, driver, archive_directory, pack_directory=None):
+
+    '''
+    (Python)
+
+    Deletes from the SFT the files that are pulled copies (see pulled_copy) but were
+    never deleted, folder by folder, exactly as the pull would.  Before each delete the
+    archive copy is verified against the size and sha256 the pull recorded (in its pack
+    if it has been packed), and the file is re-listed: it must still show the size and
+    timestamp it was matched on.  The driver must be logged in with the tree expanded.
+    Returns the files deleted.
+    '''
+
+    from sft_main import open_folder
+    from sft_functions import delete_element_by_id
+    from sft_scrub import verify_object, MISSING, OK
+    from sft_pack import verify_packed
+
+    deleted = []
+    by_folder = {}
+    for item in findings['never_deleted']:
+        by_folder.setdefault(item['folder_id'], []).append(item)
+
+    for folder_id, items in by_folder.items():
+        listed = {node.id: node for node in open_folder(driver, folder_id)}
+        for item in items:
+            archive_path = item.get('archive_path') or archive_directory + item['archive_name']
+            state, detail = verify_object(archive_path, item['size'], item['sha256'])
+            if state == MISSING and pack_directory:
+                state, detail = verify_packed(pack_directory, item['archive_name'], item['size'], item['sha256'])
+            if state != OK:
+                print('Not deleting {} from the SFT:  archive copy {} {}'.format(item['filename'], state, detail or ''))
+                continue
+
+            node = listed.get(item['filename'])
+            if node is None or node.size != item['size'] or node.mtime != item.get('mtime'):
+                print('Not deleting {} from the SFT:  changed since it was listed'.format(item['filename']))
+                continue
+
+            delete_element_by_id(driver, item['filename'])
+            deleted.append(item)
+
+    return deleted
+
+###############################################################################################################
+###############################################################################################################
+
+####################################################################################
+# Running it
+####################################################################################
+
+def live_sft_files(objects, expected_dirs, settings):
+
+    '''
+    (Python)
+
+    Logs in and lists every routed SFT folder (listing cache ignored for the listing, but
+    read for when each file was first seen).  Returns (files as dicts with submitter,
+    folder_id, filename, size, mtime and first_seen, logged-in driver, download directory);
+    the caller closes the driver.
+    '''
+
+    from sft_driver import create_chrome_driver, make_run_download_directory
+    from sft_listing_cache import ListingCache
+    from sft_main import login
+    from sft_plan import plan_pull
+
+    dir_downloads = make_run_download_directory(objects.get('download_base_directory'), run_label='reconcile')
+    driver = create_chrome_driver(dir_downloads,
+                                  headless=objects.get('chrome_headless', True),
+                                  memory_cap_mb=objects.get('chrome_memory_cap_mb'),
+                                  profile_directory=objects.get('chrome_profile_directory'))
+
+    try:
+        login(driver, settings.sft_user, settings.sft_pw)
+        plan = plan_pull(driver, objects, expected_dirs, use_listing_cache=False)
+    except Exception:
+        from sft_driver import remove_run_download_directory
+        driver.close()
+        remove_run_download_directory(dir_downloads)
+        raise
+
+    listing_cache = ListingCache(objects.get('listing_cache_path', '//Sequence Data and Reporting/Data_Objects/SFT/sft_listing_cache.p'))
+    files = []
+    for e in plan['entries']:
+        if e.kind == 'file':
+            first_seen = listing_cache.first_seen(e.folder_id, e.source_id)
+            files.append({'submitter': e.submitter, 'folder_id': e.folder_id, 'filename': e.source_id, 'size': e.size, 'mtime': e.mtime,
+                          'first_seen': datetime.datetime.fromtimestamp(first_seen).isoformat(timespec='seconds') if first_seen else None})
+
+    return files, driver, dir_downloads
+
+
+def run_reconcile(since=None, live=False, repair=False, workers=16, settings=None):
+
+    '''
+    (Python)
+
+    Builds the indexes, joins them and (with repair) fixes what the pipeline can fix:
+    missing archive copies, missing log rows and, with live, never-deleted SFT files.
+
+    --------------------------------------------------------------------------------------
+
+    Returns:
+    the findings dict (see reconcile()), with 'repairs' when repair is set
+    '''
+
+    from sft_main import read_expected_directories
+    from sft_manifest import read_since
+    from sft_pack import default_pack_directory, packed_copies
+    from sft_retention import retired_archives
+
+    if settings is None:
+        from sft_settings import get_settings
+        settings = get_settings()
+
+    objects = pickle.load(open(settings.objects_path, 'rb'))
+    expected_dirs = read_expected_directories(settings.expected_dirs_path)
+
+    manifest_directory = objects.get('manifest_directory', '//Sequence Data and Reporting/Submissions/manifest/')
+
+    destination_submitters = {normalise_directory(row['net_Drive_Mapping']): name for name, row in expected_dirs.items()}
+
+    # Disk side: every folder in one parallel pass
+    indexes = scan_directories([settings.archive_directory] + list(destination_submitters), workers)
+    archive_index = indexes.pop(settings.archive_directory)
+
+    # Cold archive copies live in the monthly packs (sft_pack)
+    pack_directory = default_pack_directory(objects, settings.archive_directory)
+    if archive_index is not None:
+        archive_index.update(packed_copies(pack_directory))
+    destination_indexes = {normalise_directory(path): index for path, index in indexes.items()}
+
+    log_rows = read_log(settings.pull_log_path, since)
+
+    driver, dir_downloads, sft_files, manifest_records = None, None, None, []
+    try:
+        if live:
+            sft_files, driver, dir_downloads = live_sft_files(objects, expected_dirs, settings)
+            manifest_records, _ = read_since(manifest_directory, 0)
+
+        retired = {os.path.basename(path) for path in retired_archives(manifest_directory) if path}
+        findings = reconcile(log_rows, archive_index, destination_indexes, destination_submitters, sft_files, since, retired,
+                             manifest_records)
+
+        if repair:
+            findings['repairs'] = {
+                'archives_restored': repair_missing_archives(findings, settings.archive_directory),
+                'log_rows_added': len(repair_log_rows(findings, manifest_directory, settings.pull_log_path)),
+                'sft_deleted': len(repair_never_deleted(findings, driver, settings.archive_directory, pack_directory))
+                               if driver is not None else 0,
+            }
+    finally:
+        if driver is not None:
+            from sft_driver import remove_run_download_directory
+            driver.close()
+            remove_run_download_directory(dir_downloads)
+
+    return findings
+
+
+def format_findings(findings, limit=REPORT_LIMIT):
+    '''Text report: counts, then up to limit examples of each finding.'''
+
+    counts = findings['counts']
+    lines = ['Reconcile:  {} log row(s), {} archive file(s), {} destination file(s){}'.format(
+        counts['log_rows'], counts['archive_files'], counts['destination_files'],
+        '' if counts['sft_files'] is None else ', {} SFT file(s)'.format(counts['sft_files']))]
+
+    if counts['missing_destination_folders']:
+        lines.append('  {} destination folder(s) not found'.format(counts['missing_destination_folders']))
+
+    for name in ('missing_archive', 'orphan_archive', 'missing_destination', 'orphan_destination', 'never_deleted', 'same_name_on_sft'):
+        if name in ('never_deleted', 'same_name_on_sft') and counts['sft_files'] is None:
+            continue
+        lines.append('{:<20} {}'.format(name, counts[name]))
+        for item in findings[name][:limit]:
+            lines.append('    ' + ', '.join('{}={}'.format(k, v) for k, v in item.items() if v not in (None, '')))
+        if counts[name] > limit:
+            lines.append('    ... {} more'.format(counts[name] - limit))
+
+    if 'repairs' in findings:
+        repairs = findings['repairs']
+        lines.append('Repairs:  {} archive copies restored, {} log rows added, {} SFT files deleted'.format(
+            len(repairs['archives_restored']), repairs['log_rows_added'], repairs['sft_deleted']))
+
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+
+    '''
+    (Python)
+
+    Command line for reconciliation (also `sft reconcile`).  Exit code 1 if anything
+    other than missing_destination was found.
+    '''
+
+    parser = argparse.ArgumentParser(description='Reconcile the SFT listing, the pull log and the files on disk.')
+    parser.add_argument('--since', type=datetime.date.fromisoformat, default=None,
+                        help='only log rows (and orphans) from this date (YYYY-MM-DD)')
+    parser.add_argument('--live', action='store_true', help='also log in and list the SFT (finds never-deleted files)')
+    parser.add_argument('--repair', action='store_true',
+                        help='restore missing archive copies, add missing log rows and (with --live) delete pulled files left on the SFT')
+    parser.add_argument('--workers', type=int, default=16, help='directories scanned at once (default 16)')
+    parser.add_argument('--limit', type=int, default=REPORT_LIMIT, help='examples listed per finding')
+    parser.add_argument('--json', help='also write the full findings to this JSON file')
+    args = parser.parse_args(argv)
+
+    findings = run_reconcile(since=args.since, live=args.live, repair=args.repair, workers=args.workers)
+    print(format_findings(findings, args.limit))
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(findings, f, indent=1, default=str)
+
+    problems = sum(findings['counts'][name] for name in ('missing_archive', 'orphan_archive', 'orphan_destination', 'never_deleted'))
+
+    return 1 if problems else 0
+
+
+if __name__ == '__main__':
+    import sys
+    sys.exit(main())
@@ -0,0 +1,379 @@
+# -*- coding: utf-8 -*-
+"""
+Daily SFT pull report.
+
+Renders the HTML, plain-text and JSON versions of the report in one pass over the run
+records (see sft_manifest), summarised per submitter: files, bytes, rows, time spent and
+first/last download time.  Templates are compiled once at import.
+"""
+###############################################################################################################
+###############################################################################################################
+
+import os
+import csv
+import json
+import html
+import datetime
+from string import Template
+
+from sft_manifest import read_since, cursor_for_date
+
+KNOWN_SUBMITTERS_FILENAME = 'report_known_submitters.json'
+
+###############################################################################################################
+###############################################################################################################
+
+####################################################################################
+# Templates (compiled once)
+####################################################################################
+
+HTML_TEMPLATE = Template('''
+    <h1 style="text-align: left;"><span style="color: #6495ED;">SFT Pull Report: $date_today</span></h1>
+    $new_submitters
+    <p>Hello,</p>
+    <p>$files_total file(s) ($bytes_total) were pulled from the SFT today from $submitters_total submitter(s).  Times are represented in a 24-hour format.</p>
+    <table class="table table-striped" border="1">
+    <thead><tr><th>Folder</th><th>Files</th><th>Size</th><th>Rows</th><th>Pull time</th><th>First download</th><th>Last download</th></tr></thead>
+    <tbody>
+    $rows
+    </tbody>
+    </table>
+    <p>Have a great day!</p>
+    <p>-DIQA Epis</p>
+     ''')
+
+HTML_ROW_TEMPLATE = Template(
+    '<tr><td>$folder</td><td>$files</td><td>$bytes</td><td>$rows</td><td>$duration</td><td>$first</td><td>$last</td></tr>')
+
+HTML_NEW_SUBMITTER_TEMPLATE = Template(
+    '<h2 style="text-align: left;"><span style="color: #DE3163;">Please review first submission:  $folder</span></h2>')
+
+HTML_EMPTY_TEMPLATE = Template('''
+    <h1 style="text-align: center;"><span style="color: #3366ff;">SFT Pull Report: $date_today</span></h1>
+    <p>Hello,</p>
+    <p>There were no files found in the SFT today.</p>
+    <p>Have a great day!</p>
+    <p>-DIQA Epis</p>
+     ''')
+
+TEXT_TEMPLATE = Template('''SFT Pull Report: $date_today
+$new_submitters
+$files_total file(s) ($bytes_total) pulled from $submitters_total submitter(s).
+
+$rows
+
+-DIQA Epis
+''')
+
+TEXT_ROW_TEMPLATE = Template('$folder: $files file(s), $bytes, $rows rows, $duration, $first-$last')
+
+TEXT_EMPTY_TEMPLATE = Template('''SFT Pull Report: $date_today
+
+There were no files found in the SFT today.
+
+-DIQA Epis
+''')
+
+###############################################################################################################
+###############################################################################################################
+
+####################################################################################
+# Formatting helpers
+####################################################################################
+
+def format_bytes(num_bytes):
+    '''1536 -> '1.5 KB'.'''
+
+    if num_bytes is None:
+        return 'unknown'
+
+    size = float(num_bytes)
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if size < 1024 or unit == 'GB':
+            return '{:.0f} {}'.format(size, unit) if unit == 'B' else '{:.1f} {}'.format(size, unit)
+        size /= 1024
+
+
+def format_seconds(seconds):
+    '''95.2 -> '1m 35s'.'''
+
+    seconds = int(round(seconds))
+    return '{}m {:02d}s'.format(seconds // 60, seconds % 60) if seconds >= 60 else '{}s'.format(seconds)
+
+
+def archive_timestamp(archive_name):
+
+    '''
+    (Python)
+
+    Download time encoded in an archive file name by sft_functions.archive_filename(): 'YYYYMMDD_HHMMSS_<file>'.
+    Returns a datetime, or None if the name doesn't carry one.
+    '''
+
+    try:
+        return datetime.datetime.strptime(archive_name[:15], '%Y%m%d_%H%M%S')
+    except (TypeError, ValueError):
+        return None
+
+###############################################################################################################
+###############################################################################################################
+
+####################################################################################
+# Records from the legacy pull log (for days before the manifest existed)
+####################################################################################
+
+def records_from_log(path_to_log, report_date, since=None):
+
+    '''
+    (Python)
+
+    Converts the rows of sft_automated_pull_log.csv for report_date (or from since
+    through report_date) into run records.
+    Size, rows and durations aren't in the log, so they are left empty.
+
+    --------------------------------------------------------------------------------------
+
+    Keyword arguments:
+    path_to_log -- full path to sft_automated_pull_log.csv
+    report_date -- datetime.date to report on
+    since -- optional first datetime.date of a multi-day report
+    '''
+
+    first_day, last_day = (since or report_date).strftime('%Y%m%d'), report_date.strftime('%Y%m%d')
+    records = []
+
+    with open(path_to_log, 'r', newline='') as f:
+        for row in csv.DictReader(f):
+            if not first_day <= str(row.get('Date')) <= last_day:
+                continue
+            downloaded_at = archive_timestamp(row.get('ArchiveFileName'))
+            records.append({
+                'submitter': row.get('DestinationName'),
+                'file_name': row.get('FileName'),
+                'archive_name': row.get('ArchiveFileName'),
+                'size': None,
+                'row_count': None,
+                'downloaded_at': downloaded_at.isoformat() if downloaded_at else None,
+                'stage_seconds': {},
+            })
+
+    return records
+
+
+def records_for_date(manifest_directory, report_date, since=None):
+
+    '''
+    (Python)
+
+    Manifest records downloaded on report_date (or from since through report_date).
+    Seeks with the manifest index, so only those days' runs are read.
+    '''
+
+    first_day = since or report_date
+    records, _ = read_since(manifest_directory, cursor_for_date(manifest_directory, first_day))
+
+    return [r for r in records
+            if first_day.isoformat() <= str(r.get('downloaded_at', ''))[:10] <= report_date.isoformat()]
+
+###############################################################################################################
+###############################################################################################################
+
+####################################################################################
+# Known submitters (for the "first submission" banner)
+####################################################################################
+
+def update_known_submitters(manifest_directory, records, report_date, path_to_log=None, since=None, save=True):
+
+    '''
+    (Python)
+
+    Records the first date each submitter was seen and returns the submitters whose
+    first date is report_date (or falls between since and report_date).  Stored as a
+    small JSON file next to the manifest; on first use it is seeded once from the
+    legacy pull log.  With save=False nothing is written (previews and dry runs).
+    '''
+
+    first_day = (since or report_date).isoformat()
+
+    path = os.path.join(manifest_directory, KNOWN_SUBMITTERS_FILENAME)
+
+    if os.path.exists(path):
+        with open(path, 'r') as f:
+            first_seen = json.load(f)
+    else:
+        first_seen = {}
+        if path_to_log and os.path.exists(path_to_log):
+            with open(path_to_log, 'r', newline='') as f:
+                for row in csv.DictReader(f):
+                    name, date = row.get('DestinationName'), str(row.get('Date'))
+                    if name and len(date) == 8:
+                        iso = '{}-{}-{}'.format(date[:4], date[4:6], date[6:])
+                        if iso < first_day and (name not in first_seen or iso < first_seen[name]):
+                            first_seen[name] = iso
+
+    for record in records:
+        name = record.get('submitter')
+        day = str(record.get('downloaded_at') or report_date.isoformat())[:10]
+        if name and (name not in first_seen or day < first_seen[name]):
+            first_seen[name] = day
+
+    if save:
+        os.makedirs(manifest_directory, exist_ok=True)
+        temp_path = path + '.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump(first_seen, f, indent=1, sort_keys=True)
+        os.replace(temp_path, path)
+
+    return sorted(name for name, first in first_seen.items() if first_day <= first <= report_date.isoformat())
+
+###############################################################################################################
+###############################################################################################################
+
+####################################################################################
+# Rendering
+####################################################################################
+
+def summarise(records):
+
+    '''
+    (Python)
+
+    Per-submitter summary of run records, sorted by submitter: files, bytes, rows,
+    total stage seconds and first/last download time.
+    '''
+
+    summary = {}
+
+    for record in records:
+        name = record.get('submitter') or 'unknown'
+        entry = summary.setdefault(name, {'submitter': name, 'files': 0, 'bytes': 0, 'rows': 0,
+                                          'seconds': 0.0, 'first': None, 'last': None,
+                                          'bytes_known': True, 'rows_known': True})
+        entry['files'] += 1
+
+        if record.get('size') is None:
+            entry['bytes_known'] = False
+        else:
+            entry['bytes'] += record['size']
+
+        if record.get('row_count') is None:
+            entry['rows_known'] = False
+        else:
+            entry['rows'] += record['row_count']
+
+        entry['seconds'] += sum((record.get('stage_seconds') or {}).values())
+
+        downloaded_at = record.get('downloaded_at')
+        if downloaded_at:
+            entry['first'] = downloaded_at if entry['first'] is None else min(entry['first'], downloaded_at)
+            entry['last'] = downloaded_at if entry['last'] is None else max(entry['last'], downloaded_at)
+
+    return [summary[k] for k in sorted(summary)]
+
+
+def render_report(records, report_date, new_submitters=()):
+
+    '''
+    (Python)
+
+    Renders the daily report from run records.
+
+    --------------------------------------------------------------------------------------
+
+    Keyword arguments:
+    records -- run records (manifest records, or records_from_log() output)
+    report_date -- datetime.date the report is for
+    new_submitters -- submitters whose first ever submission is in this report
+
+    --------------------------------------------------------------------------------------
+
+    Returns:
+    dict with keys 'html', 'text' and 'json'
+
+    --------------------------------------------------------------------------------------
+
+    Example:
+    report = render_report(records_for_date(manifest_dir, today), today)
+    send_email('Sequencing SFT Pull: Daily Report', recipients, report['html'])
+    '''
+
+    date_today = report_date.isoformat()
+    summary = summarise(records)
+
+    html_rows, text_rows, json_rows = [], [], []
+    for entry in summary:
+
+        first = entry['first'][11:19] if entry['first'] else ''
+        last = entry['last'][11:19] if entry['last'] else ''
+        values = {
+            'files': entry['files'],
+            'bytes': format_bytes(entry['bytes']) if entry['bytes_known'] else 'unknown',
+            'rows': entry['rows'] if entry['rows_known'] else 'unknown',
+            'duration': format_seconds(entry['seconds']),
+            'first': first,
+            'last': last,
+        }
+
+        html_rows.append(HTML_ROW_TEMPLATE.substitute(values, folder=html.escape(entry['submitter'])))
+        text_rows.append(TEXT_ROW_TEMPLATE.substitute(values, folder=entry['submitter']))
+        json_rows.append({
+            'submitter': entry['submitter'],
+            'files': entry['files'],
+            'bytes': entry['bytes'] if entry['bytes_known'] else None,
+            'rows': entry['rows'] if entry['rows_known'] else None,
+            'seconds': round(entry['seconds'], 3),
+            'first_download': entry['first'],
+            'last_download': entry['last'],
+            'first_submission': entry['submitter'] in new_submitters,
+        })
+
+    report_json = json.dumps({'date': date_today, 'files': len(records), 'submitters': json_rows}, indent=1)
+
+    if not records:
+        return {'html': HTML_EMPTY_TEMPLATE.substitute(date_today=date_today),
+                'text': TEXT_EMPTY_TEMPLATE.substitute(date_today=date_today),
+                'json': report_json}
+
+    bytes_known = all(e['bytes_known'] for e in summary)
+    totals = {
+        'date_today': date_today,
+        'files_total': len(records),
+        'bytes_total': format_bytes(sum(e['bytes'] for e in summary)) if bytes_known else 'size unknown',
+        'submitters_total': len(summary),
+    }
+
+    return {
+        'html': HTML_TEMPLATE.substitute(
+            totals,
+            new_submitters=''.join(HTML_NEW_SUBMITTER_TEMPLATE.substitute(folder=html.escape(n)) for n in new_submitters),
+            rows='\n    '.join(html_rows)),
+        'text': TEXT_TEMPLATE.substitute(
+            totals,
+            new_submitters=''.join('Please review first submission:  {}\n'.format(n) for n in new_submitters),
+            rows='\n'.join(text_rows)),
+        'json': report_json,
+    }
+
+
+def build_daily_report(manifest_directory, report_date, path_to_log=None, since=None):
+
+    '''
+    (Python)
+
+    Gathers report_date's records (manifest, else the legacy log), finds the new
+    submitters and renders the report.  Returns (report dict, records).
+    With since, the report covers every day from since through report_date.
+
+    The known submitters aren't saved here: call update_known_submitters() once the
+    report has been sent, so a preview doesn't use up the "first submission" banner.
+    '''
+
+    records = records_for_date(manifest_directory, report_date, since)
+
+    # Days pulled before the manifest existed only have the log
+    if not records and path_to_log and os.path.exists(path_to_log):
+        records = records_from_log(path_to_log, report_date, since)
+
+    new_submitters = update_known_submitters(manifest_directory, records, report_date, path_to_log, since, save=False)
+
+    return render_report(records, report_date, new_submitters), records
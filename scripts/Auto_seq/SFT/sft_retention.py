@@ -0,0 +1,544 @@
+# -*- coding: utf-8 -*-
+"""
+Archive retention.
+
+Policies decide how long archive copies are kept, per submitter and/or file type:
+
+    [{'submitter': 'LAB_A', 'keep_days': 365},
+     {'file_type': '.xlsx', 'keep_last': 3, 'keep_first': True},
+     {'keep_days': 730, 'keep_first': True}]                     # everything else
+
+keep_days  -- keep a copy this many days after it was pulled
+keep_last  -- keep the newest K versions of each file name a submitter sends (a copy
+              only ages out once K newer ones have arrived)
+keep_first -- keep the first version of each file name forever
+
+A file name is the name on the SFT (the manifest's sft_id), not the placed name:
+'metadata.xlsx' sent three times is placed as 'metadata.xlsx', 'metadata (1).xlsx' and
+'metadata (2).xlsx', and those are versions 1 to 3 of one file.
+
+With both keep_days and keep_last a copy must be past both.  The most specific policy
+wins (submitter + file type, then submitter, then file type, then the catch-all); a copy
+no policy matches is kept forever.  Set them with
+`sft config set retention_policies '[...]'`.
+
+Expiry is worked out from the run manifest, not by listing ARCHIVE_copies: every copy
+gets a row in an SQLite index (sft_retention.sqlite next to the manifest) with the date
+it expires, filled in as records arrive and when a newer version pushes one out of its
+keep_last window.  Pruning then reads the expired rows off an index on that date, so it
+costs time in proportion to what is deleted, not to the size of the archive.  Deleted
+copies stay in the index (deleted_at), which is how the scrubber and reconcile know they
+are gone on purpose.
+
+    python sft_retention.py --dry-run        # changes nothing, the index included
+    python sft_retention.py --batch 500
+"""
+###############################################################################################################
+###############################################################################################################
+
+import os
+import json
+import time
+import pickle
+import sqlite3
+import datetime
+import argparse
+
+INDEX_FILENAME = 'sft_retention.sqlite'
+
+POLICY_KEYS = {'submitter', 'file_type', 'keep_days', 'keep_last', 'keep_first'}
+
+# Deletes per index commit
+BATCH_SIZE = 500
+
+# Compact a pack once removed copies are this share of its data
+COMPACT_FRACTION = 0.5
+
+###############################################################################################################
+###############################################################################################################
+
+####################################################################################
+# Policies
+####################################################################################
+
+def check_policies(policies):
+    '''Raises ValueError for a malformed policy list; returns it otherwise.'''
+
+    for policy in policies:
+        unknown = set(policy) - POLICY_KEYS
+        if unknown:
+            raise ValueError('Unknown retention policy key(s) {} in {}'.format(sorted(unknown), policy))
+        for key in ('keep_days', 'keep_last'):
+            if policy.get(key) is not None and (not isinstance(policy[key], int) or policy[key] < (1 if key == 'keep_last' else 0)):
+                raise ValueError('{} must be a whole number in {}'.format(key, policy))
+
+    return policies
+
+
+def file_type(file_name):
+    return os.path.splitext(file_name or '')[1].lower()
+
+
+def policy_for(policies, submitter, file_name):
+
+    '''
+    (Python)
+
+    The policy covering a submitter's file: the most specific match (submitter and file
+    type, then submitter, then file type, then a policy naming neither); the first listed
+    on a tie.  None if nothing matches (keep forever).
+    '''
+
+    extension = file_type(file_name)
+    best, best_score = None, -1
+
+    for policy in policies:
+        if policy.get('submitter') not in (None, submitter):
+            continue
+        if policy.get('file_type') is not None and policy['file_type'].lower() != extension:
+            continue
+        score = 2 * ('submitter' in policy) + ('file_type' in policy)
+        if score > best_score:
+            best, best_score = policy, score
+
+    return best
+
+
+def expiry_date(policy, archived_on, version, superseded_on):
+
+    '''
+    (Python)
+
+    ISO date a copy expires on under a policy, or None while it is kept.
+
+    --------------------------------------------------------------------------------------
+
+    Keyword arguments:
+    policy -- policy_for() result
+    archived_on -- ISO date the copy was pulled
+    version -- 1 for the first copy of this submitter's file name, 2 for the next ...
+    superseded_on -- ISO date the policy's keep_last-th newer version arrived (None: not yet)
+    '''
+
+    if policy is None or (policy.get('keep_first') and version == 1):
+        return None
+
+    keep_days, keep_last = policy.get('keep_days'), policy.get('keep_last')
+    if keep_days is None and keep_last is None:
+        return None
+    if keep_last is not None and superseded_on is None:
+        return None
+
+    dates = []
+    if keep_days is not None:
+        dates.append((datetime.date.fromisoformat(archived_on) + datetime.timedelta(days=keep_days)).isoformat())
+    if keep_last is not None:
+        dates.append(superseded_on)
+
+    return max(dates)
+
+###############################################################################################################
+###############################################################################################################
+
+####################################################################################
+# The expiry index
+####################################################################################
+
+class RetentionIndex:
+
+    '''
+    (Python)
+
+    SQLite index of every archive copy the manifest knows: who sent it, its version and
+    the date it expires.  A partial index over (expires_on) of the live copies makes
+    "what has expired" a range read.
+
+    --------------------------------------------------------------------------------------
+
+    Keyword arguments:
+    path -- SQLite database (default location: sft_retention.sqlite next to the manifest)
+    read_only -- work on an in-memory copy of the database: updates are visible to this
+                 object only and nothing is written (dry runs)
+    '''
+
+    def __init__(self, path, read_only=False):
+        self.path = path
+
+        if read_only:
+            self.connection = sqlite3.connect(':memory:')
+            if os.path.exists(path):
+                source = sqlite3.connect(path)
+                source.backup(self.connection)
+                source.close()
+        else:
+            # Rollback journal rather than WAL: the database may live on a network share
+            self.connection = sqlite3.connect(path)
+        self.connection.execute('''CREATE TABLE IF NOT EXISTS copies (
+                                       archive_name TEXT PRIMARY KEY,
+                                       submitter TEXT,
+                                       file_name TEXT,
+                                       archived_on TEXT NOT NULL,
+                                       size INTEGER,
+                                       archive_path TEXT,
+                                       version INTEGER NOT NULL,
+                                       superseded_on TEXT,
+                                       expires_on TEXT,
+                                       deleted_at TEXT) WITHOUT ROWID''')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS copies_versions ON copies (submitter, file_name, version)')
+        self.connection.execute('''CREATE INDEX IF NOT EXISTS copies_expiry ON copies (expires_on)
+                                   WHERE deleted_at IS NULL AND expires_on IS NOT NULL''')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+        self.connection.commit()
+
+    def _meta(self, key, default=None):
+        row = self.connection.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else default
+
+    def _set_meta(self, key, value):
+        self.connection.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)', (key, str(value)))
+
+    # ---- keeping it current ----
+
+    def update(self, manifest_directory, policies):
+
+        '''
+        (Python)
+
+        Adds the manifest records written since the last update and moves the copies
+        they push out of a keep_last window onto the expiry index.  When the policies have
+        changed since the last update every expiry date is worked out again (one pass).
+
+        --------------------------------------------------------------------------------------
+
+        Returns:
+        (copies added, whether expiry was recomputed)
+        '''
+
+        from sft_manifest import read_since
+
+        policies_key = json.dumps(policies, sort_keys=True)
+        recompute = self._meta('policies') not in (None, policies_key)
+
+        # Indexes built before versions were grouped by SFT name are regrouped once
+        if self._meta('grouping') != 'sft_id':
+            if self._meta('cursor') is not None:
+                self._regroup(manifest_directory)
+                recompute = True
+            with self.connection:
+                self._set_meta('grouping', 'sft_id')
+
+        records, cursor = read_since(manifest_directory, int(self._meta('cursor', 0)))
+        added = 0
+
+        with self.connection:
+            for record in records:
+                archive_name = record.get('archive_name')
+                if not archive_name or not archive_name[:8].isdigit():
+                    continue
+                if self.connection.execute('SELECT 1 FROM copies WHERE archive_name = ?', (archive_name,)).fetchone():
+                    continue
+
+                submitter, file_name = record.get('submitter'), sft_name(record)
+                archived_on = '{}-{}-{}'.format(archive_name[:4], archive_name[4:6], archive_name[6:8])
+                version = self.connection.execute('SELECT COALESCE(MAX(version), 0) + 1 FROM copies WHERE submitter = ? AND file_name = ?',
+                                                  (submitter, file_name)).fetchone()[0]
+                policy = policy_for(policies, submitter, file_name)
+
+                self.connection.execute('INSERT INTO copies VALUES (?, ?, ?, ?, ?, ?, ?, NULL, ?, NULL)',
+                                        (archive_name, submitter, file_name, archived_on, record.get('size'),
+                                         record.get('archive_path'), version, expiry_date(policy, archived_on, version, None)))
+                added += 1
+
+                # The version this one pushes out of the keep_last window
+                if policy is not None and policy.get('keep_last') and version > policy['keep_last'] and not recompute:
+                    self._supersede(policy, submitter, file_name, version - policy['keep_last'], archived_on)
+
+            self._set_meta('cursor', cursor)
+            self._set_meta('policies', policies_key)
+
+        if recompute:
+            self.recompute(policies)
+
+        return added, recompute
+
+    def _regroup(self, manifest_directory):
+        '''Renames every copy to its SFT name and numbers the versions again (see update()).'''
+
+        from sft_manifest import read_since
+
+        records, _ = read_since(manifest_directory, 0)
+        names = {r['archive_name']: sft_name(r) for r in records if r.get('archive_name')}
+
+        with self.connection:
+            rows = self.connection.execute('SELECT archive_name, submitter, file_name FROM copies ORDER BY archive_name').fetchall()
+            versions = {}
+            updates = []
+            for archive_name, submitter, file_name in rows:
+                name = names.get(archive_name, file_name)
+                versions[(submitter, name)] = versions.get((submitter, name), 0) + 1
+                updates.append((name, versions[(submitter, name)], archive_name))
+            self.connection.executemany('UPDATE copies SET file_name = ?, version = ? WHERE archive_name = ?', updates)
+
+    def _supersede(self, policy, submitter, file_name, version, superseded_on):
+
+        row = self.connection.execute('SELECT archived_on FROM copies WHERE submitter = ? AND file_name = ? AND version = ?',
+                                      (submitter, file_name, version)).fetchone()
+        if row is not None:
+            self.connection.execute('UPDATE copies SET superseded_on = ?, expires_on = ? WHERE submitter = ? AND file_name = ? AND version = ?',
+                                    (superseded_on, expiry_date(policy, row[0], version, superseded_on), submitter, file_name, version))
+
+    def recompute(self, policies):
+        '''Works out every live copy's expiry again (after a policy change).'''
+
+        with self.connection:
+            groups = {}
+            for row in self.connection.execute('SELECT archive_name, submitter, file_name, archived_on, version FROM copies '
+                                               'WHERE deleted_at IS NULL ORDER BY submitter, file_name, version'):
+                groups.setdefault((row[1], row[2]), []).append(row)
+
+            # Versions are numbered over all copies, deleted ones included
+            arrivals = {}
+            for submitter, file_name, version, archived_on in self.connection.execute(
+                    'SELECT submitter, file_name, version, archived_on FROM copies'):
+                arrivals[(submitter, file_name, version)] = archived_on
+
+            updates = []
+            for (submitter, file_name), rows in groups.items():
+                policy = policy_for(policies, submitter, file_name)
+                keep_last = policy.get('keep_last') if policy else None
+                for archive_name, _, _, archived_on, version in rows:
+                    superseded_on = arrivals.get((submitter, file_name, version + keep_last)) if keep_last else None
+                    updates.append((superseded_on, expiry_date(policy, archived_on, version, superseded_on), archive_name))
+
+            self.connection.executemany('UPDATE copies SET superseded_on = ?, expires_on = ? WHERE archive_name = ?', updates)
+
+    # ---- reading it ----
+
+    def expired(self, on=None, limit=None):
+        '''Live copies expired on or before the date (default today): [(archive name, archive path, size, submitter)].'''
+
+        on = (on or datetime.date.today()).isoformat()
+        query = ('SELECT archive_name, archive_path, size, submitter FROM copies '
+                 'WHERE deleted_at IS NULL AND expires_on IS NOT NULL AND expires_on <= ? ORDER BY expires_on')
+        if limit:
+            query += ' LIMIT {:d}'.format(limit)
+
+        return self.connection.execute(query, (on,)).fetchall()
+
+    def deleted_paths(self):
+        '''archive_path of every copy retention has deleted.'''
+
+        return {path for (path,) in self.connection.execute('SELECT archive_path FROM copies WHERE deleted_at IS NOT NULL')}
+
+    def mark_deleted(self, archive_names):
+        now = datetime.datetime.now().isoformat(timespec='seconds')
+        with self.connection:
+            self.connection.executemany('UPDATE copies SET deleted_at = ? WHERE archive_name = ?', ((now, n) for n in archive_names))
+
+    def close(self):
+        self.connection.close()
+
+
+def sft_name(record):
+    '''The name a manifest record's file had on the SFT (versions are counted per SFT name).'''
+
+    return record.get('sft_id') or record.get('file_name')
+
+
+def index_path(manifest_directory):
+    return os.path.join(manifest_directory, INDEX_FILENAME)
+
+
+def retired_archives(manifest_directory):
+    '''archive_path of the copies retention deleted (empty if retention has never run).'''
+
+    path = index_path(manifest_directory)
+    if not os.path.exists(path):
+        return set()
+
+    # Read-only: scrub and reconcile call this without holding the pack lock
+    index = RetentionIndex(path, read_only=True)
+    try:
+        return index.deleted_paths()
+    finally:
+        index.close()
+
+###############################################################################################################
+###############################################################################################################
+
+####################################################################################
+# Pruning
+####################################################################################
+
+def prune(index, archive_directory, pack_directory, batch_size=BATCH_SIZE, dry_run=False, on=None, max_seconds=None):
+
+    '''
+    (Python)
+
+    Deletes the expired archive copies, a batch at a time: loose copies are removed from
+    ARCHIVE_copies, packed ones (see sft_pack) dropped from their pack's index and the
+    pack compacted once enough of it is gone.
+
+    --------------------------------------------------------------------------------------
+
+    Keyword arguments:
+    index -- RetentionIndex, already updated
+    archive_directory -- ARCHIVE_copies
+    pack_directory -- folder of the monthly packs
+    batch_size -- copies deleted per index commit
+    dry_run -- only report what would be deleted
+    on -- treat this date as today
+    max_seconds -- stop starting new batches after this long
+
+    --------------------------------------------------------------------------------------
+
+    Returns:
+    dict with files, bytes, by_submitter {submitter: [files, bytes]}, already_gone,
+    compacted (bytes reclaimed from packs), seconds
+    '''
+
+    from sft_pack import pack_month, open_index, compact_pack
+
+    started = time.monotonic()
+    summary = {'files': 0, 'bytes': 0, 'by_submitter': {}, 'already_gone': 0, 'compacted': 0}
+
+    def count(rows):
+        for _, _, size, submitter in rows:
+            totals = summary['by_submitter'].setdefault(submitter, [0, 0])
+            totals[0] += 1
+            totals[1] += size or 0
+        summary['files'] += len(rows)
+        summary['bytes'] += sum(row[2] or 0 for row in rows)
+
+    if dry_run:
+        count(index.expired(on))
+        summary['seconds'] = time.monotonic() - started
+        return summary
+
+    touched_months = set()
+    while max_seconds is None or time.monotonic() - started < max_seconds:
+        batch = index.expired(on, limit=batch_size)
+        if not batch:
+            break
+
+        packed = {}
+        for archive_name, archive_path, _, _ in batch:
+            loose_path = archive_path or os.path.join(archive_directory, archive_name)
+            try:
+                os.remove(loose_path)
+            except FileNotFoundError:
+                packed.setdefault(pack_month(archive_name), []).append(archive_name)
+
+        for month, names in packed.items():
+            pack_index = open_index(pack_directory, month) if month else None
+            if pack_index is None:
+                summary['already_gone'] += len(names)
+                continue
+            try:
+                found = sum(pack_index.lookup(name) is not None for name in names)
+                pack_index.remove(names)
+            finally:
+                pack_index.close()
+            summary['already_gone'] += len(names) - found
+            touched_months.add(month)
+
+        index.mark_deleted([row[0] for row in batch])
+        count(batch)
+
+    for month in sorted(touched_months):
+        pack_index = open_index(pack_directory, month)
+        removed, live = pack_index.removed_bytes, pack_index.live_bytes
+        pack_index.close()
+        if removed and removed >= COMPACT_FRACTION * (removed + live):
+            summary['compacted'] += compact_pack(pack_directory, month)
+
+    summary['seconds'] = time.monotonic() - started
+
+    return summary
+
+
+def format_summary(summary, dry_run=False):
+    '''Text report of a prune.'''
+
+    lines = ['{} {} expired archive copies, {:.1f} MB{}'.format(
+        'Would delete' if dry_run else 'Deleted', summary['files'], summary['bytes'] / 1024 / 1024,
+        '' if dry_run else ' in {:.1f}s'.format(summary['seconds']))]
+
+    for submitter, (files, num_bytes) in sorted(summary['by_submitter'].items(), key=lambda kv: -kv[1][1]):
+        lines.append('  {:<30} {:>8} file(s) {:>10.1f} MB'.format(str(submitter), files, num_bytes / 1024 / 1024))
+    if summary['already_gone']:
+        lines.append('  {} were already gone from the archive'.format(summary['already_gone']))
+    if summary['compacted']:
+        lines.append('  Compacted packs:  {:.1f} MB reclaimed'.format(summary['compacted'] / 1024 / 1024))
+
+    return '\n'.join(lines)
+
+###############################################################################################################
+###############################################################################################################
+
+####################################################################################
+# Command line
+####################################################################################
+
+def main(argv=None):
+
+    '''
+    (Python)
+
+    Command line for retention (also `sft retention`).  Updates the expiry index from the
+    manifest, then deletes (or with --dry-run lists) the expired copies under the pack
+    lock, so it never races the packer.
+    '''
+
+    parser = argparse.ArgumentParser(description='Delete archive copies past their retention policy.')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='only show what would be deleted (the index is updated in memory, not saved)')
+    parser.add_argument('--batch', type=int, default=BATCH_SIZE, help='copies deleted per commit (default {})'.format(BATCH_SIZE))
+    parser.add_argument('--max-minutes', type=float, default=None, help='stop after this long and continue next time')
+    parser.add_argument('--as-of', type=datetime.date.fromisoformat, default=None, help='treat this date (YYYY-MM-DD) as today')
+    args = parser.parse_args(argv)
+
+    from sft_pack import default_pack_directory, pack_lock
+    from sft_run import LockHeld
+    from sft_settings import get_settings
+
+    settings = get_settings()
+    objects = pickle.load(open(settings.objects_path, 'rb'))
+    manifest_directory = objects.get('manifest_directory', '//Sequence Data and Reporting/Submissions/manifest/')
+    pack_directory = default_pack_directory(objects, settings.archive_directory)
+
+    policies = check_policies(objects.get('retention_policies', []))
+    if not policies:
+        print('No retention_policies set: every archive copy is kept.')
+
+    index = RetentionIndex(index_path(manifest_directory), read_only=args.dry_run)
+    try:
+        added, recomputed = index.update(manifest_directory, policies)
+        print('Retention index:  {} new copies{}'.format(added, ', expiry recomputed for the new policies' if recomputed else ''))
+
+        if args.dry_run:
+            summary = prune(index, settings.archive_directory, pack_directory, dry_run=True, on=args.as_of)
+        else:
+            os.makedirs(pack_directory, exist_ok=True)
+            lock = pack_lock(pack_directory, 'retention')
+            try:
+                lock.acquire()
+            except LockHeld as e:
+                print(e)
+                return 75
+            try:
+                summary = prune(index, settings.archive_directory, pack_directory, batch_size=args.batch, on=args.as_of,
+                                max_seconds=args.max_minutes * 60 if args.max_minutes else None)
+            finally:
+                lock.release()
+    finally:
+        index.close()
+
+    print(format_summary(summary, args.dry_run))
+
+    return 0
+
+
+if __name__ == '__main__':
+    import sys
+    sys.exit(main())
@@ -0,0 +1,341 @@
+# -*- coding: utf-8 -*-
+"""
+Scheduler entry point for the SFT pull.
+
+Runs pull -> analytics -> report as one small DAG under a run id, holding an advisory
+lock so two pulls can never overlap (and double-download or double-delete).  Exit codes
+are meant for cron / Task Scheduler:
+
+0  -- everything ran
+1  -- a step failed
+2  -- bad command line
+3  -- pull succeeded but a later step (analytics, report) failed
+75 -- another run holds the lock (EX_TEMPFAIL: try again at the next slot)
+
+Example (every 15 minutes, report once a day):
+    */15 * * * *  python sft_run.py --no-report
+    0 16 * * *    python sft_run.py
+"""
+###############################################################################################################
+###############################################################################################################
+
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import datetime
+import threading
+
+from sft_manifest import new_run_id
+
+EXIT_OK = 0
+EXIT_FAILED = 1
+EXIT_USAGE = 2
+EXIT_PARTIAL = 3
+EXIT_LOCKED = 75
+
+# Default lock location: next to the objects file, so it is shared by every machine that pulls
+DEFAULT_LOCK_PATH = '//Sequence Data and Reporting/Data_Objects/SFT/sft_run.lock'
+
+###############################################################################################################
+###############################################################################################################
+
+####################################################################################
+# Advisory run lock
+####################################################################################
+
+class LockHeld(Exception):
+    '''Raised when another run holds the lock.'''
+
+
+class RunLock:
+
+    '''
+    (Python)
+
+    Advisory lock for a pull run.
+
+    Local paths on Linux/macOS use fcntl.flock, which the kernel releases if the process
+    dies.  Paths on the share (or Windows) use a lock file holding the owner's run id and
+    a lease expiry; a background thread renews the lease, and a lock whose lease has
+    expired (crashed owner) is taken over.  If the lease is found taken over while held,
+    the lost event is set so the run can stop before it touches the SFT again.
+
+    --------------------------------------------------------------------------------------
+
+    Keyword arguments:
+    path -- lock file path
+    run_id -- id of the run taking the lock
+    lease_seconds -- how long a lease lasts without renewal (lease-file mode only)
+    use_fcntl -- True/False to force a mode.  Default: fcntl for local POSIX paths.
+
+    --------------------------------------------------------------------------------------
+
+    Example:
+    with RunLock('//Sequence Data and Reporting/Data_Objects/SFT/sft_run.lock', run_id):
+        run_pull(run_id)
+    '''
+
+    def __init__(self, path, run_id, lease_seconds=30 * 60, use_fcntl=None):
+        self.path = path
+        self.run_id = run_id
+        self.lease_seconds = lease_seconds
+        self._file = None
+        self._stop = threading.Event()
+        self._heartbeat = None
+        self.lost = threading.Event()
+
+        if use_fcntl is None:
+            use_fcntl = os.name == 'posix' and not path.startswith(('//', '\\\\'))
+        self.use_fcntl = use_fcntl
+
+    # ---- lease file helpers ----
+
+    def _lease(self):
+        now = time.time()
+        return {'run_id': self.run_id, 'host': socket.gethostname(), 'pid': os.getpid(),
+                'acquired_at': now, 'expires_at': now + self.lease_seconds}
+
+    def _read(self):
+        try:
+            with open(self.path, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _write_over(self, lease):
+        temp_path = '{}.{}.tmp'.format(self.path, self.run_id)
+        with open(temp_path, 'w') as f:
+            json.dump(lease, f)
+        os.replace(temp_path, self.path)
+
+    def _renew(self):
+        while not self._stop.wait(self.lease_seconds / 3):
+            current = self._read()
+            if current is None or current.get('run_id') != self.run_id:
+                print('Run lock lost to {}'.format(current))
+                self.lost.set()
+                return
+            lease = self._lease()
+            lease['acquired_at'] = current['acquired_at']
+            self._write_over(lease)
+
+    # ---- public interface ----
+
+    def acquire(self):
+
+        if self.use_fcntl:
+            import fcntl
+            self._file = open(self.path, 'a+')
+            try:
+                fcntl.flock(self._file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                self._file.close()
+                self._file = None
+                raise LockHeld('Lock {} is held by another process'.format(self.path))
+            self._file.seek(0)
+            self._file.truncate()
+            self._file.write(json.dumps(self._lease()))
+            self._file.flush()
+            return self
+
+        try:
+            fd = os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            with os.fdopen(fd, 'w') as f:
+                json.dump(self._lease(), f)
+        except FileExistsError:
+            current = self._read()
+            if current is not None and current.get('expires_at', 0) > time.time():
+                raise LockHeld('Run {} on {} holds {} until {}'.format(
+                    current.get('run_id'), current.get('host'), self.path,
+                    datetime.datetime.fromtimestamp(current['expires_at']).isoformat(timespec='seconds')))
+
+            # Expired (or unreadable) lease: take it over, then make sure nobody else did at the same time
+            print('Taking over expired run lock:  {}'.format(current))
+            self._write_over(self._lease())
+            time.sleep(1)
+            current = self._read()
+            if current is None or current.get('run_id') != self.run_id:
+                raise LockHeld('Lost the race for expired lock {}'.format(self.path))
+
+        self._heartbeat = threading.Thread(target=self._renew, name='sft-lock-lease', daemon=True)
+        self._heartbeat.start()
+        return self
+
+    def release(self):
+
+        if self.use_fcntl:
+            if self._file is not None:
+                import fcntl
+                fcntl.flock(self._file, fcntl.LOCK_UN)
+                self._file.close()
+                self._file = None
+            return
+
+        self._stop.set()
+        if self._heartbeat is not None:
+            self._heartbeat.join()
+        current = self._read()
+        if current is not None and current.get('run_id') == self.run_id:
+            os.remove(self.path)
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, *exc):
+        self.release()
+
+###############################################################################################################
+###############################################################################################################
+
+####################################################################################
+# Running the steps
+####################################################################################
+
+def run_steps(steps):
+
+    '''
+    (Python)
+
+    Runs (name, function, depends_on) steps in order.  A step whose dependencies did not
+    all succeed is skipped.  Returns {name: 'ok' | 'failed' | 'skipped'}.
+
+    --------------------------------------------------------------------------------------
+
+    Example:
+    run_steps([('pull', run_pull, ()), ('report', run_report, ('pull',))])
+    '''
+
+    status = {}
+
+    for name, function, depends_on in steps:
+
+        if any(status.get(d) != 'ok' for d in depends_on):
+            print('Skipping {}:  depends on {}'.format(name, ', '.join(depends_on)))
+            status[name] = 'skipped'
+            continue
+
+        started = time.monotonic()
+        try:
+            function()
+            status[name] = 'ok'
+        except Exception as e:
+            print('Step {} failed:  {}: {}'.format(name, type(e).__name__, str(e)))
+            status[name] = 'failed'
+
+        print('Step {} {} in {:.1f}s'.format(name, status[name], time.monotonic() - started))
+
+    return status
+
+
+def update_analytics():
+    '''Folds the run's manifest records into the daily analytics aggregates (see sft_analytics).'''
+
+    import pickle
+    from sft_settings import get_settings
+    from sft_analytics import update_aggregates
+
+    objects = pickle.load(open(get_settings().objects_path, 'rb'))
+    _, added = update_aggregates(objects.get('manifest_directory', '//Sequence Data and Reporting/Submissions/manifest/'))
+    print('Analytics:  {} new record(s) aggregated'.format(added))
+
+
+def exit_code_for(status):
+    '''Maps step statuses to the cron exit codes listed at the top of the module.'''
+
+    if all(s == 'ok' for s in status.values()):
+        return EXIT_OK
+    if status.get('pull') == 'ok':
+        return EXIT_PARTIAL
+    return EXIT_FAILED
+
+###############################################################################################################
+###############################################################################################################
+
+####################################################################################
+# Command line
+####################################################################################
+
+def parse_args(argv=None):
+
+    parser = argparse.ArgumentParser(description='Pull files from the SFT and send the daily report.')
+    parser.add_argument('--since', type=datetime.date.fromisoformat, default=None,
+                        help='report on every day from this date (YYYY-MM-DD) through today')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='move nothing and send nothing; print the pull plan and the report that would go out')
+    parser.add_argument('--no-report', action='store_true', help='pull only')
+    parser.add_argument('--lock-path', default=DEFAULT_LOCK_PATH, help='advisory lock file')
+    parser.add_argument('--lease-minutes', type=float, default=30, help='lease length for share lock files')
+
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+
+    '''
+    (Python)
+
+    Runner entry point.  Returns the process exit code.
+    '''
+
+    try:
+        args = parse_args(argv)
+    except SystemExit as e:
+        return EXIT_USAGE if e.code else EXIT_OK
+
+    run_id = new_run_id()
+    print('SFT run {} starting{}'.format(run_id, ' (dry run)' if args.dry_run else ''))
+
+    lock = RunLock(args.lock_path, run_id, lease_seconds=args.lease_minutes * 60)
+    try:
+        lock.acquire()
+    except LockHeld as e:
+        print('Another run is in progress, exiting:  {}'.format(str(e)))
+        return EXIT_LOCKED
+
+    # Imported inside the steps, so a locked-out run exits without loading selenium/pandas
+    # and an import error is reported as that step failing
+    def pull():
+        from sft_main import run_pull
+        run_pull(run_id, lock_lost=lock.lost)
+
+    def plan():
+        from sft_plan import run_plan, format_plan
+        print(format_plan(run_plan()))
+
+    def report(send=True):
+        from sft_email import run_report
+        report = run_report(since=args.since, send=send)
+        if not send:
+            print(report['text'])
+
+    try:
+        if args.dry_run:
+            steps = [('pull', plan, ()),
+                     ('report', lambda: report(send=False), ('pull',))]
+        else:
+            steps = [('pull', pull, ()),
+                     ('analytics', update_analytics, ('pull',))]
+            if not args.no_report:
+                steps.append(('report', report, ('pull',)))
+
+        status = run_steps(steps)
+
+    finally:
+        lock.release()
+
+    code = exit_code_for(status)
+
+    # Another run took the lock over while this one held it: never report success
+    if lock.lost.is_set():
+        print('Run lock was lost during the run')
+        code = EXIT_FAILED
+    print('SFT run {} finished with exit code {}:  {}'.format(run_id, code, status))
+
+    return code
+
+
+if __name__ == '__main__':
+    sys.exit(main())
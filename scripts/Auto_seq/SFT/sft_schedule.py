@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+"""
+Pull order: submitter priority, aging and small files first.
+
+Each submitter can be given a priority in sft_expected_directories.csv (a Priority
+column: urgent, high, normal, low or a number, 0 being the most urgent; blank means
+normal).  The pull visits submitters most urgent first, and inside a folder downloads
+the smallest files first, so most files reach their destination early in the run.
+
+Priorities age: a submitter whose files have been waiting on the SFT (seen by an
+earlier run and still not pulled, per the listing cache) moves up one level for every
+priority_aging_hours they have waited, so a low-priority submitter is never starved by
+busy urgent ones.
+
+Each manifest record gets the file's priority and its time to availability: seconds
+from when the file was first seen on the SFT (its SFT timestamp when the page shows
+one) to when its placed copy was verified on the share.  availability_report() sums
+them per priority against priority_sla_minutes.
+"""
+###############################################################################################################
+###############################################################################################################
+
+import time
+import datetime
+
+PRIORITY_COLUMN = 'Priority'
+
+PRIORITY_LEVELS = {'urgent': 0, 'high': 1, 'normal': 2, 'low': 3}
+PRIORITY_NAMES = {level: name for name, level in PRIORITY_LEVELS.items()}
+DEFAULT_PRIORITY = PRIORITY_LEVELS['normal']
+
+###############################################################################################################
+###############################################################################################################
+
+####################################################################################
+# Priorities
+####################################################################################
+
+def priority_of(crosswalk):
+    '''A submitter's priority from its crosswalk row (0 most urgent; DEFAULT_PRIORITY when blank or unknown).'''
+
+    value = str((crosswalk or {}).get(PRIORITY_COLUMN) or '').strip().lower()
+    if value in PRIORITY_LEVELS:
+        return PRIORITY_LEVELS[value]
+
+    try:
+        return max(0, int(value))
+    except ValueError:
+        return DEFAULT_PRIORITY
+
+
+def priority_name(priority):
+    return PRIORITY_NAMES.get(priority, str(priority))
+
+
+def effective_priority(priority, waiting_seconds, aging_hours):
+    '''priority less one level per aging_hours waited (lower runs first).'''
+
+    if not aging_hours or not waiting_seconds:
+        return priority
+
+    return priority - waiting_seconds / (aging_hours * 60 * 60)
+
+
+def waiting_since(listing_cache, navigation_key):
+
+    '''
+    (Python)
+
+    {submitter: epoch seconds} of the oldest file each submitter has left waiting on the
+    SFT: files an earlier run listed in a folder it did not manage to empty.
+
+    --------------------------------------------------------------------------------------
+
+    Keyword arguments:
+    listing_cache -- sft_listing_cache.ListingCache (None: nothing is known to be waiting)
+    navigation_key -- build_navigation_key() output
+    '''
+
+    if listing_cache is None:
+        return {}
+
+    oldest = {}
+    for folder in navigation_key:
+        seen = listing_cache.waiting_since(folder.id)
+        if seen is not None and seen < oldest.get(folder.dir1, float('inf')):
+            oldest[folder.dir1] = seen
+
+    return oldest
+
+
+def order_navigation_key(navigation_key, waiting=None, aging_hours=6, now=None):
+
+    '''
+    (Python)
+
+    Reorders the navigation key by submitter priority (aged by how long each submitter's
+    files have waited), then submitter name.  A submitter's own folders keep their order
+    (deepest first), since sub-directories are deleted from their parent folder.
+
+    --------------------------------------------------------------------------------------
+
+    Keyword arguments:
+    navigation_key -- build_navigation_key() output
+    waiting -- waiting_since() output
+    aging_hours -- hours of waiting worth one priority level (0: no aging)
+    now -- epoch seconds (default: now)
+    '''
+
+    now = time.time() if now is None else now
+    waiting = waiting or {}
+
+    submitters = {}
+    for folder in navigation_key:
+        submitters.setdefault(folder.dir1, []).append(folder)
+
+    def rank(submitter):
+        priority = priority_of(submitters[submitter][0].crosswalk)
+        waited = now - waiting[submitter] if submitter in waiting else 0
+        return effective_priority(priority, waited, aging_hours), submitter
+
+    return [folder for submitter in sorted(submitters, key=rank) for folder in submitters[submitter]]
+
+
+def order_files(content_nodes):
+    '''A folder's files, smallest first (unknown sizes last, in listing order).'''
+
+    files = [node for node in content_nodes if not node.is_directory]
+
+    return sorted(files, key=lambda node: (node.size is None, node.size or 0))
+
+###############################################################################################################
+###############################################################################################################
+
+####################################################################################
+# Time to availability
+####################################################################################
+
+def arrival_time(node, first_seen=None):
+
+    '''
+    (Python)
+
+    Best estimate of when a file arrived on the SFT, as epoch seconds: its SFT
+    timestamp if the page shows one, else when the pull first listed it, else now.
+    '''
+
+    if node.mtime:
+        try:
+            arrived = datetime.datetime.fromisoformat(str(node.mtime)).timestamp()
+            if arrived <= time.time():
+                return arrived
+        except ValueError:
+            pass
+
+    return first_seen if first_seen is not None else time.time()
+
+
+def _percentile(values, p):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+
+def availability_report(records, sla_minutes=None):
+
+    '''
+    (Python)
+
+    One line per priority: files, median / p95 / max time to availability, and how
+    many missed the priority's SLA.
+
+    --------------------------------------------------------------------------------------
+
+    Keyword arguments:
+    records -- manifest records of the run
+    sla_minutes -- {priority name: minutes}, e.g. {'urgent': 15, 'high': 60}
+    '''
+
+    by_priority = {}
+    for record in records:
+        if record.get('available_seconds') is not None:
+            by_priority.setdefault(record.get('priority', DEFAULT_PRIORITY), []).append(record['available_seconds'])
+
+    if not by_priority:
+        return 'Time to availability:  no files'
+
+    lines = ['Time to availability (first seen on the SFT -> verified on the share):']
+    for priority, seconds in sorted(by_priority.items()):
+        name = priority_name(priority)
+        line = '  {:<8} {:>5} file(s)  median {:>7.1f} min  p95 {:>7.1f} min  max {:>7.1f} min'.format(
+            name, len(seconds), _percentile(seconds, 50) / 60, _percentile(seconds, 95) / 60, max(seconds) / 60)
+        sla = (sla_minutes or {}).get(name)
+        if sla is not None:
+            line += '  {} over the {} min SLA'.format(sum(s > sla * 60 for s in seconds), sla)
+        lines.append(line)
+
+    return '\n'.join(lines)
@@ -0,0 +1,350 @@
+# -*- coding: utf-8 -*-
+"""
+Archive integrity scrubber.
+
+Every manifest record (see sft_manifest) carries the size and sha256 the pull verified
+when it wrote the archive copy and the placed file.  The scrubber re-reads those files
+in a process pool and reports the ones that are missing, truncated, grown or corrupted.
+Archive copies the packer has moved into the cold tier (sft_pack) are read from their pack;
+copies retention deleted (sft_retention) are skipped.
+
+Reads are rate-limited (the share is shared with the roster jobs), and progress is kept
+as a cursor into the manifest, so a scrub that runs out of time continues where it
+stopped on the next run and a full pass can be spread over several nights.  State and
+the current list of problems live in sft_scrub_status.json next to the manifest.
+
+    python sft_scrub.py --mb-per-second 40 --max-minutes 240
+"""
+###############################################################################################################
+###############################################################################################################
+
+import os
+import json
+import time
+import pickle
+import hashlib
+import datetime
+import argparse
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+from sft_manifest import read_since
+from sft_governor import TokenBucket
+from sft_retention import retired_archives
+
+STATUS_FILENAME = 'sft_scrub_status.json'
+
+# Object states
+OK, MISSING, TRUNCATED, GROWN, CORRUPTED, UNREADABLE = 'ok', 'missing', 'truncated', 'grown', 'corrupted', 'unreadable'
+
+CHUNK_SIZE = 4 * 1024 * 1024
+
+###############################################################################################################
+###############################################################################################################
+
+####################################################################################
+# Verifying one object
+####################################################################################
+
+# Per-process read budget and pack folder (set up in each worker by _init_worker)
+_bucket = None
+_pack_directory = None
+
+
+def _init_worker(bytes_per_second, pack_directory=None):
+    global _bucket, _pack_directory
+    _bucket = TokenBucket(bytes_per_second, CHUNK_SIZE) if bytes_per_second else None
+    _pack_directory = pack_directory
+
+
+def verify_object(path, size, sha256, bucket=None, chunk_size=CHUNK_SIZE):
+
+    '''
+    (Python)
+
+    Checks a file against the size and sha256 recorded when it was written.
+
+    --------------------------------------------------------------------------------------
+
+    Keyword arguments:
+    path -- file to check
+    size -- expected size in bytes (None: not checked)
+    sha256 -- expected hex digest (None: only existence and size are checked)
+    bucket -- optional sft_governor.TokenBucket limiting the read rate
+
+    --------------------------------------------------------------------------------------
+
+    Returns:
+    (state, detail) -- state is one of ok, missing, truncated, grown, corrupted, unreadable
+    '''
+
+    try:
+        actual_size = os.path.getsize(path)
+    except FileNotFoundError:
+        return MISSING, None
+    except OSError as e:
+        return UNREADABLE, str(e)
+
+    if size is not None and actual_size != size:
+        return (TRUNCATED if actual_size < size else GROWN), '{} bytes, expected {}'.format(actual_size, size)
+
+    if sha256 is None:
+        return OK, None
+
+    sha = hashlib.sha256()
+    try:
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                if bucket is not None:
+                    bucket.consume(len(chunk))
+                sha.update(chunk)
+    except OSError as e:
+        return UNREADABLE, str(e)
+
+    if sha.hexdigest() != sha256:
+        return CORRUPTED, 'sha256 {}, expected {}'.format(sha.hexdigest(), sha256)
+
+    return OK, None
+
+
+def _verify_job(path, size, sha256, kind='archive'):
+    '''Worker-process entry point.  An archive copy no longer on disk is checked in its pack (see sft_pack).'''
+
+    state, detail = verify_object(path, size, sha256, _bucket)
+    if state == MISSING and kind == 'archive' and _pack_directory:
+        from sft_pack import verify_packed
+        return verify_packed(_pack_directory, os.path.basename(path), size, sha256, _bucket)
+
+    return state, detail
+
+###############################################################################################################
+###############################################################################################################
+
+####################################################################################
+# Scrubbing the manifest
+####################################################################################
+
+def load_status(manifest_directory):
+    '''Scrub state: cursor, pass times and the current problems {path: {...}}.'''
+
+    path = os.path.join(manifest_directory, STATUS_FILENAME)
+    if not os.path.exists(path):
+        return {'cursor': 0, 'pass_started_at': None, 'last_pass_completed_at': None, 'problems': {}}
+
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def save_status(manifest_directory, status):
+
+    path = os.path.join(manifest_directory, STATUS_FILENAME)
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w') as f:
+        json.dump(status, f, indent=1, sort_keys=True)
+    os.replace(temp_path, path)
+
+
+def scrub_objects(record, include_destinations=False):
+    '''(kind, path) of the files a manifest record vouches for.'''
+
+    objects = [('archive', record.get('archive_path'))]
+    if include_destinations:
+        objects.append(('destination', record.get('destination_path')))
+
+    return [(kind, path) for kind, path in objects if path]
+
+
+def scrub(manifest_directory, workers=4, bytes_per_second=None, max_seconds=None, include_destinations=False,
+          restart=False, checkpoint_every=500, pack_directory=None):
+
+    '''
+    (Python)
+
+    Verifies the files of every manifest record after the scrub cursor, oldest first,
+    then starts the next pass from the beginning.
+
+    --------------------------------------------------------------------------------------
+
+    Keyword arguments:
+    manifest_directory -- folder holding the manifest (and the scrub status)
+    workers -- hashing processes
+    bytes_per_second -- total read rate across the workers.  None: unlimited.
+    max_seconds -- stop submitting new files after this long; the cursor keeps the place
+    include_destinations -- also verify the placed files (the default is archive copies
+                            only, since downstream jobs move placed files on)
+    restart -- start a fresh pass instead of resuming
+    checkpoint_every -- save the cursor after this many records
+    pack_directory -- folder of the archive packs (sft_pack): archive copies moved there
+                      are verified in their pack
+
+    --------------------------------------------------------------------------------------
+
+    Returns:
+    dict with checked, bytes, counts per state, new_problems, pass_completed, cursor
+    '''
+
+    status = load_status(manifest_directory)
+    if restart:
+        status['cursor'] = 0
+    if status['cursor'] == 0:
+        status['pass_started_at'] = datetime.datetime.now().isoformat(timespec='seconds')
+
+    records, _ = read_since(manifest_directory, status['cursor'])
+
+    # Copies retention deleted on purpose are not problems
+    retired = retired_archives(manifest_directory)
+    for path in retired.intersection(status['problems']):
+        status['problems'].pop(path)
+    started = time.monotonic()
+    per_worker_rate = bytes_per_second / workers if bytes_per_second else None
+
+    summary = {'checked': 0, 'bytes': 0, 'counts': {}, 'new_problems': [], 'pass_completed': False}
+
+    # Records are finished in any order; the cursor only moves past a record once it and
+    # every record before it are done
+    remaining = {}
+    order = deque()
+    in_flight = {}
+    position = 0
+    since_checkpoint = 0
+
+    def advance_cursor():
+        while order and remaining.get(order[0]) == 0:
+            status['cursor'] = order.popleft()
+            remaining.pop(status['cursor'])
+
+    with ProcessPoolExecutor(max_workers=max(1, workers), initializer=_init_worker, initargs=(per_worker_rate, pack_directory)) as pool:
+
+        while position < len(records) or in_flight:
+
+            # Keep a bounded window in flight, in seq order
+            out_of_time = max_seconds is not None and time.monotonic() - started > max_seconds
+            while not out_of_time and position < len(records) and len(in_flight) < workers * 4:
+                record = records[position]
+                position += 1
+                objects = [(kind, path) for kind, path in scrub_objects(record, include_destinations)
+                           if not (kind == 'archive' and path in retired)]
+                order.append(record['seq'])
+                remaining[record['seq']] = len(objects)
+                for kind, path in objects:
+                    future = pool.submit(_verify_job, path, record.get('size'), record.get('sha256'), kind)
+                    in_flight[future] = (record, kind, path)
+
+            if not in_flight:
+                advance_cursor()
+                break
+
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                record, kind, path = in_flight.pop(future)
+                try:
+                    state, detail = future.result()
+                except Exception as e:
+                    state, detail = UNREADABLE, '{}: {}'.format(type(e).__name__, str(e))
+
+                summary['checked'] += 1
+                summary['counts'][state] = summary['counts'].get(state, 0) + 1
+                if state == OK:
+                    summary['bytes'] += record.get('size') or 0
+                    status['problems'].pop(path, None)
+                else:
+                    problem = {'state': state, 'detail': detail, 'kind': kind, 'seq': record['seq'],
+                               'submitter': record.get('submitter'), 'sha256': record.get('sha256'),
+                               'checked_at': datetime.datetime.now().isoformat(timespec='seconds')}
+                    if status['problems'].get(path, {}).get('state') != state:
+                        summary['new_problems'].append(dict(problem, path=path))
+                    status['problems'][path] = problem
+
+                remaining[record['seq']] -= 1
+
+            advance_cursor()
+            since_checkpoint += len(done)
+            if since_checkpoint >= checkpoint_every:
+                save_status(manifest_directory, status)
+                since_checkpoint = 0
+
+    # Everything up to the end of the manifest verified: the next run starts a new pass
+    if position >= len(records) and not order:
+        summary['pass_completed'] = True
+        status['cursor'] = 0
+        status['last_pass_completed_at'] = datetime.datetime.now().isoformat(timespec='seconds')
+
+    save_status(manifest_directory, status)
+
+    summary['cursor'] = status['cursor']
+    summary['seconds'] = time.monotonic() - started
+    summary['open_problems'] = len(status['problems'])
+
+    return summary
+
+
+def format_summary(summary, status=None):
+    '''Text report of a scrub run.'''
+
+    counts = ', '.join('{} {}'.format(n, state) for state, n in sorted(summary['counts'].items())) or 'nothing'
+    rate = summary['bytes'] / summary['seconds'] / 1024 / 1024 if summary['seconds'] else 0.0
+
+    lines = ['Scrub:  checked {} object(s) in {:.1f}s ({:.1f} MB/s verified):  {}'.format(
+                 summary['checked'], summary['seconds'], rate, counts),
+             'Pass {}; cursor {}; {} open problem(s)'.format(
+                 'completed' if summary['pass_completed'] else 'in progress', summary['cursor'], summary['open_problems'])]
+
+    for problem in summary['new_problems']:
+        lines.append('  NEW {:<10} {}  {}'.format(problem['state'], problem['path'], problem['detail'] or ''))
+
+    return '\n'.join(lines)
+
+###############################################################################################################
+###############################################################################################################
+
+####################################################################################
+# Command line
+####################################################################################
+
+def main(argv=None):
+
+    '''
+    (Python)
+
+    Command line for the scrubber (also `sft scrub`).  Exit code 1 when there are open
+    problems, so a nightly scheduler can alert on it.
+    '''
+
+    parser = argparse.ArgumentParser(description='Re-verify archived files against their pull-time checksums.')
+    parser.add_argument('--workers', type=int, default=4, help='hashing processes (default 4)')
+    parser.add_argument('--mb-per-second', type=float, default=None, help='total read rate limit (default: unlimited)')
+    parser.add_argument('--max-minutes', type=float, default=None, help='stop after this long and resume next time')
+    parser.add_argument('--destinations', action='store_true', help='also verify the placed files')
+    parser.add_argument('--restart', action='store_true', help='start a new pass instead of resuming')
+    parser.add_argument('--problems', action='store_true', help='list the open problems and exit')
+    parser.add_argument('--manifest-dir', help='manifest folder (default: manifest_directory from the objects file)')
+    args = parser.parse_args(argv)
+
+    from sft_pack import default_pack_directory
+    from sft_settings import get_settings
+
+    settings = get_settings()
+    objects = pickle.load(open(settings.objects_path, 'rb'))
+    manifest_directory = args.manifest_dir or objects.get('manifest_directory', '//Sequence Data and Reporting/Submissions/manifest/')
+
+    if args.problems:
+        problems = load_status(manifest_directory)['problems']
+        for path, problem in sorted(problems.items()):
+            print('{:<10} {}  {}'.format(problem['state'], path, problem['detail'] or ''))
+        return 1 if problems else 0
+
+    summary = scrub(manifest_directory,
+                    workers=args.workers,
+                    bytes_per_second=args.mb_per_second * 1024 * 1024 if args.mb_per_second else None,
+                    max_seconds=args.max_minutes * 60 if args.max_minutes else None,
+                    include_destinations=args.destinations,
+                    restart=args.restart,
+                    pack_directory=default_pack_directory(objects, settings.archive_directory))
+    print(format_summary(summary))
+
+    return 1 if summary['open_problems'] else 0
+
+
+if __name__ == '__main__':
+    import sys
+    sys.exit(main())
@@ -0,0 +1,324 @@
+# -*- coding: utf-8 -*-
+"""
+Paths and credentials for the SFT scripts, resolved once per process.
+
+Each value is looked up in this order and the first one found wins:
+
+1. environment variables (SFT_SEQUENCING_PATH, SFT_USER, SFT_PASSWORD, SFT_SMTP_USERNAME,
+   SFT_SMTP_PASSWORD) -- the headless / cron route, no keyring needed
+2. an encrypted settings file (SFT_SETTINGS_FILE, default ~/.sft_settings.enc): Fernet-
+   encrypted JSON, key in SFT_SETTINGS_KEY or keyring ('sequencing', 'settings_key')
+3. the shared creds.yml (%USERPROFILE%/Projects/Sequencing/creds.yml, see creds_TEMPLATE.yml):
+   paths.network_drive and sft.username / sft.password of the default profile
+4. keyring ('sequencing', 'fpath') and the legacy py_creds.p pickle
+
+get_settings() caches the result, so the pull, log and email steps share one lookup and
+per-file calls cost a dictionary read.
+"""
+###############################################################################################################
+###############################################################################################################
+
+import os
+import json
+import pickle
+
+# Used when nothing else says where the sequencing folder is (the value sft_main used to hard-code)
+DEFAULT_SEQUENCING_PATH = '//Sequence Data and Reporting'
+
+DEFAULT_SETTINGS_FILE = os.path.join(os.path.expanduser('~'), '.sft_settings.enc')
+
+# Setting name -> environment variable
+ENVIRONMENT_VARIABLES = {
+    'sequencing_path': 'SFT_SEQUENCING_PATH',
+    'sft_user': 'SFT_USER',
+    'sft_pw': 'SFT_PASSWORD',
+    'smtp_username': 'SFT_SMTP_USERNAME',
+    'smtp_password': 'SFT_SMTP_PASSWORD',
+}
+
+# Settings that are never printed
+SECRET_KEYS = ('sft_pw', 'smtp_password')
+
+_settings = None
+
+###############################################################################################################
+###############################################################################################################
+
+####################################################################################
+# The settings object
+####################################################################################
+
+class Settings:
+
+    '''
+    (Python)
+
+    Resolved paths and credentials.  Build it with get_settings() rather than directly.
+
+    --------------------------------------------------------------------------------------
+
+    Keyword arguments:
+    values -- dict of setting name -> value (see ENVIRONMENT_VARIABLES for the names)
+    sources -- dict of setting name -> where the value came from (for printing)
+
+    --------------------------------------------------------------------------------------
+
+    Example:
+    settings = get_settings()
+    objects = pickle.load(open(settings.objects_path, 'rb'))
+    login(driver, settings.sft_user, settings.sft_pw)
+    '''
+
+    def __init__(self, values, sources=None):
+        self.values = dict(values)
+        self.sources = dict(sources or {})
+
+    def get(self, key, default=None):
+        return self.values.get(key, default)
+
+    @property
+    def sequencing_path(self):
+        return self.values.get('sequencing_path') or DEFAULT_SEQUENCING_PATH
+
+    @property
+    def sft_user(self):
+        return self._required('sft_user')
+
+    @property
+    def sft_pw(self):
+        return self._required('sft_pw')
+
+    def _required(self, key):
+        value = self.values.get(key)
+        if value is None:
+            raise KeyError('{} is not set.  Set {} or add it to the settings file.'.format(key, ENVIRONMENT_VARIABLES[key]))
+        return value
+
+    # ---- paths under the sequencing folder ----
+
+    @property
+    def objects_path(self):
+        return f'{self.sequencing_path}/Data_Objects/SFT/sft_objects.p'
+
+    @property
+    def expected_dirs_path(self):
+        return f'{self.sequencing_path}/Data_Objects/SFT/sft_expected_directories.csv'
+
+    @property
+    def pull_log_path(self):
+        return f'{self.sequencing_path}/Submissions/sft_automated_pull_log.csv'
+
+    @property
+    def archive_directory(self):
+        return f'{self.sequencing_path}/Submissions/ARCHIVE_copies/'
+
+    def notify_config(self, objects):
+        '''objects with any SMTP credentials from the settings laid over it, for notifier_from_config().'''
+
+        config = dict(objects)
+        for key in ('smtp_username', 'smtp_password'):
+            if self.values.get(key) is not None:
+                config[key] = self.values[key]
+
+        return config
+
+    def __repr__(self):
+        shown = {k: ('***' if k in SECRET_KEYS else v) for k, v in self.values.items()}
+        return 'Settings({}, sources={})'.format(shown, self.sources)
+
+###############################################################################################################
+###############################################################################################################
+
+####################################################################################
+# Sources
+####################################################################################
+
+def from_environment():
+    '''Settings given as environment variables.'''
+
+    return {key: os.environ[name] for key, name in ENVIRONMENT_VARIABLES.items() if os.environ.get(name)}
+
+
+def _keyring_password(service, name):
+    '''keyring lookup that returns None instead of failing when keyring (or a backend) is missing.'''
+
+    try:
+        import keyring
+        return keyring.get_password(service, name)
+    except Exception:
+        return None
+
+
+def from_encrypted_file(path=None, key=None):
+
+    '''
+    (Python)
+
+    Settings from a Fernet-encrypted JSON file.  Returns {} if the file doesn't exist.
+    Needs the cryptography package.
+
+    --------------------------------------------------------------------------------------
+
+    Keyword arguments:
+    path -- the file.  Default: SFT_SETTINGS_FILE, else ~/.sft_settings.enc
+    key -- Fernet key.  Default: SFT_SETTINGS_KEY, else keyring ('sequencing', 'settings_key')
+    '''
+
+    path = path or os.environ.get('SFT_SETTINGS_FILE') or DEFAULT_SETTINGS_FILE
+    if not os.path.exists(path):
+        return {}
+
+    key = key or os.environ.get('SFT_SETTINGS_KEY') or _keyring_password('sequencing', 'settings_key')
+    if not key:
+        raise KeyError('{} exists but no key was found in SFT_SETTINGS_KEY or the keyring'.format(path))
+
+    from cryptography.fernet import Fernet
+
+    with open(path, 'rb') as f:
+        return json.loads(Fernet(key).decrypt(f.read()))
+
+
+def write_encrypted_file(values, path=None, key=None):
+
+    '''
+    (Python)
+
+    Writes settings to a Fernet-encrypted JSON file.  Generates a key if none is given.
+    Returns the key (store it in SFT_SETTINGS_KEY or the keyring).
+
+    --------------------------------------------------------------------------------------
+
+    Example:
+    key = write_encrypted_file({'sft_user': 'me', 'sft_pw': '...', 'sequencing_path': '//Sequence Data and Reporting'})
+    keyring.set_password('sequencing', 'settings_key', key)
+    '''
+
+    from cryptography.fernet import Fernet
+
+    path = path or os.environ.get('SFT_SETTINGS_FILE') or DEFAULT_SETTINGS_FILE
+    key = key or Fernet.generate_key().decode()
+
+    temp_path = path + '.tmp'
+    with open(temp_path, 'wb') as f:
+        f.write(Fernet(key).encrypt(json.dumps(values).encode()))
+    os.replace(temp_path, path)
+
+    return key
+
+
+def from_creds_yml(path=None):
+
+    '''
+    (Python)
+
+    Settings from the shared creds.yml (default profile).  Returns {} if the file or
+    PyYAML is missing.
+    '''
+
+    if path is None:
+        home = os.environ.get('USERPROFILE') or os.path.expanduser('~')
+        path = os.path.join(home, 'Projects', 'Sequencing', 'creds.yml')
+
+    if not os.path.exists(path):
+        return {}
+
+    try:
+        import yaml
+    except ImportError:
+        return {}
+
+    with open(path, 'r') as f:
+        profile = (yaml.safe_load(f) or {}).get('default') or {}
+
+    values = {
+        'sequencing_path': (profile.get('paths') or {}).get('network_drive'),
+        'sft_user': (profile.get('sft') or {}).get('username'),
+        'sft_pw': (profile.get('sft') or {}).get('password'),
+    }
+
+    return {k: v for k, v in values.items() if v}
+
+
+def from_legacy_stores():
+
+    '''
+    (Python)
+
+    The stores the scripts used before: keyring ('sequencing', 'fpath') for the
+    sequencing path and C:/Users/<user>/Projects/Sequencing/Data_Objects/py_creds.p for
+    the SFT login.
+    '''
+
+    values = {}
+
+    sequencing_path = _keyring_password('sequencing', 'fpath')
+    if sequencing_path:
+        values['sequencing_path'] = sequencing_path
+
+    try:
+        creds_path = f'C:/Users/{os.getlogin()}/Projects/Sequencing/Data_Objects/py_creds.p'
+    except OSError:
+        creds_path = None
+
+    if creds_path and os.path.exists(creds_path):
+        with open(creds_path, 'rb') as f:
+            py_creds = pickle.load(f)
+        values.update({k: py_creds[k] for k in ('sft_user', 'sft_pw') if py_creds.get(k)})
+
+    return values
+
+###############################################################################################################
+###############################################################################################################
+
+####################################################################################
+# Loading (once per process)
+####################################################################################
+
+def load_settings():
+
+    '''
+    (Python)
+
+    Resolves every setting from the sources in priority order (see the module docstring).
+    Later, slower sources are only consulted for settings still missing.
+    '''
+
+    values, sources = {}, {}
+
+    for source_name, source in (('environment', from_environment),
+                                ('encrypted file', from_encrypted_file),
+                                ('creds.yml', from_creds_yml),
+                                ('keyring/py_creds.p', from_legacy_stores)):
+
+        if all(key in values for key in ENVIRONMENT_VARIABLES if key not in ('smtp_username', 'smtp_password')):
+            break
+
+        for key, value in source().items():
+            if key not in values:
+                values[key] = value
+                sources[key] = source_name
+
+    return Settings(values, sources)
+
+
+def get_settings():
+    '''The process-wide settings, loaded on first use.'''
+
+    global _settings
+
+    if _settings is None:
+        _settings = load_settings()
+
+    return _settings
+
+
+def set_settings(settings):
+    '''Replaces the process-wide settings (a Settings, a dict of values, or None to reload on next use).'''
+
+    global _settings
+
+    _settings = Settings(settings) if isinstance(settings, dict) else settings
+
+
+if __name__ == '__main__':
+    print(get_settings())
@@ -0,0 +1,518 @@
+# -*- coding: utf-8 -*-
+"""
+Parquet sidecars for submitted workbooks and CSVs.
+
+When the pull places a metadata file (.xlsx, .xlsm, .csv, .tsv) it also reads it once,
+row by row, and writes '.sidecars/<file>.parquet' in the same folder on the share (see
+sidecar_path).  The hidden sub-folder keeps sidecars out of the listings the R scripts
+filter on name (str_detect(files, "xlsx"), "most recent REDCAP file"), which would
+otherwise pick up 'x.xlsx.parquet' and hand it to read_xlsx.  Readers that want the
+sidecar (read_all_data.Rmd, the roster scripts) open sidecar_path(file) with
+arrow::read_parquet() instead of parsing the spreadsheet again.
+
+Every column is stored as text with empty cells as null, which is what the R side reads
+today (read_xlsx(col_types = "text"), vroom with character columns), so a sidecar is a
+drop-in replacement.  A schema fingerprint (hash of the column names and types) is kept
+in the Parquet metadata so readers can group files with the same layout without opening
+them.  Conversions run in a process pool, off the transfer loop, and their output goes
+to the share through the staging area like every other write.  The same job appends the
+rows to the consolidated dataset (see sft_dataset) and fingerprints them for the
+duplicate index (see sft_dupindex).
+
+Needs pyarrow (and openpyxl for workbooks).  Without pyarrow files are still streamed
+for their fingerprints, but no sidecar or dataset part is written.
+"""
+###############################################################################################################
+###############################################################################################################
+
+import os
+import csv
+import json
+import uuid
+import shutil
+import hashlib
+import datetime
+import threading
+import importlib.util
+from concurrent.futures import ProcessPoolExecutor
+
+from sft_dataset import part_path, write_part
+from sft_dupindex import RowFingerprinter
+
+SIDECAR_EXTENSIONS = ('.csv', '.tsv', '.xlsx', '.xlsm')
+SIDECAR_SUFFIX = '.parquet'
+
+# Sub-folder of the placed file's folder holding its sidecar (hidden: list.files / dir_ls skip it)
+SIDECAR_FOLDER = '.sidecars'
+
+# Rows per Parquet row group (and per batch held in memory while converting)
+BATCH_ROWS = 50000
+
+# Parquet key/value metadata written into every sidecar
+METADATA_PREFIX = 'sft.'
+
+###############################################################################################################
+###############################################################################################################
+
+####################################################################################
+# Reading submissions row by row
+####################################################################################
+
+def sidecars_available():
+    '''True if pyarrow is installed.'''
+
+    return importlib.util.find_spec('pyarrow') is not None
+
+
+def sidecar_path(placed_path):
+    '''Where the sidecar of a placed file goes: <folder>/.sidecars/<file>.parquet.'''
+
+    folder, name = os.path.split(placed_path)
+    return os.path.join(folder, SIDECAR_FOLDER, name + SIDECAR_SUFFIX)
+
+
+def cell_text(value):
+
+    '''
+    (Python)
+
+    A cell as the text R would read: None/'' -> None, 5.0 -> '5', True -> 'TRUE',
+    dates and times -> ISO format.
+    '''
+
+    if value is None:
+        return None
+    if isinstance(value, str):
+        return value if value != '' else None
+    if isinstance(value, bool):
+        return 'TRUE' if value else 'FALSE'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    if isinstance(value, datetime.datetime) and value.time() == datetime.time():
+        # Excel stores dates as midnight datetimes
+        return value.date().isoformat()
+    if isinstance(value, (datetime.datetime, datetime.date, datetime.time)):
+        return value.isoformat()
+
+    return str(value)
+
+
+def column_names(header):
+
+    '''
+    (Python)
+
+    Column names from a header row.  Blank names become '...<position>' and repeated
+    names get '...<position>' appended, the way readr names them.
+    '''
+
+    names = []
+    seen = set()
+
+    for position, value in enumerate(header, start=1):
+        name = (cell_text(value) or '').strip()
+        if not name or name in seen:
+            name = '{}...{}'.format(name, position)
+        seen.add(name)
+        names.append(name)
+
+    return names
+
+
+def iter_rows(path):
+
+    '''
+    (Python)
+
+    Rows of a CSV/TSV or of a workbook's first sheet (what read_xlsx() reads by default),
+    one list of cell values at a time.  Workbooks are opened read-only, so only the
+    current row is in memory.
+    '''
+
+    extension = os.path.splitext(path)[1].lower()
+
+    if extension in ('.xlsx', '.xlsm'):
+        import openpyxl
+
+        workbook = openpyxl.load_workbook(path, read_only=True, data_only=True)
+        try:
+            for row in workbook.worksheets[0].iter_rows(values_only=True):
+                yield list(row)
+        finally:
+            workbook.close()
+        return
+
+    with open(path, 'r', newline='', encoding='utf-8-sig', errors='replace') as f:
+        yield from csv.reader(f, delimiter='\t' if extension == '.tsv' else ',')
+
+
+def schema_fingerprint(columns, column_type='string'):
+    '''Short hash of the column names and types.  Equal fingerprints mean the same layout.'''
+
+    layout = json.dumps([[name, column_type] for name in columns])
+
+    return hashlib.sha256(layout.encode('utf-8')).hexdigest()[:16]
+
+###############################################################################################################
+###############################################################################################################
+
+####################################################################################
+# Conversion (runs in the worker processes)
+####################################################################################
+
+def convert_to_parquet(source_path, output_path, metadata=None, batch_rows=BATCH_ROWS, fingerprint_rows=False):
+
+    '''
+    (Python)
+
+    Streams a CSV/TSV/workbook into a Parquet file of text columns, optionally
+    fingerprinting each row on the way (see sft_dupindex.RowFingerprinter).
+
+    --------------------------------------------------------------------------------------
+
+    Keyword arguments:
+    source_path -- file to convert
+    output_path -- Parquet file to write (written as .part, then renamed).  None: only read.
+    metadata -- extra key/value pairs for the Parquet metadata (e.g. source name and hash)
+    batch_rows -- rows per row group
+    fingerprint_rows -- also return the rows' fingerprints
+
+    --------------------------------------------------------------------------------------
+
+    Returns:
+    dict with rows, columns, fingerprint, ragged_rows (rows with more cells than the
+    header; the extra cells are dropped) and bytes (size of the Parquet file).  With
+    fingerprint_rows, also fingerprints, fingerprint_key and unkeyed_rows.
+
+    --------------------------------------------------------------------------------------
+
+    Example:
+    convert_to_parquet('C:/tmp/metadata.xlsx', 'C:/tmp/metadata.xlsx.parquet', {'source_file': 'metadata.xlsx'})
+    '''
+
+    rows = iter_rows(source_path)
+    columns = column_names(next(rows, []))
+    fingerprint = schema_fingerprint(columns)
+    fingerprinter = RowFingerprinter(columns) if fingerprint_rows else None
+
+    if output_path is None:
+        return _read_only(rows, columns, fingerprint, fingerprinter)
+
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema_metadata = {METADATA_PREFIX + 'schema_fingerprint': fingerprint,
+                       METADATA_PREFIX + 'converted_at': datetime.datetime.now().isoformat(timespec='seconds')}
+    schema_metadata.update({METADATA_PREFIX + k: str(v) for k, v in (metadata or {}).items()})
+    schema = pa.schema([pa.field(name, pa.string()) for name in columns], metadata=schema_metadata)
+
+    temp_path = output_path + '.part'
+    writer = pq.ParquetWriter(temp_path, schema)
+    total_rows = 0
+    ragged_rows = 0
+
+    def flush(batch):
+        writer.write_table(pa.Table.from_arrays([pa.array(values, pa.string()) for values in batch], schema=schema))
+
+    try:
+        batch = [[] for _ in columns]
+        for row in rows:
+            cells = [cell_text(v) for v in row]
+            # Skip fully blank rows, like the R readers do
+            if not any(c is not None for c in cells):
+                continue
+            if len(cells) > len(columns):
+                ragged_rows += any(c is not None for c in cells[len(columns):])
+            cells = cells[:len(columns)] + [None] * (len(columns) - len(cells))
+
+            for values, cell in zip(batch, cells):
+                values.append(cell)
+            total_rows += 1
+            if fingerprinter is not None:
+                fingerprinter.add(cells)
+
+            if total_rows % batch_rows == 0:
+                flush(batch)
+                batch = [[] for _ in columns]
+
+        if batch and batch[0] or total_rows == 0:
+            flush(batch)
+    finally:
+        writer.close()
+
+    os.replace(temp_path, output_path)
+
+    result = {'rows': total_rows, 'columns': len(columns), 'fingerprint': fingerprint,
+              'ragged_rows': ragged_rows, 'bytes': os.path.getsize(output_path)}
+
+    return _with_fingerprints(result, fingerprinter)
+
+
+def _read_only(rows, columns, fingerprint, fingerprinter):
+    '''convert_to_parquet() without an output file: counts (and fingerprints) the rows.'''
+
+    total_rows = 0
+    for row in rows:
+        cells = [cell_text(v) for v in row]
+        if not any(c is not None for c in cells):
+            continue
+        total_rows += 1
+        if fingerprinter is not None:
+            fingerprinter.add(cells[:len(columns)])
+
+    result = {'rows': total_rows, 'columns': len(columns), 'fingerprint': fingerprint, 'ragged_rows': 0, 'bytes': 0}
+
+    return _with_fingerprints(result, fingerprinter)
+
+
+def _with_fingerprints(result, fingerprinter):
+
+    if fingerprinter is not None:
+        result.update(fingerprints=fingerprinter.fingerprints, fingerprint_key=fingerprinter.key,
+                      unkeyed_rows=fingerprinter.unkeyed_rows)
+
+    return result
+
+
+def _convert_job(source_path, output_path, metadata, batch_rows, part_output_path=None, provenance=None, fingerprint_rows=False):
+
+    '''
+    Worker-process entry point: the sidecar (and row fingerprints), then (if asked) the
+    consolidated dataset part built from it.  Errors come back as a string so they always pickle.
+    '''
+
+    try:
+        result = convert_to_parquet(source_path, output_path, metadata, batch_rows, fingerprint_rows)
+        if part_output_path is not None:
+            result['part_bytes'] = write_part(output_path, part_output_path, provenance)
+        return result, None
+    except Exception as e:
+        return None, '{}: {}'.format(type(e).__name__, str(e))
+
+###############################################################################################################
+###############################################################################################################
+
+####################################################################################
+# Converter used by the pull
+####################################################################################
+
+class SidecarJob:
+
+    '''
+    (Python)
+
+    One submitted conversion.  done is set once the result (or error) is in and the
+    outputs are staged; result['duplicates'] holds the duplicate counts when an index is used.
+    The file's rows join the duplicate index only after confirm() (the pull calls it once
+    the file is on the share and deleted from the SFT), whichever of the two finishes last.
+    '''
+
+    def __init__(self, share_path, duplicate_index=None):
+        self.share_path = share_path
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+        self._duplicate_index = duplicate_index
+        self._pending = None
+        self._confirmed = False
+        self._lock = threading.Lock()
+
+    def _hold(self, pending):
+        '''Keeps the checked fingerprints until confirm() (or adds them now if it already came).'''
+
+        with self._lock:
+            if self._confirmed:
+                self._duplicate_index.add(pending, self.share_path)
+            else:
+                self._pending = pending
+
+    def confirm(self):
+        '''The file is safely pulled: its rows are added to the duplicate index.'''
+
+        with self._lock:
+            self._confirmed = True
+            pending, self._pending = self._pending, None
+            if pending is not None:
+                self._duplicate_index.add(pending, self.share_path)
+
+    def duplicates(self, timeout=None):
+        '''Duplicate counts for the manifest record, or None if unknown (no index, failed, timed out).'''
+
+        if not self.done.wait(timeout) or self.result is None:
+            return None
+
+        return self.result.get('duplicates')
+
+
+class SidecarConverter:
+
+    '''
+    (Python)
+
+    Converts placed submissions in a process pool and stages each sidecar (and its
+    consolidated dataset part) for the share.
+
+    --------------------------------------------------------------------------------------
+
+    Keyword arguments:
+    work_directory -- local folder for conversion inputs and outputs (emptied on start)
+    staging -- sft_staging.StagingArea that takes the finished sidecars to the share
+    workers -- conversion processes
+    batch_rows -- rows per Parquet row group
+    dataset_directory -- consolidated dataset on the share (see sft_dataset).  None: sidecars only.
+    duplicate_index -- sft_dupindex.DuplicateIndex to check each file's rows against.  None: no check.
+    write_sidecars -- False to only read files (fingerprints), e.g. without pyarrow
+
+    --------------------------------------------------------------------------------------
+
+    Example:
+    converter = SidecarConverter('C:/sft_staging/sidecars', staging)
+    if converter.wants(file_name):
+        job = converter.submit(download_path, placed_share_path, sha256,
+                               partition={'submitter': 'LAB_A', 'month': '2021-08', 'run_id': run_id, 'pulled_on': '2021-08-31'})
+    job.confirm()    # once the file is on the share and deleted from the SFT
+    record['duplicates'] = job.duplicates(timeout=300)
+    converter.close()
+    print(converter.report())
+    '''
+
+    def __init__(self, work_directory, staging, workers=2, batch_rows=BATCH_ROWS, dataset_directory=None,
+                 duplicate_index=None, write_sidecars=True):
+        self.work_directory = work_directory
+        self.write_sidecars = write_sidecars
+        self.dataset_directory = dataset_directory if write_sidecars else None
+        self.duplicate_index = duplicate_index
+        self.staging = staging
+        self.batch_rows = batch_rows
+        self.results = []
+        self.failures = []
+
+        # Anything here belongs to an earlier run whose files are still on the SFT
+        shutil.rmtree(work_directory, ignore_errors=True)
+        os.makedirs(work_directory, exist_ok=True)
+
+        self._pool = ProcessPoolExecutor(max_workers=max(1, workers))
+        self._futures = []
+
+    def wants(self, file_name):
+        '''True for the file types that get a sidecar.'''
+
+        return os.path.splitext(file_name)[1].lower() in SIDECAR_EXTENSIONS
+
+    def submit(self, source_path, share_path, sha256=None, metadata=None, partition=None):
+
+        '''
+        (Python)
+
+        Takes source_path (moved into the work folder, so the download name is free again)
+        and queues its conversion.  The sidecar is staged for sidecar_path(share_path)
+        when done.  With partition (submitter, month, run_id, pulled_on) and a dataset
+        directory, the rows are also staged as a dataset part.  Returns the SidecarJob.
+        '''
+
+        job_id = uuid.uuid4().hex
+        extension = os.path.splitext(source_path)[1].lower()
+        work_source = os.path.join(self.work_directory, job_id + extension)
+        work_output = os.path.join(self.work_directory, job_id + SIDECAR_SUFFIX) if self.write_sidecars else None
+        os.replace(source_path, work_source)
+        job = SidecarJob(share_path, self.duplicate_index)
+
+        metadata = dict(metadata or {}, source_file=os.path.basename(share_path), source_sha256=sha256 or '')
+
+        part_output, part_share_path, provenance = None, None, None
+        if self.dataset_directory is not None and partition is not None and sha256:
+            part_output = os.path.join(self.work_directory, job_id + '.part' + SIDECAR_SUFFIX)
+            part_share_path = part_path(self.dataset_directory, partition['submitter'], partition['month'], sha256)
+            provenance = {'source_file': share_path, 'source_sha256': sha256,
+                          'run_id': partition['run_id'], 'pulled_on': partition['pulled_on']}
+
+        future = self._pool.submit(_convert_job, work_source, work_output, metadata, self.batch_rows,
+                                   part_output, provenance, self.duplicate_index is not None)
+        future.add_done_callback(lambda f: self._finished(f, job, work_source, work_output, part_output, part_share_path))
+        self._futures.append(future)
+
+        return job
+
+    def _finished(self, future, job, work_source, work_output, part_output=None, part_share_path=None):
+
+        try:
+            self._collect(future, job, work_source, work_output, part_output, part_share_path)
+        except Exception as e:
+            job.error = '{}: {}'.format(type(e).__name__, str(e))
+            print('Sidecar bookkeeping failed for {}:  {}'.format(job.share_path, job.error))
+        finally:
+            job.done.set()
+
+    def _collect(self, future, job, work_source, work_output, part_output, part_share_path):
+
+        share_path = job.share_path
+
+        try:
+            result, error = future.result()
+        except Exception as e:
+            result, error = None, '{}: {}'.format(type(e).__name__, str(e))
+
+        os.remove(work_source)
+
+        if error is not None:
+            print('Sidecar failed for {}:  {}'.format(share_path, error))
+            self.failures.append((share_path, error))
+            job.error = error
+            for path in (work_output, part_output):
+                if path is not None and os.path.exists(path):
+                    os.remove(path)
+            return
+
+        # Duplicate counts against everything indexed so far.  The rows are added once the pull
+        # confirms the file (SidecarJob.confirm), so a file left on the SFT isn't its own duplicate next run.
+        if self.duplicate_index is not None:
+            result['duplicates'], pending = self.duplicate_index.check(
+                result.pop('fingerprints'), share_path, result.pop('unkeyed_rows'), result.pop('fingerprint_key'))
+            job._hold(pending)
+            if result['duplicates']['duplicate_rows']:
+                print('Duplicates in {}:  {} of {} row(s) already seen ({})'.format(
+                    share_path, result['duplicates']['duplicate_rows'], result['duplicates']['rows'],
+                    ', '.join(result['duplicates']['earlier_sources'])))
+
+        job.result = result
+
+        if not self.write_sidecars:
+            self.results.append(result)
+            return
+
+        result['share_path'] = sidecar_path(share_path)
+        os.makedirs(os.path.dirname(result['share_path']), exist_ok=True)
+        self.staging.stage_file(work_output, result['share_path'])
+
+        if part_output is not None:
+            # Parts are append-only: one per content, created on the share if missing
+            result['part_path'] = part_share_path
+            os.makedirs(os.path.dirname(part_share_path), exist_ok=True)
+            self.staging.stage_file(part_output, part_share_path)
+
+        self.results.append(result)
+
+        if result['ragged_rows']:
+            print('Sidecar {}:  {} row(s) longer than the header, extra cells dropped'.format(result['share_path'], result['ragged_rows']))
+
+    def close(self):
+        '''Waits for every conversion and its staging, then stops the pool.'''
+
+        self._pool.shutdown(wait=True)
+
+    def report(self):
+        '''One-line summary for the end of a run.'''
+
+        if not self.results and not self.failures:
+            return 'Sidecars:  none'
+
+        line = 'Sidecars:  {} {} ({} rows, {} layouts, {} dataset parts), {} failed'.format(
+            len(self.results), 'written' if self.write_sidecars else 'read', sum(r['rows'] for r in self.results),
+            len({r['fingerprint'] for r in self.results}), sum('part_path' in r for r in self.results), len(self.failures))
+
+        checked = [r['duplicates'] for r in self.results if 'duplicates' in r]
+        if checked:
+            line += '; duplicate rows {} (+{} within files) in {} file(s)'.format(
+                sum(d['duplicate_rows'] for d in checked), sum(d['within_file'] for d in checked), len(checked))
+
+        return line
@@ -0,0 +1,409 @@
+# -*- coding: utf-8 -*-
+"""
+Local staging area with write-behind sync to the share.
+
+The pull commits each file, archive copy and log row to local disk first (fast), and
+background sync workers push them to the share in batches through the I/O governor,
+verify each copy and retry failures with backoff.  Every staged item has a ticket; the
+pull only deletes a file from the SFT once all of its tickets are confirmed.
+
+A journal (journal.jsonl in the staging folder) records every item and its outcome for
+the current run.  Files a dead run left unfinished are discarded by the next one: they
+are still on the SFT and simply get pulled again.  Log rows it left unwritten for files
+that did reach the share are appended by the next run.
+"""
+###############################################################################################################
+###############################################################################################################
+
+import os
+import csv
+import json
+import time
+import uuid
+import queue
+import shutil
+import hashlib
+import threading
+
+from sft_governor import get_governor
+
+JOURNAL_FILENAME = 'journal.jsonl'
+FILES_DIRECTORY = 'files'
+
+# Ticket states
+PENDING, SYNCED, FAILED, SKIPPED = 'pending', 'synced', 'failed', 'skipped'
+
+###############################################################################################################
+###############################################################################################################
+
+####################################################################################
+# Tickets
+####################################################################################
+
+class Ticket:
+
+    '''
+    (Python)
+
+    One staged item.  kind is 'file' (staged file -> share path) or 'log' (rows to append
+    to a CSV on the share once the tickets in after are synced).
+    '''
+
+    def __init__(self, kind, share_path, staged_path=None, sha256=None, size=None, rows=None, after=(), ticket_id=None):
+        self.id = ticket_id or uuid.uuid4().hex
+        self.kind = kind
+        self.share_path = share_path
+        self.staged_path = staged_path
+        self.sha256 = sha256
+        self.size = size
+        self.rows = rows or []
+        self.after = list(after)
+        self.state = PENDING
+        self.attempts = 0
+        self.error = None
+        self.synced_at = None
+        self.done = threading.Event()
+
+    def as_dict(self):
+        return {'id': self.id, 'kind': self.kind, 'share_path': self.share_path, 'staged_path': self.staged_path,
+                'sha256': self.sha256, 'size': self.size, 'rows': self.rows, 'after': [t.id for t in self.after],
+                'state': self.state, 'attempts': self.attempts, 'error': self.error}
+
+###############################################################################################################
+###############################################################################################################
+
+####################################################################################
+# Staging area
+####################################################################################
+
+def sha256_of(path, chunk_size=1024 * 1024):
+    '''sha256 hex digest of a file, read in chunks.'''
+
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha.update(chunk)
+
+    return sha.hexdigest()
+
+
+class StagingArea:
+
+    '''
+    (Python)
+
+    Local staging folder plus write-behind sync workers.
+
+    --------------------------------------------------------------------------------------
+
+    Keyword arguments:
+    local_root -- local folder for staged files and the journal
+    governor -- sft_governor.IOGovernor for the share writes.  Defaults to the process-wide one.
+    workers -- sync threads
+    batch_size -- items a worker takes from the queue at a time (log rows for the same
+                  file in a batch are appended in one write)
+    max_retries -- attempts per item before it is marked failed
+    verify -- 'sha256' re-reads each share copy and compares hashes; 'size' only compares sizes
+
+    --------------------------------------------------------------------------------------
+
+    Example:
+    staging = StagingArea('C:/sft_staging', governor)
+    archive = staging.stage_file(download_path, archive_path, sha256=sha, keep_source=True)
+    placed = staging.stage_file(download_path, destination_path, sha256=sha)
+    log = staging.stage_log_rows(path_to_log, [row], after=[archive, placed])
+    if staging.wait([archive, placed, log]):
+        delete_element_by_id(driver, file_name)
+    staging.close()
+    '''
+
+    def __init__(self, local_root, governor=None, workers=2, batch_size=20, max_retries=5, verify='sha256'):
+        self.local_root = local_root
+        self.files_directory = os.path.join(local_root, FILES_DIRECTORY)
+        self.journal_path = os.path.join(local_root, JOURNAL_FILENAME)
+        self.governor = governor or get_governor()
+        self.batch_size = batch_size
+        self.max_retries = max_retries
+        self.verify = verify
+
+        self.tickets = {}
+        self._reserved = {}
+        self._queue = queue.Queue()
+        self._journal_lock = threading.Lock()
+        self._stop = threading.Event()
+
+        os.makedirs(self.files_directory, exist_ok=True)
+        left_over, replayed = self._recover()
+
+        self._workers = [threading.Thread(target=self._work, name='sft-sync-{}'.format(i), daemon=True)
+                         for i in range(max(1, workers))]
+        for worker in self._workers:
+            worker.start()
+
+        if left_over:
+            print('Staging:  dropped {} unfinished item(s) from an earlier run (still on the SFT, pulled again)'.format(left_over))
+        if replayed:
+            print('Staging:  appending {} log row batch(es) an earlier run left unwritten'.format(replayed))
+
+    # ---- journal ----
+
+    def _journal(self, ticket):
+        with self._journal_lock:
+            with open(self.journal_path, 'a') as f:
+                f.write(json.dumps(ticket.as_dict()) + '\n')
+
+    def _recover(self):
+
+        '''
+        Clears out what an earlier run left behind and starts a fresh journal.  Returns
+        (unfinished items dropped, log tickets queued again).
+
+        Unfinished files are dropped rather than re-synced: they were never deleted from
+        the SFT (deletes wait for the sync), so the next pull downloads them again, and
+        syncing the old copies as well would place them twice.  Unwritten log rows whose
+        files all synced are queued again, since those copies are on the share for good.
+        '''
+
+        latest = {}
+        if os.path.exists(self.journal_path):
+            with open(self.journal_path, 'r') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue
+                    latest[entry['id']] = entry
+
+        unfinished = [e for e in latest.values() if e['state'] in (PENDING, FAILED)]
+        replay = [e for e in unfinished if e['kind'] == 'log' and e['rows']
+                  and all(latest.get(d, {}).get('state') == SYNCED for d in e['after'])]
+
+        for name in os.listdir(self.files_directory):
+            os.remove(os.path.join(self.files_directory, name))
+
+        with open(self.journal_path, 'w'):
+            pass
+
+        # Journaled again in the fresh journal, so a second crash doesn't lose them either
+        for entry in replay:
+            self._add(Ticket('log', entry['share_path'], rows=entry['rows']))
+
+        return len(unfinished) - len(replay), len(replay)
+
+    # ---- staging ----
+
+    def _reserve(self, share_path):
+        directory, name = os.path.split(share_path)
+        self._reserved.setdefault(directory + '/', set()).add(name)
+
+    def reserved_names(self, share_directory):
+        '''Names staged for share_directory but not necessarily there yet (pass as taken= to collision_free_name).'''
+
+        return self._reserved.get(share_directory, set())
+
+    def stage_file(self, source_path, share_path, sha256=None, keep_source=False):
+
+        '''
+        (Python)
+
+        Stages a local file for share_path and queues it.  The source is moved into the
+        staging folder (copied if keep_source).  Returns the Ticket.
+
+        --------------------------------------------------------------------------------------
+
+        Keyword arguments:
+        source_path -- local file
+        share_path -- full destination path on the share (replaced if it exists)
+        sha256 -- the file's hash if already known (saves a local re-read)
+        keep_source -- copy instead of move, e.g. when the same download is staged twice
+        '''
+
+        ticket = Ticket('file', share_path)
+        ticket.staged_path = os.path.join(self.files_directory, ticket.id)
+
+        if keep_source:
+            shutil.copyfile(source_path, ticket.staged_path)
+        else:
+            shutil.move(source_path, ticket.staged_path)
+
+        ticket.size = os.path.getsize(ticket.staged_path)
+        ticket.sha256 = sha256 or sha256_of(ticket.staged_path)
+
+        self._add(ticket)
+        self._reserve(share_path)
+
+        return ticket
+
+    def stage_log_rows(self, path_to_log, rows, after=()):
+        '''Queues CSV rows to append to path_to_log once every ticket in after is synced.  Returns the Ticket.'''
+
+        ticket = Ticket('log', path_to_log, rows=[list(r) for r in rows], after=after)
+        self._add(ticket)
+
+        return ticket
+
+    def _add(self, ticket):
+        self.tickets[ticket.id] = ticket
+        self._journal(ticket)
+        self._queue.put(ticket)
+
+    # ---- waiting ----
+
+    def wait(self, tickets, timeout=None):
+        '''True once every ticket is synced; False if any failed or the timeout passed.'''
+
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for ticket in tickets:
+            remaining = None if deadline is None else max(0.0, deadline - time.monotonic())
+            if not ticket.done.wait(remaining):
+                return False
+
+        return all(t.state == SYNCED for t in tickets)
+
+    def pending_count(self):
+        return sum(t.state == PENDING for t in self.tickets.values())
+
+    def close(self, timeout=None):
+
+        '''
+        Waits for everything queued to finish (or timeout), stops the workers and
+        returns the tickets that did not sync.  Their files were not deleted from the
+        SFT, so the next run pulls them again.
+        '''
+
+        self.wait(list(self.tickets.values()), timeout)
+        self._stop.set()
+        for _ in self._workers:
+            self._queue.put(None)
+        for worker in self._workers:
+            worker.join(timeout=5)
+
+        return [t for t in self.tickets.values() if t.state != SYNCED]
+
+    # ---- sync workers ----
+
+    def _work(self):
+
+        while not self._stop.is_set():
+            first = self._queue.get()
+            if first is None:
+                return
+
+            batch = [first]
+            while len(batch) < self.batch_size:
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    self._queue.put(None)
+                    break
+                batch.append(item)
+
+            # Files smallest first; log rows after, grouped per log file
+            files = sorted((t for t in batch if t.kind == 'file'), key=lambda t: t.size or 0)
+            for ticket in files:
+                self._attempt(ticket, self._sync_file)
+
+            logs = {}
+            for ticket in (t for t in batch if t.kind == 'log'):
+                logs.setdefault(ticket.share_path, []).append(ticket)
+            for path_to_log, tickets in logs.items():
+                self._sync_logs(path_to_log, tickets)
+
+    def _attempt(self, ticket, sync):
+        '''Runs sync(ticket) with retries and backoff; records the outcome.'''
+
+        while True:
+            ticket.attempts += 1
+            try:
+                sync(ticket)
+                self._finish(ticket, SYNCED)
+                return
+            except Exception as e:
+                ticket.error = '{}: {}'.format(type(e).__name__, str(e))
+                if ticket.attempts >= self.max_retries or self._stop.is_set():
+                    print('Staging:  giving up on {} after {} attempt(s):  {}'.format(ticket.share_path, ticket.attempts, ticket.error))
+                    self._finish(ticket, FAILED)
+                    return
+                time.sleep(min(60, 2 ** ticket.attempts))
+
+    def _finish(self, ticket, state):
+        ticket.state = state
+        ticket.synced_at = time.time() if state == SYNCED else None
+        self._journal(ticket)
+        if state == SYNCED and ticket.kind == 'file':
+            try:
+                os.remove(ticket.staged_path)
+            except OSError:
+                pass
+        ticket.done.set()
+
+    def _sync_file(self, ticket):
+        '''Copies the staged file to the share and verifies the copy.'''
+
+        # The copy is only renamed onto the share name once its sha256 matches the staged file's
+        self.governor.copy_file(ticket.staged_path, ticket.share_path, label=os.path.basename(ticket.share_path),
+                                expected_sha256=ticket.sha256)
+
+        if os.path.getsize(ticket.share_path) != ticket.size:
+            raise IOError('size on share {} != {}'.format(os.path.getsize(ticket.share_path), ticket.size))
+        if self.verify == 'sha256' and sha256_of(ticket.share_path) != ticket.sha256:
+            raise IOError('sha256 on share does not match')
+
+    def _sync_logs(self, path_to_log, tickets):
+        '''Appends the rows of every ticket whose files synced, in one write.'''
+
+        ready = []
+        for ticket in tickets:
+            for dependency in ticket.after:
+                dependency.done.wait()
+            if all(d.state == SYNCED for d in ticket.after):
+                ready.append(ticket)
+            else:
+                # The file didn't make it: no log row (it stays on the SFT for the next run)
+                self._finish(ticket, SKIPPED)
+
+        if not ready:
+            return
+
+        rows = [row for ticket in ready for row in ticket.rows]
+
+        def append(_):
+            from sft_functions import append_log_records
+            with self.governor.write_small(sum(len(','.join(map(str, r))) + 2 for r in rows), os.path.basename(path_to_log)):
+                append_log_records(path_to_log, rows)
+
+        # One attempt loop for the whole batch; the outcome applies to every ticket in it
+        carrier = Ticket('log', path_to_log)
+        self._attempt_batch(carrier, append, ready)
+
+    def _attempt_batch(self, carrier, sync, tickets):
+        while True:
+            carrier.attempts += 1
+            try:
+                sync(carrier)
+                for ticket in tickets:
+                    ticket.attempts = carrier.attempts
+                    self._finish(ticket, SYNCED)
+                return
+            except Exception as e:
+                error = '{}: {}'.format(type(e).__name__, str(e))
+                if carrier.attempts >= self.max_retries or self._stop.is_set():
+                    print('Staging:  giving up on {} row(s) for {}:  {}'.format(len(tickets), carrier.share_path, error))
+                    for ticket in tickets:
+                        ticket.error = error
+                        self._finish(ticket, FAILED)
+                    return
+                time.sleep(min(60, 2 ** carrier.attempts))
+
+    # ---- reporting ----
+
+    def report(self):
+        '''One-line summary for the end of a run.'''
+
+        counts = {}
+        for ticket in self.tickets.values():
+            counts[ticket.state] = counts.get(ticket.state, 0) + 1
+
+        return 'Staging:  ' + ', '.join('{} {}'.format(n, state) for state, n in sorted(counts.items())) if counts else 'Staging:  nothing staged'
@@ -0,0 +1,551 @@
+# -*- coding: utf-8 -*-
+"""
+Streaming transfer helpers for the SFT pull.
+
+Large FASTA bundles and multi-sheet workbooks can take longer than any fixed wall-clock
+limit over a slow link.  Everything here streams in fixed-size chunks (constant memory),
+reports progress, and only gives up when a transfer stops making progress.
+"""
+###############################################################################################################
+###############################################################################################################
+
+import os
+import time
+import hashlib
+import zipfile
+import urllib.request
+import urllib.error
+
+# Default chunk size for all streaming operations (1 MiB)
+CHUNK_SIZE = 1024 * 1024
+
+# Suffixes Chrome uses for in-progress downloads
+PARTIAL_DOWNLOAD_SUFFIXES = ('.crdownload', '.tmp', '.part')
+
+###############################################################################################################
+###############################################################################################################
+
+####################################################################################
+# Progress tracking
+####################################################################################
+
+class TransferProgress:
+
+    '''
+    (Python)
+
+    Tracks progress of a single transfer: bytes done, smoothed rate and ETA.
+
+    --------------------------------------------------------------------------------------
+
+    Keyword arguments:
+    name -- label used when printing progress
+    total_bytes -- expected size in bytes, if known.  ETA is only available when this is set.
+    print_every -- minimum number of seconds between printed progress lines
+
+    --------------------------------------------------------------------------------------
+
+    Example:
+    progress = TransferProgress('bundle.fasta', total_bytes=2_000_000_000)
+    progress.update(1_048_576)
+    progress.bytes_per_second, progress.eta_seconds
+    '''
+
+    # Weight given to the newest rate sample
+    SMOOTHING = 0.3
+
+    def __init__(self, name, total_bytes=None, print_every=10):
+        self.name = name
+        self.total_bytes = total_bytes
+        self.print_every = print_every
+        self.bytes_done = 0
+        self.bytes_per_second = 0.0
+        self.started = time.monotonic()
+        self.last_progress = self.started
+        self._last_sample_time = self.started
+        self._last_sample_bytes = 0
+        self._last_print = self.started
+
+    def set(self, bytes_done):
+        '''Records the absolute number of bytes transferred so far.'''
+
+        now = time.monotonic()
+
+        # Any growth counts as progress
+        if bytes_done > self.bytes_done:
+            self.last_progress = now
+
+        # Update the smoothed rate at most once every half second
+        elapsed = now - self._last_sample_time
+        if elapsed >= 0.5:
+            sample = (bytes_done - self._last_sample_bytes) / elapsed
+            if self.bytes_per_second == 0.0:
+                self.bytes_per_second = sample
+            else:
+                self.bytes_per_second = self.SMOOTHING * sample + (1 - self.SMOOTHING) * self.bytes_per_second
+            self._last_sample_time = now
+            self._last_sample_bytes = bytes_done
+
+        self.bytes_done = bytes_done
+
+        # Periodic progress line
+        if self.print_every is not None and (now - self._last_print) >= self.print_every:
+            print(self.format())
+            self._last_print = now
+
+    def update(self, num_bytes):
+        '''Records that num_bytes more bytes were transferred.'''
+        self.set(self.bytes_done + num_bytes)
+
+    @property
+    def seconds_since_progress(self):
+        return time.monotonic() - self.last_progress
+
+    @property
+    def elapsed_seconds(self):
+        return time.monotonic() - self.started
+
+    @property
+    def eta_seconds(self):
+        if not self.total_bytes or self.bytes_per_second <= 0:
+            return None
+        return max(self.total_bytes - self.bytes_done, 0) / self.bytes_per_second
+
+    def format(self):
+        '''Human readable progress line.'''
+
+        done_mb = self.bytes_done / CHUNK_SIZE
+        rate_mb = self.bytes_per_second / CHUNK_SIZE
+        line = 'Progress {}:  {:.1f} MB at {:.2f} MB/s'.format(self.name, done_mb, rate_mb)
+
+        if self.total_bytes:
+            line += ' ({:.0%})'.format(self.bytes_done / self.total_bytes)
+
+        eta = self.eta_seconds
+        if eta is not None:
+            line += ', ETA {:.0f}s'.format(eta)
+
+        return line
+
+###############################################################################################################
+###############################################################################################################
+
+####################################################################################
+# Waiting for a browser download, timing out on stalls instead of wall-clock time
+####################################################################################
+
+def partial_download_size(download_directory):
+
+    '''
+    (Python)
+
+    Total size of the in-progress (partial) downloads in a directory.
+    Cheap when download_directory is the per-run directory from sft_driver.
+
+    --------------------------------------------------------------------------------------
+
+    Keyword arguments:
+    download_directory -- directory Chrome is downloading into
+
+    --------------------------------------------------------------------------------------
+
+    Dependencies:
+    import os
+    '''
+
+    total = 0
+
+    with os.scandir(download_directory) as entries:
+        for entry in entries:
+            if entry.name.endswith(PARTIAL_DOWNLOAD_SUFFIXES) or entry.name.startswith('Unconfirmed '):
+                try:
+                    total += entry.stat().st_size
+                except FileNotFoundError:
+                    # Finished (renamed) between listing and stat
+                    pass
+
+    return total
+
+
+def wait_for_download_progress(filename, download_directory, stall_timeout=120, expected_size=None,
+                               poll_interval=1, max_wait=None):
+
+    '''
+    (Python)
+
+    Waits for a browser download to finish.  It only times out when the download stops
+    growing for stall_timeout seconds, so large files over a slow link keep going as long
+    as bytes keep arriving.
+
+    --------------------------------------------------------------------------------------
+
+    Keyword arguments:
+    filename -- name of the file being downloaded
+    download_directory -- directory Chrome is downloading into.  Ends in /
+    stall_timeout -- seconds without any progress before giving up
+    expected_size -- size in bytes, if known (used for percentage/ETA only)
+    poll_interval -- seconds between checks
+    max_wait -- optional hard upper bound in seconds.  None means no wall-clock limit.
+
+    --------------------------------------------------------------------------------------
+
+    Example:
+    download_element_by_id(driver, 'bundle.fasta')
+    wait_for_download_progress('bundle.fasta', dir_downloads, stall_timeout=180)
+
+    --------------------------------------------------------------------------------------
+
+    Dependencies:
+    import os
+    import time
+    '''
+
+    full_path = os.path.join(download_directory, filename)
+    progress = TransferProgress(filename, total_bytes=expected_size)
+
+    while True:
+
+        # Done once the final file exists and Chrome no longer has a partial for it
+        partial_exists = any(os.path.exists(full_path + suffix) for suffix in PARTIAL_DOWNLOAD_SUFFIXES)
+        if os.path.exists(full_path) and not partial_exists:
+            print('Action Complete:  {}'.format(str(filename)))
+            return progress
+
+        # Measure progress from the partial file(s)
+        progress.set(partial_download_size(download_directory))
+
+        if progress.seconds_since_progress > stall_timeout:
+            raise TimeoutError('Download of {} stalled for {} seconds ({})'.format(
+                filename, stall_timeout, progress.format()))
+
+        if max_wait is not None and progress.elapsed_seconds > max_wait:
+            raise TimeoutError('Download of {} exceeded {} seconds ({})'.format(
+                filename, max_wait, progress.format()))
+
+        time.sleep(poll_interval)
+
+
+def wait_for_new_download(download_directory, known_names, stall_timeout=120, start_timeout=60, poll_interval=1,
+                          expected_names=None, settle_seconds=5):
+
+    '''
+    (Python)
+
+    Waits for a download whose file name isn't known in advance (a folder zip, or the
+    files of a multi-file request) and returns the names of the finished new files.
+    Done once no partial download is left and either every expected name (or a zip) is
+    there, or the new files haven't changed for settle_seconds: the browser can start the
+    files of one request a few seconds apart.  Times out if nothing starts within
+    start_timeout or progress stalls for stall_timeout seconds.
+
+    --------------------------------------------------------------------------------------
+
+    Keyword arguments:
+    download_directory -- directory Chrome is downloading into
+    known_names -- names that were already there before the download was started
+    expected_names -- names the request should deliver, if known
+    settle_seconds -- how long the finished new files must stay unchanged when not all
+                      expected names (or no expected names) arrived
+    '''
+
+    progress = TransferProgress('bulk download')
+    expected = set(expected_names or ())
+    last_seen, unchanged_since = None, None
+
+    while True:
+
+        names = set(os.listdir(download_directory)) - set(known_names)
+        partials = {n for n in names if n.endswith(PARTIAL_DOWNLOAD_SUFFIXES) or n.startswith('Unconfirmed ')}
+
+        if names and not partials:
+            complete = bool(expected) and (expected <= names or any(n.lower().endswith('.zip') for n in names))
+
+            # Names and sizes; any change restarts the settle period
+            seen = {}
+            for name in names:
+                try:
+                    seen[name] = os.path.getsize(os.path.join(download_directory, name))
+                except OSError:
+                    seen[name] = None
+            if seen != last_seen:
+                last_seen, unchanged_since = seen, time.monotonic()
+
+            if complete or time.monotonic() - unchanged_since >= settle_seconds:
+                print('Action Complete:  {}'.format(', '.join(sorted(names))))
+                return sorted(names)
+        else:
+            last_seen = None
+
+        progress.set(partial_download_size(download_directory))
+
+        if not names and progress.elapsed_seconds > start_timeout:
+            raise TimeoutError('No download started within {} seconds'.format(start_timeout))
+
+        if progress.seconds_since_progress > stall_timeout:
+            raise TimeoutError('Bulk download stalled for {} seconds ({})'.format(stall_timeout, progress.format()))
+
+        time.sleep(poll_interval)
+
+###############################################################################################################
+###############################################################################################################
+
+####################################################################################
+# Unpacking a folder zip
+####################################################################################
+
+def unpack_zip(zip_path, output_directory, expected_names=None, chunk_size=CHUNK_SIZE):
+
+    '''
+    (Python)
+
+    Streams the members of a zip into output_directory, one at a time, hashing each as
+    it is written.  Members are written under their base name only (never outside
+    output_directory), through a temp file, so a member that fails its CRC check is
+    never left behind looking complete.
+
+    --------------------------------------------------------------------------------------
+
+    Keyword arguments:
+    zip_path -- the downloaded zip
+    output_directory -- where the members go.  Ends in /
+    expected_names -- if given, only these names are unpacked; others are reported
+
+    --------------------------------------------------------------------------------------
+
+    Returns:
+    (unpacked {name: {'size', 'sha256'}}, problems {name: reason})
+    '''
+
+    unpacked, problems = {}, {}
+
+    with zipfile.ZipFile(zip_path) as archive:
+        for member in archive.infolist():
+            if member.is_dir():
+                continue
+
+            name = os.path.basename(member.filename)
+            if expected_names is not None and name not in expected_names:
+                problems[name or member.filename] = 'not expected in this folder'
+                continue
+            if name in unpacked or name in problems:
+                # Which copy is the file is unknowable: none is kept, including one already written
+                if unpacked.pop(name, None) is not None:
+                    os.remove(os.path.join(output_directory, name))
+                problems[name] = 'more than one member with this name'
+                continue
+
+            path = os.path.join(output_directory, name)
+            sha = hashlib.sha256()
+            size = 0
+            try:
+                with archive.open(member) as source, open(path + '.unzip', 'wb') as target:
+                    for chunk in iter(lambda: source.read(chunk_size), b''):
+                        sha.update(chunk)
+                        target.write(chunk)
+                        size += len(chunk)
+            except (zipfile.BadZipFile, OSError, EOFError) as e:
+                if os.path.exists(path + '.unzip'):
+                    os.remove(path + '.unzip')
+                problems[name] = '{}: {}'.format(type(e).__name__, str(e))
+                continue
+
+            os.replace(path + '.unzip', path)
+            unpacked[name] = {'size': size, 'sha256': sha.hexdigest()}
+
+    return unpacked, problems
+
+###############################################################################################################
+###############################################################################################################
+
+####################################################################################
+# Chunked, resumable file copy
+####################################################################################
+
+def copy_file_chunked(source_path, destination_path, chunk_size=CHUNK_SIZE, resume=True, progress=None, throttle=None,
+                      expected_sha256=None):
+
+    '''
+    (Python)
+
+    Copies a file in fixed-size chunks through a '.part' file, hashing as it goes.
+    If an earlier attempt left a '.part' file behind, the copy resumes from where it
+    stopped instead of starting over, provided the '.part' file matches the start of the
+    source.  Peak memory is one chunk regardless of file size.
+
+    --------------------------------------------------------------------------------------
+
+    Keyword arguments:
+    source_path -- full path of the file to copy
+    destination_path -- full path of the copy
+    chunk_size -- bytes per read/write
+    resume -- reuse an existing '.part' file from an interrupted copy
+    progress -- optional TransferProgress to update
+    throttle -- optional callable taking a byte count, called before each chunk is written
+                (e.g. IOGovernor.throttle to rate-limit writes to the share)
+    expected_sha256 -- if given, the copy is only renamed to destination_path when its
+                       digest matches; otherwise the '.part' file is removed and IOError raised
+
+    --------------------------------------------------------------------------------------
+
+    Returns:
+    (bytes copied, sha256 hex digest of the full file)
+
+    --------------------------------------------------------------------------------------
+
+    Example:
+    size, sha = copy_file_chunked('C:/tmp/bundle.fasta', '//share/ARCHIVE_copies/20210831_140102_bundle.fasta')
+
+    --------------------------------------------------------------------------------------
+
+    Dependencies:
+    import os
+    import hashlib
+    '''
+
+    partial_path = destination_path + '.part'
+    source_size = os.path.getsize(source_path)
+    sha = hashlib.sha256()
+
+    if progress is None:
+        progress = TransferProgress(os.path.basename(source_path), total_bytes=source_size)
+
+    # Resume: re-hash what is already there so the final digest covers the whole file.  A '.part'
+    # file left by a copy of something else (or damaged) doesn't match the source: start over.
+    offset = 0
+    mode = 'wb'
+    if resume and os.path.exists(partial_path) and os.path.getsize(partial_path) <= source_size:
+        with open(partial_path, 'rb') as part, open(source_path, 'rb') as src:
+            for chunk in iter(lambda: part.read(chunk_size), b''):
+                if src.read(len(chunk)) != chunk:
+                    sha, offset = hashlib.sha256(), 0
+                    break
+                sha.update(chunk)
+                offset += len(chunk)
+            else:
+                mode = 'ab'
+
+    progress.set(offset)
+
+    with open(source_path, 'rb') as src, open(partial_path, mode) as dst:
+        src.seek(offset)
+        for chunk in iter(lambda: src.read(chunk_size), b''):
+            if throttle is not None:
+                throttle(len(chunk))
+            dst.write(chunk)
+            sha.update(chunk)
+            progress.update(len(chunk))
+
+    if expected_sha256 is not None and sha.hexdigest() != expected_sha256:
+        os.remove(partial_path)
+        raise IOError('copy of {}: sha256 {} != {}'.format(source_path, sha.hexdigest(), expected_sha256))
+
+    # Only expose the file under its real name once it is complete (and, if asked, verified)
+    os.replace(partial_path, destination_path)
+
+    return progress.bytes_done, sha.hexdigest()
+
+###############################################################################################################
+###############################################################################################################
+
+####################################################################################
+# Resumable HTTP download (for backends that expose a direct download URL)
+####################################################################################
+
+def cookie_header_from_driver(driver):
+
+    '''
+    (Python)
+
+    Builds a Cookie header from a logged-in selenium session, so a direct HTTP
+    download can reuse the browser's authentication.
+
+    --------------------------------------------------------------------------------------
+
+    Keyword arguments:
+    driver -- selenium webdriver
+    '''
+
+    return '; '.join('{}={}'.format(c['name'], c['value']) for c in driver.get_cookies())
+
+
+def download_url(url, destination_path, headers=None, chunk_size=CHUNK_SIZE, stall_timeout=120,
+                 max_retries=5, expected_size=None):
+
+    '''
+    (Python)
+
+    Streams a URL to disk in chunks.  Interrupted transfers are resumed with an HTTP
+    Range request when the server answers 206 (Partial Content); a plain 200 restarts
+    the file.  Socket reads time out after stall_timeout seconds without data.
+
+    --------------------------------------------------------------------------------------
+
+    Keyword arguments:
+    url -- file URL
+    destination_path -- full path to write to.  A '.part' file is used until complete.
+    headers -- extra request headers (e.g. {'Cookie': cookie_header_from_driver(driver)})
+    chunk_size -- bytes per read
+    stall_timeout -- seconds without data before the attempt is abandoned
+    max_retries -- number of resumed attempts after the first one
+    expected_size -- size in bytes, if known
+
+    --------------------------------------------------------------------------------------
+
+    Returns:
+    (bytes written, sha256 hex digest)
+
+    --------------------------------------------------------------------------------------
+
+    Dependencies:
+    import os
+    import hashlib
+    import urllib.request
+    '''
+
+    partial_path = destination_path + '.part'
+    progress = TransferProgress(os.path.basename(destination_path), total_bytes=expected_size)
+    attempt = 0
+
+    while True:
+
+        offset = os.path.getsize(partial_path) if os.path.exists(partial_path) else 0
+        request = urllib.request.Request(url, headers=dict(headers or {}))
+        if offset > 0:
+            request.add_header('Range', 'bytes={}-'.format(offset))
+
+        try:
+            with urllib.request.urlopen(request, timeout=stall_timeout) as response:
+
+                # Server ignored the Range header -> start over
+                if offset > 0 and response.status != 206:
+                    offset = 0
+
+                progress.set(offset)
+                with open(partial_path, 'ab' if offset > 0 else 'wb') as f:
+                    for chunk in iter(lambda: response.read(chunk_size), b''):
+                        f.write(chunk)
+                        progress.update(len(chunk))
+            break
+
+        except urllib.error.HTTPError as e:
+            # 416: nothing left to fetch (the partial already holds the whole file)
+            if e.code == 416 and offset > 0:
+                break
+            raise
+
+        except (urllib.error.URLError, OSError) as e:
+            attempt += 1
+            if attempt > max_retries:
+                raise
+            print('Download interrupted ({}).  Resuming attempt {} of {}'.format(str(e), attempt, max_retries))
+            time.sleep(min(2 ** attempt, 30))
+
+    # Hash in a separate streaming pass so resumed downloads get a whole-file digest
+    sha = hashlib.sha256()
+    with open(partial_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha.update(chunk)
+
+    os.replace(partial_path, destination_path)
+
+    return os.path.getsize(destination_path), sha.hexdigest()